@@ -0,0 +1,429 @@
+"""
+Asyncio client of the chat server, for the command-line client, bots and load tests.
+
+    client = AsyncClient('127.0.0.1', 1060)
+    await client.connect()
+    await client.send('broadcast', 'Hello!')
+    reply = await client.request('/online-users')
+    async for message in client:
+        print(message.sender, message.content)
+"""
+import asyncio
+import itertools
+import os
+import random
+import time
+from collections import namedtuple
+
+from .heartbeat import set_keepalive, HEARTBEAT_INTERVAL, IDLE_TIMEOUT
+from .transfer import pack_chunk
+from .utils import (pack_message, unpack_message, FrameDecoder, IncomingFile, MESSAGE, FILE_DATA, FILE_CHUNK_SIZE,
+                    frame_type, frame_body, frame_ref, compress_frame)
+
+BUFFER_SIZE = 1024 * 64  # 64KB
+REQUEST_TIMEOUT = 10  # Seconds to wait for the reply to a command
+INBOX_SIZE = 1024  # Received messages not consumed yet, beyond which the next ones are dropped
+WRITE_BUFFER_HIGH = 1024 * 256  # Senders wait for the socket above 256KB of unsent data
+# Delays between reconnection attempts, doubled from the first to the last one, with jitter
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30
+
+Message = namedtuple('Message', ['sender', 'recipient', 'content'])
+
+
+def result_fields(content):
+    """
+    :return: the fields of a reply such as '/upload_result:id=1;offset=0', as a dict
+    """
+    header = content.partition('\n')[0]
+    return dict(field.split('=', 1) for field in header.partition(':')[2].split(';') if '=' in field)
+
+
+class AsyncClient:
+    """
+    A connection to the chat server, re-established with exponential backoff whenever it is lost.
+
+    - `send` queues a message or command and returns without waiting for the server. The frames queued
+      within an iteration of the event loop are written together.
+    - `request` sends a command with a ref the server echoes in its reply, and returns the reply.
+      Any number of requests can be pending at once, their commands are pipelined.
+    - Iterating the client yields the other messages received, as Message tuples, until it is closed.
+      Messages received while INBOX_SIZE of them are waiting are dropped, and counted in `dropped`:
+      the socket is still read, so replies and heartbeats get through to a client that doesn't iterate.
+    - The session is resumed on reconnection with the token the server gave for it, so the user keeps its
+      username and groups, and the messages sent to it meanwhile are delivered. Without a token, or if the
+      session can't be resumed, the username is claimed back instead once it is free, i.e. the offline user
+      holding it has expired, without the groups and messages.
+      Requests pending when the connection is lost fail with ConnectionError, sends wait for the next connection.
+    - Heartbeats of the server are answered. The server only pings clients that are silent towards it, so the
+      client pings a server it has received nothing from for HEARTBEAT_INTERVAL itself, and considers it gone
+      once it has been silent for IDLE_TIMEOUT.
+    """
+
+    def __init__(self, host, port, username=None, ssl=None, compress=False, reconnect=True, save_dir=None,
+                 progress=False, on_connect=None, on_disconnect=None, token=None):
+        """
+        :param username: username to claim on connection, e.g. the one of an expired session whose token is lost
+        :param ssl: client SSLContext to encrypt the connection with, see tls.client_context
+        :param compress: ask the server for compressed frames
+        :param save_dir: directory the files sent to the user are saved to, they are not saved if it is None
+        :param progress: show the progress of the received files on the console
+        :param on_connect: function called with the client every time it is connected, and registered as `name`
+        :param on_disconnect: function called with the client and the error, if any, when the connection is lost
+        :param token: token of a previous session to resume on connection, see `token`
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.ssl = ssl
+        self.compress = compress
+        self.reconnect = reconnect
+        self.save_dir = save_dir
+        self.progress = progress
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        # Token of the current session, which the server sends on connection and in the reply to every resume
+        self.token = token
+
+        self.name = None
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.closed = False
+        self.session = None  # TLS session resumed by the next connection
+        # Set once the server has agreed to compression
+        self.compressing = False
+        self.outgoing = []  # Frames written by the next flush
+        self.flush_scheduled = False
+
+        self.refs = itertools.count(1)
+        self.pending = {}  # ref -> Future of the reply
+        self.transfer_ids = itertools.count(1)
+        self.transfers = {}  # transfer id -> Queue of the events of the upload
+        self.inbox = asyncio.Queue(INBOX_SIZE)
+        self.dropped = 0  # Messages received while the inbox was full
+        self.incoming_file = None
+        self.task = None
+
+    async def connect(self):
+        """
+        Connects to the server, and keeps the connection up until the client is closed.
+        :raises OSError: if the server can't be reached
+        """
+        await self.open()
+
+    async def open(self):
+        if self.ssl is not None:
+            self.ssl.session = self.session
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        set_keepalive(writer.get_extra_info('socket'))
+        decoder = FrameDecoder()
+
+        async def next_content():
+            frame = decoder.next_frame()
+            while frame is None:
+                data = await asyncio.wait_for(reader.read(BUFFER_SIZE), IDLE_TIMEOUT)
+                if not data:
+                    writer.close()
+                    raise ConnectionError('The server closed the connection')
+                decoder.feed(data)
+                frame = decoder.next_frame()
+            return unpack_message(frame)[2]
+
+        content = await next_content()
+        if not content.startswith('INIT_USERNAME='):
+            # e.g. /server_busy
+            writer.close()
+            raise ConnectionRefusedError(content)
+        self.name = content.split('=')[1]
+        # Followed by the token of the new session, which replaces the previous one unless that one is resumed
+        token = self.token
+        self.token = result_fields(await next_content())['token']
+
+        self.writer = writer
+        self.compressing = False
+        self.task = asyncio.get_running_loop().create_task(self.read(reader, writer, decoder))
+        if self.ssl is not None:
+            self.session = writer.get_extra_info('ssl_object').session
+
+        try:
+            if token is not None:
+                fields = result_fields(await self.call('/resume {}'.format(token), self.name))
+                if fields['username'] != '-1':
+                    self.name = self.username = fields['username']
+                    self.token = fields['token']
+            if self.username is not None and self.username != self.name:
+                await self.call('/change-username {}'.format(self.username), self.name)
+            if self.compress:
+                await self.call('/compression zlib', self.name)
+        except asyncio.TimeoutError:
+            writer.close()
+            raise
+        self.connected.set()
+        # Resumed or claimed back after reconnecting
+        self.username = self.name
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    async def read(self, reader, writer, decoder):
+        error = None
+        received = time.monotonic()
+        try:
+            while True:
+                for frame in decoder:
+                    await self.dispatch(frame)
+                try:
+                    data = await asyncio.wait_for(reader.read(BUFFER_SIZE), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    if time.monotonic() - received >= IDLE_TIMEOUT:
+                        raise
+                    # Even a client that only sends hears from the server, with its '/pong'
+                    self.write(pack_message(self.name, 'Server', '/ping'))
+                    continue
+                if not data:
+                    break
+                received = time.monotonic()
+                decoder.feed(data)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            error = e
+        await self.lost(writer, error)
+
+    async def dispatch(self, frame):
+        if frame_type(frame) == FILE_DATA:
+            if self.incoming_file is not None and self.incoming_file.write(frame_body(frame)):
+                self.incoming_file = None
+            return
+        if frame_type(frame) != MESSAGE:
+            return
+        sender, recipient, content = message = Message(*unpack_message(frame))
+        if content == '/ping':
+            self.write(pack_message(self.name, 'Server', '/pong'))
+            return
+        if content == '/pong' and not frame_ref(frame):
+            return  # Answer to a heartbeat of the client, receiving it was all that mattered
+
+        if content.startswith('/change-username_result'):
+            new_username = content.split('=')[1]
+            if new_username != '-1':
+                self.name = self.username = new_username
+        elif content.startswith('/compression_result'):
+            self.compressing = content.endswith(':zlib')
+        elif content.startswith('/upload_') and not content.startswith('/upload_result'):
+            # /upload_ack, /upload_error and /upload_done of a transfer
+            transfer_id = content.partition('=')[2].partition(';')[0]
+            events = self.transfers.get(int(transfer_id)) if transfer_id.isdigit() else None
+            if events is not None:
+                events.put_nowait(content)
+                return
+        elif content.startswith('/send-file_aborted'):
+            # The upload of the file being received was interrupted
+            if self.incoming_file is not None:
+                self.incoming_file.discard()
+                self.incoming_file = None
+        elif content.startswith('/send-file') and self.save_dir is not None:
+            _, filename, filesize = content.split()
+            if self.incoming_file is not None:
+                # The rest of the previous file is not coming
+                self.incoming_file.discard()
+            self.incoming_file = IncomingFile(os.path.basename(filename), int(filesize), self.save_dir,
+                                              progress=self.progress)
+            if self.incoming_file.done:
+                self.incoming_file = None
+
+        reply = self.pending.pop(frame_ref(frame), None)
+        if reply is not None:
+            if not reply.done():
+                reply.set_result(content)
+            return
+        try:
+            self.inbox.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def lost(self, writer, error):
+        if writer is not self.writer:
+            return  # A connection which failed to be set up
+        was_connected = self.connected.is_set()
+        self.connected.clear()
+        writer.close()
+        self.outgoing.clear()
+        if self.incoming_file is not None:
+            self.incoming_file.close()
+            self.incoming_file = None
+        for reply in self.pending.values():
+            if not reply.done():
+                reply.set_exception(ConnectionError('The connection to the server was lost'))
+        self.pending.clear()
+        for events in self.transfers.values():
+            events.put_nowait(None)
+        if not was_connected:
+            return  # open() fails, and its caller decides whether to try again
+
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, error)
+        if not self.reconnect:
+            self.stop()
+            return
+        delay = BACKOFF_MIN
+        while True:
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            try:
+                await self.open()
+                return
+            except (OSError, ValueError, asyncio.TimeoutError):
+                delay = min(delay * 2, BACKOFF_MAX)
+
+    def stop(self):
+        """
+        Ends the iteration of the messages, and fails the senders waiting for a connection.
+        """
+        self.closed = True
+        self.connected.set()
+        self.connected.clear()
+        try:
+            self.inbox.put_nowait(None)
+        except asyncio.QueueFull:
+            pass  # The iteration ends once the queued messages have been consumed
+
+    # ================ Sending =============
+
+    def write(self, frame):
+        """
+        Queues a frame, written with the others queued during this iteration of the event loop.
+        """
+        if self.compressing:
+            frame = compress_frame(frame)
+        self.outgoing.append(frame)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.outgoing and not self.writer.is_closing():
+            self.writer.write(b''.join(self.outgoing))
+            self.outgoing.clear()
+
+    async def send_frame(self, frame):
+        while not self.connected.is_set():
+            if self.closed:
+                raise ConnectionError('The client is closed')
+            await self.connected.wait()
+        self.write(frame)
+        if self.writer.transport.get_write_buffer_size() > WRITE_BUFFER_HIGH:
+            await self.writer.drain()
+
+    async def send(self, recipient, content):
+        """
+        Sends a message, or a command whose reply is received as a message, once the client is connected.
+        """
+        await self.send_frame(pack_message(self.name, recipient, content))
+
+    async def request(self, content, recipient=None, timeout=REQUEST_TIMEOUT):
+        """
+        Sends a command and waits for its reply.
+        :param recipient: the user or group the command is about, e.g. of `/upload`
+        :return: the content of the reply
+        :raises ConnectionError: if the connection is lost before the reply
+        :raises asyncio.TimeoutError: if there is no reply within the timeout, e.g. for a command that has none
+        """
+        while not self.connected.is_set():
+            if self.closed:
+                raise ConnectionError('The client is closed')
+            await self.connected.wait()
+        return await self.call(content, recipient or self.name, timeout)
+
+    async def call(self, content, recipient, timeout=REQUEST_TIMEOUT):
+        ref = next(self.refs) % 2 ** 32 or next(self.refs)
+        reply = self.pending[ref] = asyncio.get_running_loop().create_future()
+        self.write(pack_message(self.name, recipient, content, ref=ref))
+        try:
+            return await asyncio.wait_for(reply, timeout)
+        finally:
+            self.pending.pop(ref, None)
+
+    async def upload(self, path, recipient, progress=None):
+        """
+        Sends a file to a user or a group with `/upload`. The server stores a file once whoever uploads it,
+        and an upload interrupted by the loss of the connection resumes where it stopped once reconnected.
+        :param progress: function called with the number of bytes of the file the server has, as they increase
+        :return: False if the server refused the upload
+        """
+        filesize = os.path.getsize(path)
+        filename = os.path.basename(path)
+        while True:
+            transfer_id = next(self.transfer_ids)
+            events = self.transfers[transfer_id] = asyncio.Queue()
+            try:
+                reply = await self.request('/upload {} {} {}'.format(transfer_id, filename, filesize), recipient)
+                fields = result_fields(reply)
+                if not reply.startswith('/upload_result') or fields['id'] == '-1':
+                    return False
+                await self.send_chunks(transfer_id, events, path, int(fields['offset']), filesize, progress)
+                return True
+            except ConnectionError:
+                if self.closed or not self.reconnect:
+                    raise
+            finally:
+                del self.transfers[transfer_id]
+
+    async def send_chunks(self, transfer_id, events, path, offset, filesize, progress):
+        if progress is not None:
+            progress(offset)
+        with open(path, 'rb') as f:
+            while True:
+                while offset < filesize and events.empty():
+                    f.seek(offset)
+                    data = f.read(min(FILE_CHUNK_SIZE, filesize - offset))
+                    if not data:
+                        raise OSError('{} was truncated while being uploaded'.format(path))
+                    await self.send_frame(pack_chunk(transfer_id, offset, data))
+                    offset += len(data)
+                    if progress is not None:
+                        progress(len(data))
+                event = await events.get()
+                if event is None:
+                    raise ConnectionError('The connection to the server was lost')
+                if event.startswith('/upload_done'):
+                    return
+                if event.startswith('/upload_error'):
+                    # A chunk was lost or corrupted, the server expects the upload to go on from its offset
+                    restart = int(result_fields(event)['offset'])
+                    if progress is not None:
+                        progress(restart - offset)
+                    offset = restart
+
+    async def close(self):
+        """
+        Closes the connection for good, once the queued frames are written.
+        """
+        if self.closed:
+            return
+        if self.task is not None:
+            # Stops reading, and reconnecting
+            self.task.cancel()
+        for reply in self.pending.values():
+            if not reply.done():
+                reply.set_exception(ConnectionError('The client is closed'))
+        for events in self.transfers.values():
+            events.put_nowait(None)
+        self.stop()
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+    # ================ Receiving =============
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self.inbox.empty():
+            raise StopAsyncIteration
+        message = await self.inbox.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
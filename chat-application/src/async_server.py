@@ -0,0 +1,253 @@
+import asyncio
+import time
+from collections import deque
+
+from .heartbeat import set_keepalive
+from .log import logger
+from .metrics import metrics
+from .server import Server, CommandHandler, busy_message
+from .utils import FrameDecoder, compress_frame, compress_message
+
+WRITE_BUFFER_HIGH = 1024 * 256  # Pause writing files to a client above 256KB of unsent data
+
+
+class AsyncServer(Server):
+    """
+    Serves all clients from a single asyncio event loop instead of a thread per client.
+    Idle connections only cost an AsyncServerSocket object and a file descriptor.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.tcp_server = None
+        self.tasks = set()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def spawn(self, coro):
+        """
+        Runs the coroutine as a task of the event loop, keeping a reference to it until it is done.
+        """
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def schedule(self, delay, function):
+        """
+        Calls the function after delay seconds from the event loop, which the connections are written from.
+        """
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, function)
+
+    def call(self, function, *args):
+        """
+        Calls the function from the event loop, and waits for its result.
+        """
+        async def call():
+            return function(*args)
+
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def stop_accepting(self):
+        self.draining.set()
+        self.call(self.tcp_server.close)
+
+    def apply_bus_event_soon(self, event, args):
+        """
+        Events of the other shards are received by the bus thread, and applied by the event loop.
+        """
+        self.loop.call_soon_threadsafe(self.apply_bus_event, event, args)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.tcp_server = await self.loop.create_server(lambda: AsyncServerSocket(self), sock=self.listen(),
+                                                        ssl=self.ssl_context, start_serving=False)
+        await self.loop.run_in_executor(None, self.take_over)
+        if self.bus is not None:
+            self.bus.listen(self.apply_bus_event_soon)
+        self.reaper.start()
+
+        await self.tcp_server.start_serving()
+        # Serves until the process exits, the connections outlive the listener when the server is drained
+        await self.loop.create_future()
+
+
+class AsyncServerSocket(CommandHandler, asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.sockname = None
+        self.address = None
+
+        self.decoder = FrameDecoder()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        # Messages waiting for the transport's write buffer to drain below its high-water mark
+        self.outbox = deque()
+        self.compress = False
+        self.sending = set()
+        # Set when the connection is to be closed once the outbox is written
+        self.finishing = False
+        # Storage writes the handling of the frames waits for, see then
+        self.waiting = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        self.sockname = transport.get_extra_info('peername')
+        self.address = str(self.sockname)
+        # asyncio accepts connections as they come, so beyond the accept rate they are turned away
+        # instead of being left in the listen backlog as in the threaded mode
+        if self.server.admission() is not None:
+            logger.warning('Turning away %s, %s connections are open', self.sockname, len(self.server.connections))
+            self.transport.write(busy_message())
+            self.transport.close()
+            return
+        set_keepalive(transport.get_extra_info('socket'), timeout=self.server.idle_timeout)
+        logger.info('Accepted a new connection from %s to %s', self.sockname, transport.get_extra_info('sockname'))
+
+        self.server.register(self)
+        logger.debug('Ready to receive messages from %s', self.sockname)
+
+    def data_received(self, data):
+        self.last_seen = time.monotonic()
+        metrics.inc('chat_bytes_received_total', len(data))
+        self.decoder.feed(data)
+        if not self.handle_frames():
+            return
+        if self.registered:
+            # Clients sending faster than their byte rate are read from more slowly
+            delay = self.throttle(len(data))
+            if delay:
+                self.transport.pause_reading()
+                self.server.loop.call_later(delay, self.transport.resume_reading)
+
+    def handle_frames(self):
+        """
+        Handles the frames received, until one of them waits for the storage.
+        :return: False if the connection was closed because the stream can't be decoded anymore
+        """
+        if self.waiting:
+            return True  # Reading was resumed by the throttle meanwhile, the frames wait for the storage
+        try:
+            for frame in self.decoder:
+                self.handle_frame(frame)
+                if self.waiting:
+                    break
+        except (ValueError, OSError) as e:
+            # The stream can not be decoded anymore, or a file it carries can not be written
+            logger.warning('Closing connection %s: %s', self.sockname, e)
+            self.transport.close()
+            return False
+        return True
+
+    def then(self, future, callback):
+        """
+        Calls the callback from the event loop once the storage write is done, instead of blocking the loop
+        until it is committed. The client is not read from meanwhile, and the frames already received are
+        handled after the callback, so its commands are still answered in order.
+        """
+        self.waiting += 1
+        self.transport.pause_reading()
+
+        def done(_):
+            try:
+                callback(future)
+            finally:
+                self.waiting -= 1
+                if not self.waiting:
+                    self.transport.resume_reading()
+                    self.handle_frames()
+
+        asyncio.wrap_future(future, loop=self.server.loop).add_done_callback(done)
+
+    def connection_lost(self, exc):
+        self.abort_file()
+        self.can_write.set()
+        self.server.unregister(self)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        while self.outbox:
+            message = self.outbox.popleft()
+            self.transport.write(message)
+            metrics.inc('chat_bytes_sent_total', len(message))
+            if self.transport.is_closing():
+                return
+            if self.transport.get_write_buffer_size() > WRITE_BUFFER_HIGH:
+                # write() has paused the transport again, the rest is written on the next resume
+                return
+        self.can_write.set()
+        if self.finishing:
+            self.transport.close()
+
+    def send(self, message):
+        if self.transport.is_closing():
+            return
+        if self.compress:
+            message = compress_message(message)
+        if self.can_write.is_set():
+            self.transport.write(message)
+            metrics.inc('chat_bytes_sent_total', len(message))
+        elif len(self.outbox) < self.server.outbox_size:
+            self.outbox.append(message)
+        elif self.server.slow_consumer_detected(self):
+            logger.warning('Disconnecting slow consumer %s', self.sockname)
+            self.transport.abort()
+
+    def finish(self):
+        """
+        Closes the connection once the outbox is written, the transport writes its buffer before closing.
+        """
+        self.finishing = True
+        if not self.outbox:
+            self.transport.close()
+
+    def outbox_depth(self):
+        return len(self.outbox)
+
+    def deliver_file(self, fanout):
+        self.sending.add(fanout)
+        self.server.spawn(self.send_fanout(fanout))
+
+    async def send_fanout(self, fanout):
+        """
+        Writes the file of the fan-out to this client, waiting whenever its transport's write buffer is full.
+        Every recipient has a task of its own, so a slow client doesn't hold up the other recipients.
+        """
+        try:
+            self.send(fanout.message)
+            offset = 0
+            while offset < fanout.filesize and not self.transport.is_closing():
+                available = await fanout.wait_async(offset)
+                if available <= offset:
+                    # The upload was aborted
+                    await self.can_write.wait()
+                    self.send(fanout.abort_message())
+                    break
+                for start, count in fanout.chunks(offset, available):
+                    await self.can_write.wait()
+                    if self.transport.is_closing():
+                        return
+                    frame = fanout.frame_header(count) + fanout.map[start:start + count]
+                    if self.compress:
+                        frame = compress_frame(frame)
+                    self.transport.write(frame)
+                    metrics.inc('chat_bytes_sent_total', len(frame))
+                    offset = start + count
+        finally:
+            self.sending.discard(fanout)
+            fanout.release()
+
+    def abort(self):
+        """
+        Drops the connection of a client which doesn't answer anymore, from the event loop.
+        """
+        self.transport.abort()
+
+    def close(self):
+        self.server.loop.call_soon_threadsafe(self.transport.close)
@@ -0,0 +1,481 @@
+"""
+Load generator and latency benchmark of the chat server.
+Simulates many clients speaking the chat protocol against a running server, or against one it starts itself,
+drives a mix of broadcast, direct and group messages, `/send-file` transfers and commands, and reports
+throughput, delivery latency percentiles and the CPU and memory used by the server.
+Results are saved as JSON, and can be compared with the results of a previous run.
+Usage (from the chat-application directory):
+    python -m src.bench -spawn -clients 1000 -duration 20 -mix direct=8,group=1,broadcast=1
+    python -m src.bench -spawn -workers 4 -compare bench_results/bench-20260101-120000.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .ratelimit import RATE_LIMITS
+from .utils import (pack_message, unpack_message, pack_frame, FrameDecoder, frame_type, frame_body, frame_ref,
+                    FILE_DATA, FILE_CHUNK_SIZE)
+
+KINDS = ['broadcast', 'direct', 'group', 'file', 'command']
+COMMANDS = ['/online-users', '/show-groups', '/history broadcast', '/change-chat broadcast']
+RESULTS_DIR = 'bench_results'
+CONNECT_TIMEOUT = 30
+DRAIN_TIME = 2  # Seconds to wait for the deliveries in flight once the clients stop sending
+
+
+def parse_mix(mix):
+    """
+    :param mix: weights of the kinds of traffic, e.g. 'direct=8,group=1,broadcast=1'
+    :return: a dict of kind -> weight
+    """
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in KINDS:
+            raise ValueError('Unknown kind of traffic {!r}, expected one of {}'.format(kind, ', '.join(KINDS)))
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def percentile(samples, q):
+    """
+    :param samples: sorted samples
+    :param q: a fraction, e.g. 0.99
+    """
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': percentile(samples, 0.5),
+        'p99_ms': percentile(samples, 0.99),
+        'p999_ms': percentile(samples, 0.999),
+        'max_ms': samples[-1] if samples else None,
+    }
+
+
+# ================ Simulated Clients =============
+
+class SimulatedClient:
+    """
+    A client connection of the benchmark. Messages carry the wall-clock time they were sent at,
+    so their receivers (possibly in another process of the benchmark) can measure the delivery latency.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.name = None
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.named = asyncio.Event()
+        # Send times of the commands waiting for their reply, by the ref the reply comes back with
+        self.pending_commands = {}
+        self.refs = itertools.count(1)
+        # Send times and sizes of the files announced to this client, whose data is still expected
+        self.incoming_files = []
+        self.incoming_bytes = 0
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        asyncio.get_running_loop().create_task(self.receive())
+        await asyncio.wait_for(self.named.wait(), CONNECT_TIMEOUT)
+
+    async def receive(self):
+        while True:
+            try:
+                data = await self.reader.read(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self.stats['disconnects'] += 1
+                return
+            self.stats['bytes_in'] += len(data)
+            self.decoder.feed(data)
+            for frame in self.decoder:
+                if frame_type(frame) == FILE_DATA:
+                    self.file_data(len(frame_body(frame)))
+                else:
+                    self.message(frame)
+
+    def message(self, frame):
+        sender, recipient, content = unpack_message(frame)
+        now = time.time_ns()
+        if content.startswith('INIT_USERNAME'):
+            self.name = content.split('=')[1]
+            self.named.set()
+        elif content.startswith('/session_token'):
+            pass  # Sent after INIT_USERNAME, it is not the reply to a command
+        elif content.startswith('bench '):
+            sent = int(content.split(' ', 2)[1])
+            if recipient == 'broadcast':
+                kind = 'broadcast'
+            elif recipient.startswith('bench-g'):
+                kind = 'group'
+            else:
+                kind = 'direct'
+            self.stats['latency'][kind].append((now - sent) / 1e6)
+        elif content.startswith('/send-file'):
+            _, filename, filesize = content.split()
+            sent = int(filename[len('bench-'):-len('.bin')])
+            self.incoming_files.append((sent, int(filesize)))
+        elif sender == 'Server' and content.startswith(('/rate_limited', '/overloaded')):
+            # A refused command is answered with the refusal, which is not a reply to time
+            self.pending_commands.pop(frame_ref(frame), None)
+            self.stats['refused'] += 1
+        elif sender == 'Server' and frame_ref(frame) in self.pending_commands:
+            sent = self.pending_commands.pop(frame_ref(frame))
+            self.stats['latency']['command'].append((now - sent) / 1e6)
+
+    def file_data(self, n):
+        # Transfers to the same client may overlap, the bytes are attributed to the files in announcement order
+        self.incoming_bytes += n
+        while self.incoming_files and self.incoming_bytes >= self.incoming_files[0][1]:
+            sent, size = self.incoming_files.pop(0)
+            self.incoming_bytes -= size
+            self.stats['latency']['file'].append((time.time_ns() - sent) / 1e6)
+
+    def write(self, frame):
+        self.stats['bytes_out'] += len(frame)
+        self.writer.write(frame)
+
+    def send(self, recipient, padding):
+        self.write(pack_message(self.name, recipient, 'bench {} {}'.format(time.time_ns(), padding)))
+
+    def command(self, content):
+        ref = next(self.refs)
+        self.pending_commands[ref] = time.time_ns()
+        self.write(pack_message(self.name, self.name, content, ref=ref))
+
+    def send_file(self, recipient, filesize):
+        self.write(pack_message(self.name, recipient, '/send-file bench-{}.bin {}'.format(time.time_ns(), filesize)))
+        data = os.urandom(min(filesize, FILE_CHUNK_SIZE))
+        for offset in range(0, filesize, FILE_CHUNK_SIZE):
+            self.write(pack_frame(FILE_DATA, data[:min(FILE_CHUNK_SIZE, filesize - offset)]))
+
+    def close(self):
+        self.writer.close()
+
+
+async def drive(client, peers, groups, options, weights, deadline):
+    """
+    Sends the traffic of one client at `rate` operations per second until the deadline.
+    """
+    kinds = list(weights)
+    cumulative = [sum(list(weights.values())[:i + 1]) for i in range(len(kinds))]
+    padding = 'x' * max(0, options['size'] - 30)
+    interval = 1 / options['rate']
+    # Spread the clients over the first interval, instead of sending in lockstep
+    await asyncio.sleep(random.random() * interval)
+    while time.monotonic() < deadline:
+        kind = random.choices(kinds, cum_weights=cumulative)[0]
+        if kind == 'broadcast':
+            client.send('broadcast', padding)
+        elif kind == 'direct':
+            client.send(random.choice(peers).name, padding)
+        elif kind == 'group':
+            client.send(random.choice(groups), padding)
+        elif kind == 'file':
+            client.send_file(random.choice(peers).name, options['file_size'])
+        elif kind == 'command':
+            client.command(random.choice(COMMANDS))
+        client.stats['sent'][kind] += 1
+        if client.writer.transport.get_write_buffer_size() > 1024 * 1024:
+            await client.writer.drain()
+        await asyncio.sleep(interval)
+
+
+async def run_clients(index, count, options, barrier):
+    stats = {'sent': {kind: 0 for kind in KINDS}, 'latency': {kind: [] for kind in KINDS},
+             'bytes_in': 0, 'bytes_out': 0, 'disconnects': 0, 'connect_errors': 0, 'refused': 0}
+    clients = []
+    for i in range(count):
+        client = SimulatedClient(stats)
+        try:
+            await client.connect(options['host'], options['port'])
+            clients.append(client)
+        except (OSError, asyncio.TimeoutError):
+            stats['connect_errors'] += 1
+
+    # Every process has groups of its own, joined by its clients
+    groups = ['bench-g{}-{}-{}'.format(options['run'], index, g) for g in range(options['groups'])]
+    if clients:
+        for group in groups:
+            clients[0].write(pack_message(clients[0].name, clients[0].name, '/create-group ' + group))
+        await asyncio.sleep(0.5)
+        for i, client in enumerate(clients):
+            client.write(pack_message(client.name, client.name, '/join-group ' + groups[i % len(groups)]))
+        await asyncio.sleep(1)
+    for kind in KINDS:
+        stats['latency'][kind].clear()
+    stats['clients'] = len(clients)
+
+    # Start sending at the same time in every process
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    deadline = time.monotonic() + options['duration']
+    weights = options['weights']
+    await asyncio.gather(*(drive(client, clients, groups, options, weights, deadline) for client in clients))
+    await asyncio.sleep(DRAIN_TIME)
+    for client in clients:
+        client.close()
+    return stats
+
+
+def client_process(index, count, options, barrier, results):
+    raise_fd_limit()
+    results.put(asyncio.run(run_clients(index, count, options, barrier)))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ================ Server Under Test =============
+
+def spawn_server(host, port, mode, workers):
+    """
+    Starts a server with a fresh database in a temporary directory.
+    Its rate limits are lifted, so that it is measured at the load the benchmark sends rather than at its limits.
+    :return: the server process and its directory
+    """
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    work_dir = tempfile.mkdtemp(prefix='chat-bench-')
+    shutil.copy(os.path.join(app_dir, 'usernames.txt'), work_dir)
+    env = dict(os.environ, PYTHONPATH=app_dir)
+    log = open(os.path.join(work_dir, 'server.log'), 'w')
+    process = subprocess.Popen([sys.executable, '-m', 'src.server', host, '-p', str(port), '-mode', mode,
+                                '-workers', str(workers), '-db', os.path.join(work_dir, 'db.sqlite')]
+                               + [arg for name in RATE_LIMITS for arg in ('-rate-limit', name + '=0')],
+                               cwd=work_dir, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('The server did not start, see {}'.format(log.name))
+            time.sleep(0.2)
+    # The probe connection has registered a user, give its departure time to settle
+    time.sleep(0.5)
+    return process, work_dir
+
+
+def process_tree(pid):
+    """
+    :return: the pid and the pids of the children of the process, e.g. the workers of a sharded server
+    """
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return pids
+
+
+def process_usage(pid):
+    """
+    :return: (cpu seconds, resident memory bytes) of the process, read from /proc
+    """
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+
+class UsageSampler(threading.Thread):
+    """
+    Samples the CPU and memory used by the server and its worker processes once a second.
+    """
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.cpu_percent = []
+        self.rss = []
+        self.running = True
+
+    def usage(self):
+        cpu = rss = 0
+        for pid in process_tree(self.pid):
+            try:
+                process_cpu, process_rss = process_usage(pid)
+            except OSError:
+                continue
+            cpu += process_cpu
+            rss += process_rss
+        return cpu, rss
+
+    def run(self):
+        last_cpu, last_time = self.usage()[0], time.monotonic()
+        while self.running:
+            time.sleep(1)
+            cpu, rss = self.usage()
+            now = time.monotonic()
+            self.cpu_percent.append(100 * (cpu - last_cpu) / (now - last_time))
+            self.rss.append(rss)
+            last_cpu, last_time = cpu, now
+
+    def summary(self):
+        return {
+            'cpu_avg_percent': sum(self.cpu_percent) / len(self.cpu_percent) if self.cpu_percent else None,
+            'cpu_max_percent': max(self.cpu_percent, default=None),
+            'rss_max_mb': max(self.rss) / 2 ** 20 if self.rss else None,
+        }
+
+
+# ================ Results =============
+
+def merge(all_stats, options, elapsed, server):
+    sent = {kind: sum(stats['sent'][kind] for stats in all_stats) for kind in KINDS}
+    latency = {kind: summarize([sample for stats in all_stats for sample in stats['latency'][kind]])
+               for kind in KINDS}
+    delivered = sum(latency[kind]['count'] for kind in KINDS if kind != 'command')
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'options': {key: value for key, value in options.items() if key != 'weights'},
+        'clients': sum(stats['clients'] for stats in all_stats),
+        'connect_errors': sum(stats['connect_errors'] for stats in all_stats),
+        'disconnects': sum(stats['disconnects'] for stats in all_stats),
+        'refused': sum(stats['refused'] for stats in all_stats),
+        'sent': sent,
+        'sent_per_second': sum(sent.values()) / elapsed,
+        'delivered': delivered,
+        'delivered_per_second': delivered / elapsed,
+        'bytes_in_per_second': sum(stats['bytes_in'] for stats in all_stats) / elapsed,
+        'bytes_out_per_second': sum(stats['bytes_out'] for stats in all_stats) / elapsed,
+        'latency': latency,
+        'server': server,
+    }
+
+
+def flatten(results, prefix=''):
+    """
+    :return: the numbers of the results, keyed by their dotted path
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def report(results, baseline=None):
+    current = flatten({key: results[key] for key in results if key != 'options'})
+    previous = flatten({key: baseline[key] for key in baseline if key != 'options'}) if baseline else {}
+    for key, value in current.items():
+        line = '{:<36}{:>14.3f}'.format(key, value)
+        if previous.get(key):
+            line += '{:>14.3f}{:>+9.1f}%'.format(previous[key], 100 * (value - previous[key]) / previous[key])
+        print(line)
+
+
+def main(args):
+    options = {
+        'host': args.host, 'port': args.p, 'clients': args.clients, 'duration': args.duration,
+        'rate': args.rate, 'size': args.size, 'file_size': args.file_size, 'groups': args.groups,
+        'mix': args.mix, 'weights': parse_mix(args.mix), 'mode': args.mode, 'workers': args.workers,
+        'spawn': args.spawn, 'run': random.randrange(1 << 30),
+    }
+    raise_fd_limit()
+
+    server_process = work_dir = None
+    if args.spawn:
+        server_process, work_dir = spawn_server(args.host, args.p, args.mode, args.workers)
+    server_pid = server_process.pid if server_process else args.server_pid
+    sampler = UsageSampler(server_pid) if server_pid else None
+
+    try:
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(args.processes + 1)
+        results = context.Queue()
+        counts = [args.clients // args.processes + (i < args.clients % args.processes)
+                  for i in range(args.processes)]
+        processes = [context.Process(target=client_process, args=(i, count, options, barrier, results))
+                     for i, count in enumerate(counts)]
+        for process in processes:
+            process.start()
+
+        barrier.wait()
+        print('All clients connected, sending for {}s'.format(args.duration))
+        if sampler:
+            sampler.start()
+        started = time.monotonic()
+        all_stats = [results.get() for _ in processes]
+        elapsed = time.monotonic() - started - DRAIN_TIME
+        for process in processes:
+            process.join()
+        if sampler:
+            sampler.running = False
+    finally:
+        if server_process:
+            server_process.kill()
+            server_process.wait()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = merge(all_stats, options, elapsed, sampler.summary() if sampler else {})
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime('bench-%Y%m%d-%H%M%S.json'))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to', output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chatroom Benchmark')
+    parser.add_argument('host', nargs='?', default='127.0.0.1', help='Interface the server listens at')
+    parser.add_argument('-p', metavar='PORT', type=int, default=1060, help='TCP port (default 1060)')
+    parser.add_argument('-spawn', action='store_true',
+                        help='Start a server with a fresh database for the benchmark, instead of using a running one')
+    parser.add_argument('-mode', choices=['thread', 'async'], default='thread', help='Mode of the spawned server')
+    parser.add_argument('-workers', metavar='N', type=int, default=1, help='Worker processes of the spawned server')
+    parser.add_argument('-server-pid', metavar='PID', type=int, default=None,
+                        help='Process of a running server to measure the CPU and memory of')
+    parser.add_argument('-clients', metavar='N', type=int, default=200, help='Simulated clients (default 200)')
+    parser.add_argument('-processes', metavar='N', type=int, default=max(1, min(4, os.cpu_count() // 2)),
+                        help='Benchmark processes the clients are spread over')
+    parser.add_argument('-duration', metavar='SECONDS', type=float, default=10, help='Time spent sending')
+    parser.add_argument('-rate', metavar='N', type=float, default=5, help='Operations per second of each client')
+    parser.add_argument('-mix', type=str, default='direct=8,group=1,broadcast=1',
+                        help='Weights of the kinds of traffic among {} (default direct=8,group=1,broadcast=1)'
+                        .format(', '.join(KINDS)))
+    parser.add_argument('-size', metavar='BYTES', type=int, default=100, help='Size of the messages')
+    parser.add_argument('-file-size', metavar='BYTES', type=int, default=64 * 1024, help='Size of the files')
+    parser.add_argument('-groups', metavar='N', type=int, default=10, help='Groups per benchmark process')
+    parser.add_argument('-output', metavar='FILE', type=str, default=None,
+                        help='Where to save the results (default {}/bench-<time>.json)'.format(RESULTS_DIR))
+    parser.add_argument('-compare', metavar='FILE', type=str, default=None,
+                        help='Results of a previous run to compare with')
+    main(parser.parse_args())
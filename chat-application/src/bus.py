@@ -0,0 +1,101 @@
+import os
+import pickle
+import struct
+import threading
+from multiprocessing.connection import Client, Listener
+
+from .log import logger, stop_logging
+
+# Every bus message starts with the shard it is addressed to, or ALL_SHARDS
+TARGET = struct.Struct('!i')
+ALL_SHARDS = -1
+READY = b'ready'
+
+
+class MessageBus:
+    """
+    Connection of a worker process to the BusHub of the supervisor.
+    Events are (name, args) tuples, published to one shard or to all the other ones.
+    """
+
+    def __init__(self, address, shard, authkey):
+        self.shard = shard
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+        self.conn.send_bytes(TARGET.pack(shard))
+        # Serializes the events published by the threads of the worker
+        self.lock = threading.Lock()
+
+    def wait_ready(self):
+        """
+        Blocks until every worker has connected to the bus, so none of them misses events.
+        """
+        if self.conn.recv_bytes() != READY:
+            raise ValueError('Unexpected message on the bus')
+
+    def publish(self, event, args, to=None):
+        data = TARGET.pack(ALL_SHARDS if to is None else to) + pickle.dumps((event, args), pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.conn.send_bytes(data)
+
+    def listen(self, handler):
+        """
+        Calls handler(event, args) for each event published by the other shards, from a thread of its own.
+        """
+        threading.Thread(target=self.receive, args=(handler,), name='bus', daemon=True).start()
+
+    def receive(self, handler):
+        while True:
+            try:
+                event, args = pickle.loads(self.conn.recv_bytes())
+            except (EOFError, OSError):
+                # The supervisor is gone, this worker can't route to the other shards anymore
+                logger.error('Lost the connection to the message bus, shard %s exiting', self.shard)
+                stop_logging()
+                os._exit(1)
+            handler(event, args)
+
+
+class BusHub:
+    """
+    Relays the events of each worker process to the worker they are addressed to, or to all the other ones.
+    Runs in the supervisor, with a thread per worker. Events are forwarded without being decoded.
+    """
+
+    def __init__(self, address, shards, authkey):
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self.shards = shards
+        self.conns = {}
+        self.locks = {}
+
+    def serve(self):
+        while len(self.conns) < self.shards:
+            conn = self.listener.accept()
+            shard, = TARGET.unpack(conn.recv_bytes())
+            self.conns[shard] = conn
+            self.locks[shard] = threading.Lock()
+
+        for shard, conn in self.conns.items():
+            threading.Thread(target=self.relay, args=(shard, conn), name='bus-{}'.format(shard), daemon=True).start()
+            conn.send_bytes(READY)
+
+    def relay(self, source, conn):
+        while True:
+            try:
+                data = conn.recv_bytes()
+            except (EOFError, OSError):
+                return
+            to, = TARGET.unpack_from(data)
+            targets = self.conns if to == ALL_SHARDS else {to: self.conns[to]}
+            for shard, target in targets.items():
+                if shard == source:
+                    continue
+                try:
+                    with self.locks[shard]:
+                        target.send_bytes(data, TARGET.size)
+                except OSError:
+                    pass  # That worker is gone, the supervisor is shutting the cluster down
+
+    def close(self):
+        self.listener.close()
+        for conn in self.conns.values():
+            conn.close()
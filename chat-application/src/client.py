@@ -1,103 +1,146 @@
 import argparse
+import asyncio
 import os
-import socket
 import threading
 
-from .utils import pack_message, unpack_message, send_file, recv_file
+from .async_client import AsyncClient, result_fields
+from .tls import client_context
+from .utils import pack_message, Progress
 
-BUFFER_SIZE = 1024 * 4  # 4KB
 
+class Client:
+    """
+    The command-line client: messages and commands typed are sent to the current chat,
+    and the messages and replies received are printed. The connection is re-established when it is lost.
+    """
 
-class Send(threading.Thread):
-    def __init__(self, sock):
-        super().__init__()
-        self.sock = sock
-        self.name = 'UNK'
+    def __init__(self, host, port, username=None, tls=False, cafile=None, compress=False, token=None):
+        """
+        :param username: username of an expired session to claim back, e.g. when its token is lost
+        :param token: token of a previous session to resume, which also gets its groups back
+        :param tls: encrypt the connection, verifying the server with the CA certificates in cafile
+         (the default ones of the system if it is None)
+        :param compress: ask the server for compressed frames
+        """
+        self.connection = AsyncClient(host, port, username, ssl=client_context(cafile) if tls else None,
+                                      compress=compress, progress=True, token=token,
+                                      on_connect=self.connected, on_disconnect=self.disconnected)
         self.recipient = 'broadcast'
+        self.joined = False
+        self.token = None  # The last token shown to the user
 
-    def run(self):
-        while True:
-            input_str = input('{}: '.format(self.name))
-
-            # Type '/quit' to leave the chatroom
-            if input_str == '/quit':
-                self.sock.sendall('Server: {} has left the chat.'.format(self.name).encode('ascii'))
-                break
+    @property
+    def name(self):
+        return self.connection.name
 
-            elif input_str.startswith('/send-file'):
-                _, filepath = input_str.split()
+    def start(self):
+        asyncio.run(self.run())
 
-                filesize = int(os.path.getsize(filepath))
-                filename = os.path.basename(filepath)
+    async def run(self):
+        connection = self.connection
+        print('Trying to connect to {}:{}...'.format(connection.host, connection.port))
+        await connection.connect()
 
-                content = '/send-file {} {}'.format(filename, filesize)
+        # Create a directory to store client's received files
+        pwd = os.getcwd()
+        connection.save_dir = os.path.join(pwd, 'clients_media/' + str(connection.writer.get_extra_info('sockname')))
+        os.makedirs(connection.save_dir, exist_ok=True)
 
-                # send the filename and filesize
-                message = pack_message(self.name, self.recipient, content)
-                self.sock.sendall(message)
+        # input() blocks, so lines are read by a thread of their own
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+        threading.Thread(target=read_lines, args=(loop, lines), daemon=True).start()
+        loop.create_task(self.handle_input(lines))
 
-                send_file(self.sock, filepath, filesize)
+        print("\rAll set! Leave the chatroom anytime by typing '/quit'\n")
+        self.prompt()
+        async for message in connection:
+            self.show(*message)
+        print('\nQuiting...')
 
-            # Send message (or command) to server_media
-            else:
-                message = pack_message(self.name, self.recipient, content=input_str)
-                self.sock.sendall(message)
+    def connected(self, connection):
+        if self.joined:
+            print('\nReconnected as {}'.format(self.name))
+            self.show_token(connection)
+            self.prompt()
+            return
+        self.joined = True
+        print('Successfully connected to {}:{}'.format(connection.host, connection.port))
+        print('Welcome! Getting ready to send and receive messages...')
+        print('\nYour Username is: ' + self.name)
+        print("If you don't like it, you can always change it by typing the command `/change-username`!")
+        self.show_token(connection)
+        connection.write(pack_message('Server', 'broadcast', '{} has joined the chat. Say hi!'.format(self.name)))
+
+    def show_token(self, connection):
+        # A token is good for one resume only, the one of every new session is shown
+        if connection.token != self.token:
+            self.token = connection.token
+            print("To come back as {} with your groups next time, start the client with `-token {}`\n"
+                  .format(self.name, self.token))
+
+    def disconnected(self, connection, error):
+        print('\nOh no, we have lost connection to the Server! Reconnecting...')
+
+    def prompt(self):
+        print('{}: '.format(self.name), end='', flush=True)
 
-        print('\nQuiting...')
-        self.sock.close()
-        os._exit(0)
+    async def handle_input(self, lines):
+        while True:
+            input_str = await lines.get()
 
+            # Type '/quit' to leave the chatroom, the server notifies others once the socket is closed
+            if input_str is None or input_str == '/quit':
+                await self.connection.close()
+                return
 
-class Receive(threading.Thread):
-    def __init__(self, sender, sock, save_dir):
-        super().__init__()
-        self.sender = sender
-        self.sock = sock
-        self.name = 'UNK'
-        self.save_dir = save_dir
+            elif input_str.startswith('/send-file'):
+                _, filepath = input_str.split()
+                asyncio.get_running_loop().create_task(self.upload(filepath, self.recipient))
 
-    def run(self):
-        while True:
-            message = self.sock.recv(1024)
-            if message:
-                self.parse(message)
-                # print('\r{}\n{}: '.format(message.decode('ascii'), self.name), end='')
+            # Send message (or command) to server_media
             else:
-                # Server has closed the socket, exit the program
-                print('\nOh no, we have lost connection to the Server!')
-                print('\nQuitting...')
-                self.sock.close()
-                os._exit(0)
-
-    def parse(self, message):
-        """ Parse the received data, print out the messages, execute the commands.
-        :param message:
-        :return:
+                try:
+                    await self.connection.send(self.recipient, input_str)
+                except ConnectionError:
+                    return
+            self.prompt()
+
+    async def upload(self, path, recipient):
+        # The server resumes an upload of this file by this user which was interrupted,
+        # and stores a file of the same content as one it already has only once
+        progress = Progress(os.path.getsize(path), "Sending {}".format(path))
+        try:
+            uploaded = await self.connection.upload(path, recipient, progress.update)
+        except OSError as e:
+            print('\nUpload of {} failed: {}'.format(path, e))
+            return
+        finally:
+            progress.close()
+        if uploaded:
+            print("{} was uploaded successfully!".format(os.path.basename(path)))
+        else:
+            print("The upload could not be started!")
+        self.prompt()
+
+    def show(self, sender, recipient, content):
+        """
+        Prints out a received message, or the outcome of a command.
         """
         print()
-        sender, recipient, content = unpack_message(message)
-
-        if content.startswith('INIT_USERNAME'):
-            _, new_username = content.split('=')
-            self.name = new_username
-            self.sender.name = new_username
-            print('\nYour Username is: ' + new_username)
-            print("If you don't like it, you can always change it by typing the command `/change-username`!\n")
 
-            content = '{} has joined the chat. Say hi!'.format(self.name)
-            message = pack_message('Server', 'broadcast', content)
-            self.sock.sendall(message)
+        if content.startswith("/"):
+            if content.startswith("/send-file_aborted"):
+                _, filename = content.split()
+                print("{} stopped sending {}, the part received was deleted".format(sender, filename))
 
-        elif content.startswith("/"):
-            if content.startswith("/send-file"):
-                _, filename, filesize = content.split()
-                filesize = int(filesize)
-                recv_file(self.sock, filename, filesize, self.save_dir)
+            elif content.startswith("/send-file"):
+                pass  # The file is saved by the connection, which shows its progress
 
             elif content.startswith("/change-chat_result"):
                 _, new_recipient = content.split('=')
                 if new_recipient != '-1':
-                    self.sender.recipient = new_recipient
+                    self.recipient = new_recipient
                     print("You are now chatting with " + new_recipient)
                 else:
                     print("It seems like this user is not currently online!")
@@ -105,17 +148,22 @@ class Receive(threading.Thread):
             elif content.startswith("/change-username_result"):
                 _, new_username = content.split('=')
                 if new_username != '-1':
-                    self.name = new_username
-                    self.sender.name = new_username
                     print("Your username successfully changed to: {}".format(new_username))
                 else:
-                    print("Sorry! It seems like this one is already taken!")
+                    print("Sorry! It seems like this one is already taken, or not a valid username!")
+
+            elif content.startswith("/resume_result"):
+                if result_fields(content)['username'] == '-1':
+                    print("Your previous session could not be resumed!")
 
             elif content.startswith("/online-users"):
-                online_users = content.split('\n')
-                print('Following Users are currently online')
-                for i, user in enumerate(online_users[1:]):
-                    print('#{}.\t{}'.format(i, user))
+                header, _, online_users = content.partition('\n')
+                next_after, count = [field.split('=')[1] for field in header.split(':')[1].split(';')]
+                print('Following {} Users are currently online'.format(count))
+                for user in online_users.splitlines():
+                    print('\t{}'.format(user))
+                if next_after != '-1':
+                    print('To see more of them, type `/online-users {}`'.format(next_after))
                 print('\nYou can chat with each one by typing the command change-chat')
 
             elif content.startswith("/create-group_result"):
@@ -125,6 +173,12 @@ class Receive(threading.Thread):
                 else:
                     print("Group created successfully!")
 
+            elif content.startswith("/join-group_result") and 'join_group=' not in content:
+                # Several groups joined at once
+                results = batch_results(content)
+                self.show_batch(results, {'1': "You are now a member of", '0': "You were already a member of",
+                                          '-1': "No such groups:"})
+
             elif content.startswith("/join-group_result"):
                 _, new_joined_group = content.split('=')
                 if new_joined_group == '-1':
@@ -137,11 +191,19 @@ class Receive(threading.Thread):
                     print("To chat with them, simply type `/change-chat {}`".format(new_joined_group))
 
             elif content.startswith("/show-groups_result"):
-                _, available_groups = content.split('=')
-                print(' #\tName\tCreator Address\t\tCreation Date')
+                header, _, available_groups = content.partition('\n')
+                next_after, count = [field.split('=')[1] for field in header.split(':')[1].split(';')]
+                print(' #\tName\tCreator Address\t\tCreation Date\t\t\tMembers')
                 print(available_groups)
+                if next_after != '-1':
+                    print('{} groups in total, to see more of them type `/show-groups {}`'.format(count, next_after))
                 print("To chat with anyone of them, enter command `change-chat`")
 
+            elif content.startswith("/leave-group_result") and 'leave_group=' not in content:
+                results = batch_results(content)
+                self.show_batch(results, {'1': "You left", '0': "You were not a member of",
+                                          '-1': "No such groups:"})
+
             elif content.startswith("/leave-group_result"):
                 _, new_left_group = content.split('=')
                 if new_left_group == '-1':
@@ -152,58 +214,116 @@ class Receive(threading.Thread):
                     print("You Successfully left the group {}".format(new_left_group))
                     print("You can always come back by using command `/join-group {}`".format(new_left_group))
 
+            elif content.startswith("/add-members_result"):
+                results = batch_results(content)
+                group = results.pop('group')
+                if group == '-1':
+                    print("No such group, or you are not a member of it!")
+                else:
+                    self.show_batch(results, {'1': "Added to {}:".format(group),
+                                              '0': "Already members of {}:".format(group), '-1': "No such users:"})
+
+            elif content.startswith("/history_result"):
+                header, _, messages = content.partition('\n')
+                if header.endswith('chat=-1'):
+                    print("No such chat, or you are not a member of this group!")
+                else:
+                    chat, before = [field.split('=')[1] for field in header.split(':')[1].split(';')]
+                    print(messages if messages else "No messages found!")
+                    if before != '-1':
+                        print("To see older messages, type `/history {} {}`".format(chat, before))
+
+            elif content.startswith("/compression_result"):
+                if not self.connection.compressing:
+                    print("The server doesn't compress messages")
+
+            elif content.startswith("/subscribe-presence_result"):
+                _, online = content.split('=')
+                print("You will be notified when users join or leave. {} users are online,"
+                      " type `/online-users` to see them".format(online))
+
+            elif content.startswith("/unsubscribe-presence_result"):
+                print("You will not be notified when users join or leave anymore")
+
+            elif content.startswith("/presence_delta"):
+                for change in content.split('\n')[1:]:
+                    if change.startswith('+'):
+                        print("{} is online".format(change[1:]))
+                    elif change.startswith('-'):
+                        print("{} went offline".format(change[1:]))
+
+            elif content.startswith("/rate_limited"):
+                fields = dict(field.split('=') for field in content.split(':')[1].split(';'))
+                print("Slow down! The server ignores your {} for {} seconds".format(
+                    'messages to everyone' if fields['class'] == 'broadcast' else fields['class'] + 's',
+                    fields['retry']))
+
+            elif content.startswith("/overloaded"):
+                print("The server is overloaded and didn't send your message, try again in a moment")
+
+            elif content.startswith("/server_busy"):
+                print("The server is busy, try again later")
+
+            elif content.startswith("/server_closing"):
+                if content.endswith('restart=1'):
+                    print("The server is restarting, you will be reconnected in a moment")
+                else:
+                    print("The server is shutting down")
+
             elif content.startswith("/command_invalid"):
                 print("{} to {}: {}".format(sender, recipient, content))
 
         else:  # An Actual message from a user
             print('{} to {}: {}'.format(sender, recipient, content))
 
-        print('{}: '.format(self.name), end='', flush=True)
+        self.prompt()
 
-
-class Client:
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.save_dir = ""
-
-    def start(self):
+    @staticmethod
+    def show_batch(results, descriptions):
         """
-        Establishes the client-server_media connection. Generates a random username,
-        creates and starts the Send and Receive threads, and notifies other connected clients.
-        Returns:
-        A Receive object representing the receiving thread.
+        Prints the names a command on several groups or users had each outcome for.
         """
+        for result, description in descriptions.items():
+            names = [name for name, value in results.items() if value == result]
+            if names:
+                print('{} {}'.format(description, ', '.join(names)))
 
-        print('Trying to connect to {}:{}...'.format(self.host, self.port))
-        self.sock.connect((self.host, self.port))
-        print('Successfully connected to {}:{}'.format(self.host, self.port))
-
-        print('Welcome! Getting ready to send and receive messages...')
 
-        # Create a directory to store client's received files
-        pwd = os.getcwd()
-        self.save_dir = os.path.join(pwd, 'clients_media/' + str(self.sock.getsockname()))
-        if not os.path.exists(self.save_dir):
-            os.makedirs(self.save_dir)
+def batch_results(content):
+    """
+    :return: name -> result, of the NAME=RESULT fields of the reply to a command on several groups or users
+    """
+    return dict(field.split('=', 1) for field in content.split(':', 1)[1].split(';'))
 
-        # Create send and receive threads
-        send = Send(self.sock)
-        receive = Receive(send, self.sock, self.save_dir)
 
-        # Start send and receive threads
-        send.start()
-        receive.start()
-
-        print("\rAll set! Leave the chatroom anytime by typing '/quit'\n")
+def read_lines(loop, lines):
+    """
+    Passes the lines typed to the event loop, and None at the end of the input.
+    """
+    while True:
+        try:
+            line = input()
+        except EOFError:
+            line = None
+        loop.call_soon_threadsafe(lines.put_nowait, line)
+        if line is None:
+            return
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Chatroom Server')
     parser.add_argument('host', help='Interface the server listens at')
     parser.add_argument('-p', metavar='PORT', type=int, default=1060, help='TCP port (default 1060)')
+    parser.add_argument('-username', metavar='NAME', type=str, default=None,
+                        help='Username of an expired session to claim back, without its groups and messages')
+    parser.add_argument('-token', metavar='TOKEN', type=str, default=None,
+                        help='Token of a previous session to resume, with its username, groups and messages')
+    parser.add_argument('-tls', action='store_true', help='Encrypt the connection with TLS')
+    parser.add_argument('-cafile', metavar='CAFILE', type=str, default=None,
+                        help='CA certificates to verify the server with, e.g. its self-signed certificate')
+    parser.add_argument('-compress', action='store_true', help='Compress the large messages and files')
     args = parser.parse_args()
 
-    client = Client(args.host, args.p)
+    client = Client(args.host, args.p, args.username, args.tls or args.cafile is not None, args.cafile, args.compress,
+                    args.token)
     client.start()
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+from multiprocessing.connection import wait
+
+from .bus import MessageBus, BusHub
+from .log import logger, setup_logging, stop_logging
+from .server import server_class, reset_online_users, handle_signals
+from .storage import Storage
+
+
+def run_worker(shard, shards, bus_address, authkey, mode, host, port, db, options, log_options):
+    """
+    Entry point of a worker process: serves the clients the kernel hands to this shard.
+    """
+    # Each shard rotates a log file of its own
+    setup_logging(**dict(log_options, path='{}.{}'.format(log_options['path'], shard)))
+    server = server_class(mode)(host, port, db, shard=shard, shards=shards, **options)
+    server.bus = MessageBus(bus_address, shard, authkey)
+    server.bus.wait_ready()
+    server.start()
+    # The supervisor stops the workers with SIGTERM, which drains them
+    handle_signals(server)
+    server.join()
+
+
+def serve_cluster(host, port, db, mode, workers, options, log_options):
+    """
+    Runs the server as `workers` processes listening on the same port with SO_REUSEPORT.
+    Each process owns the connections it accepts. Messages, and the changes of the routing index
+    every process keeps a copy of, are relayed between them by a BusHub over a Unix socket.
+    Presence is shared through the database, which every process opens in WAL mode.
+    """
+    setup_logging(**log_options)
+    # Migrate the schema and reset the presence once, before the workers open the database
+    storage = Storage(db)
+    reset_online_users(storage)
+    storage.close()
+
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    bus_address = os.path.join(bus_dir, 'bus.sock')
+    authkey = os.urandom(16)
+    hub = BusHub(bus_address, workers, authkey)
+
+    # Workers are spawned, not forked, so they don't inherit the threads of this process
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, name='shard-{}'.format(shard),
+                                 args=(shard, workers, bus_address, authkey, mode, host, port, db, options,
+                                       log_options))
+                 for shard in range(workers)]
+    for process in processes:
+        process.start()
+    logger.info('Started %s workers', workers)
+
+    threading.Thread(target=exit_cluster, args=(processes,), daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_workers(processes))
+    hub.serve()
+
+    # A shard that dies takes its clients with it, and the others can't route to them anymore
+    wait([process.sentinel for process in processes])
+    for process in processes:
+        if not process.is_alive() and process.exitcode != 0:
+            logger.error('Worker %s exited with code %s, shutting down', process.name, process.exitcode)
+    stop_workers(processes)
+    # The bus relays the messages of the workers until they are all drained
+    for process in processes:
+        process.join()
+    hub.close()
+    shutil.rmtree(bus_dir, ignore_errors=True)
+    stop_logging()
+
+
+def stop_workers(processes):
+    """
+    Drains the workers still running, with SIGTERM.
+    """
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+
+def exit_cluster(processes):
+    while True:
+        ipt = input('')
+        if ipt == 'q':
+            logger.info('shutting down the workers')
+            stop_workers(processes)
@@ -0,0 +1,77 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+PAGE_SIZE = 50  # Default number of entries of a page of /online-users or /show-groups
+MAX_PAGE_SIZE = 500
+CACHE_SIZE = 256  # Rendered pages kept until the directory changes
+
+
+class Directory:
+    """
+    Sorted names of the online users, or of the groups, kept up to date by the RoutingIndex
+    as users connect, leave and rename and as groups are created and joined.
+    Pages are rendered once and served from a cache until the directory changes.
+    """
+
+    def __init__(self, describe=str):
+        """
+        :param describe: function rendering the line of a name in a page
+        """
+        self.describe = describe
+        self.names = []
+        self.lock = threading.Lock()
+        self.pages = {}  # (after, limit) -> (text, next, count)
+
+    def add(self, name):
+        """
+        :return: True if the name was not in the directory yet
+        """
+        with self.lock:
+            i = bisect_left(self.names, name)
+            if i < len(self.names) and self.names[i] == name:
+                return False
+            self.names.insert(i, name)
+            self.pages.clear()
+            return True
+
+    def remove(self, name):
+        """
+        :return: True if the name was in the directory
+        """
+        with self.lock:
+            i = bisect_left(self.names, name)
+            if i == len(self.names) or self.names[i] != name:
+                return False
+            del self.names[i]
+            self.pages.clear()
+            return True
+
+    def invalidate(self):
+        """
+        Drops the rendered pages, when the description of a name has changed.
+        """
+        with self.lock:
+            self.pages.clear()
+
+    def page(self, after=None, limit=PAGE_SIZE):
+        """
+        :param after: the name the page starts after, None for the first page
+        :return: the rendered lines of the page, the name to pass as `after` to get the next page
+                 (None if this is the last one), and the number of names in the directory
+        """
+        key = (after, limit)
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                start = 0 if after is None else bisect_right(self.names, after)
+                names = self.names[start:start + limit]
+                more = start + limit < len(self.names)
+                text = ''.join(self.describe(name) + '\n' for name in names)
+                page = (text, names[-1] if more else None, len(self.names))
+                if len(self.pages) >= CACHE_SIZE:
+                    self.pages.clear()
+                self.pages[key] = page
+            return page
+
+    def __len__(self):
+        return len(self.names)
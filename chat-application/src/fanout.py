@@ -0,0 +1,118 @@
+import asyncio
+import mmap
+import threading
+
+from .utils import HEADER, FILE_DATA, FILE_CHUNK_SIZE, pack_message, unpack_message
+
+
+class FileFanout:
+    """
+    Delivers one file stored in server_media to many connections.
+    The file is mapped into memory once and every recipient sends slices of the same mapping
+    at its own pace, so the file is never re-read per member and a slow member only delays itself.
+    Threaded recipients on unencrypted, uncompressed connections have the kernel copy the slices
+    from the open file to their socket with sendfile() instead.
+    In cut-through mode the file is still being received: `available` is advanced as the uploaded
+    chunks are written, and recipients wait for it when they have caught up with the upload.
+    """
+
+    def __init__(self, path, filesize, message, connections, available=None):
+        self.path = path
+        self.filesize = filesize
+        self.message = message
+        self.connections = list(connections)
+        self.available = filesize if available is None else available
+        self.aborted = False
+
+        self.f = open(path, 'rb')
+        # A zero-length file can not be mapped, and has no content to send anyway
+        self.map = mmap.mmap(self.f.fileno(), filesize, access=mmap.ACCESS_READ) if filesize else None
+
+        self.cond = threading.Condition()
+        self.changed = None  # asyncio.Event, waited on by AsyncServerSocket recipients
+        self.pending = len(self.connections)
+
+    def start(self):
+        if not self.connections:
+            self.close()
+        for connection in self.connections:
+            connection.deliver_file(self)
+
+    @property
+    def finished(self):
+        return self.aborted or self.available >= self.filesize
+
+    def advance(self, n):
+        """
+        Announces that n more bytes of the file have been written to disk.
+        """
+        with self.cond:
+            self.available += n
+            self.cond.notify_all()
+        self.wake()
+
+    def abort(self):
+        """
+        The upload was interrupted, recipients stop after sending what is available.
+        """
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+        self.wake()
+
+    def wake(self):
+        if self.changed is not None:
+            self.changed.set()
+            self.changed = None
+
+    def wait(self, offset):
+        """
+        Blocks until there is data after offset to send, or the file is finished.
+        :return: the number of bytes available
+        """
+        with self.cond:
+            while self.available <= offset and not self.finished:
+                self.cond.wait()
+            return self.available
+
+    async def wait_async(self, offset):
+        while self.available <= offset and not self.finished:
+            if self.changed is None:
+                self.changed = asyncio.Event()
+            await self.changed.wait()
+        return self.available
+
+    def chunks(self, offset, available):
+        """
+        Yields (offset, count) of the FILE_DATA frames covering the available data after offset.
+        """
+        while offset < available:
+            count = min(FILE_CHUNK_SIZE, available - offset)
+            yield offset, count
+            offset += count
+
+    def abort_message(self):
+        """
+        :return: the `/send-file_aborted <filename>` message telling a recipient to drop the part of the file
+         it has been sent, when the upload was interrupted
+        """
+        sender, recipient, content = unpack_message(self.message)
+        return pack_message(sender, recipient, '/send-file_aborted ' + content.split()[1])
+
+    def frame_header(self, count):
+        return HEADER.pack(count, FILE_DATA, 0, 0)
+
+    def release(self):
+        """
+        Called by each recipient once it is done; the mapping is closed after the last one.
+        """
+        with self.cond:
+            self.pending -= 1
+            if self.pending > 0:
+                return
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.f.close()
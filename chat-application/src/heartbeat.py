@@ -0,0 +1,64 @@
+import socket
+import time
+
+from .log import logger
+from .metrics import metrics
+from .utils import pack_message
+
+HEARTBEAT_INTERVAL = 30  # Seconds a client may stay silent before it is pinged
+IDLE_TIMEOUT = 90  # Seconds of silence, pings unanswered, after which a client is considered gone
+# TCP keepalive probes, which also detect peers that vanished while the connection was idle
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT, timeout=IDLE_TIMEOUT):
+    """
+    Enables TCP keepalive on the socket, with the given probe timing where the platform allows it,
+    and gives up on data the peer doesn't acknowledge within `timeout` seconds.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count),
+                          ('TCP_USER_TIMEOUT', int(timeout * 1000))):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class Reaper:
+    """
+    Finds the connections whose client has vanished without closing them, e.g. behind a NAT or after a crash.
+    Every connection records when it last received a frame. Clients that have been silent for `interval`
+    seconds are sent '/ping', which they answer with '/pong', and those silent for `timeout` seconds are
+    unregistered all at once, and their sockets aborted so their threads, or protocols, clean up.
+    The sweep runs every `interval` seconds with the server's `schedule`, so it runs on the event loop in async mode.
+    """
+
+    def __init__(self, server, interval=HEARTBEAT_INTERVAL, timeout=IDLE_TIMEOUT):
+        self.server = server
+        self.interval = interval
+        self.timeout = timeout
+
+    def start(self):
+        self.server.schedule(self.interval, self.sweep)
+
+    def sweep(self):
+        try:
+            now = time.monotonic()
+            dead = []
+            for connection in list(self.server.connections):
+                silent = now - connection.last_seen
+                if silent >= self.timeout:
+                    dead.append(connection)
+                elif silent >= self.interval:
+                    connection.send(pack_message('Server', 'heartbeat', '/ping'))
+            if dead:
+                logger.info('Reaping %s connections silent for %s seconds', len(dead), self.timeout)
+                metrics.inc('chat_reaped_connections_total', len(dead))
+                self.server.unregister_all(dead)
+                for connection in dead:
+                    connection.abort()
+        except Exception:
+            logger.exception('Sweeping the connections failed')
+        finally:
+            self.server.schedule(self.interval, self.sweep)
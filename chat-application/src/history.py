@@ -0,0 +1,63 @@
+from datetime import datetime
+
+PAGE_SIZE = 20  # Messages returned by /history when no limit is given
+MAX_PAGE_SIZE = 100
+
+
+def chat_key(kind, *names):
+    """
+    :param kind: 'broadcast', 'group' or 'user'
+    :param names: the group name, or the user ids of the two sides of a direct chat
+    :return: the key all messages of the chat are stored under
+    """
+    if kind == 'broadcast':
+        return 'broadcast'
+    elif kind == 'group':
+        return 'group:' + names[0]
+    # Both sides of a direct chat share the same key, which outlives their usernames: a user renamed keeps
+    # its history, and whoever takes the name of a user who is gone doesn't get it.
+    # Chats were keyed by usernames under 'user:', those keys are left behind as they can't be told apart.
+    return 'dm:{}|{}'.format(*sorted(names))
+
+
+class MessageHistory:
+    """
+    Append-only log of the relayed messages, indexed by chat and id.
+    Messages are appended through the storage writer, so recording one never waits for a commit.
+    Pages are read with a keyset on the id (older than a given id), which costs the same
+    on the first page and on the millionth one, and only the rows of the page are loaded.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def append(self, chat, sender, recipient, content):
+        return self.storage.execute(''' INSERT INTO messages(chat, sender, recipient, content, creation_date)
+                                        VALUES(?,?,?,?,?) ''',
+                                    (chat, sender, recipient, content, str(datetime.now())))
+
+    def page(self, chat, before=None, limit=PAGE_SIZE):
+        """
+        :param before: only return messages older than this id, the newest ones if None
+        :return: a list of (id, sender, recipient, content, creation_date), oldest first,
+                 and whether there are older messages
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        # One more row than asked tells whether this is the first page of the chat
+        if before is None:
+            cursor = self.storage.query("""SELECT id, sender, recipient, content, creation_date
+                                           FROM messages
+                                           WHERE chat=?
+                                           ORDER BY id DESC
+                                           LIMIT ?""", (chat, limit + 1))
+        else:
+            cursor = self.storage.query("""SELECT id, sender, recipient, content, creation_date
+                                           FROM messages
+                                           WHERE chat=? AND id<?
+                                           ORDER BY id DESC
+                                           LIMIT ?""", (chat, before, limit + 1))
+        rows = cursor.fetchall()
+        older = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, older
@@ -0,0 +1,84 @@
+import itertools
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FILE = 'chat_server.log'
+MAX_BYTES = 10 * 1024 * 1024  # Size of a log file before it is rotated
+BACKUP_COUNT = 5  # Number of rotated log files kept
+QUEUE_SIZE = 10000  # Records waiting to be written, beyond which new ones are dropped
+SAMPLE_RATE = 100  # One per-message event in SAMPLE_RATE is logged
+FORMAT = '%(asctime)s %(processName)s %(levelname)s %(name)s: %(message)s'
+
+# Server events: connections, errors, startup and shutdown
+logger = logging.getLogger('chat')
+# Per-message events, logged at DEBUG level and sampled
+message_logger = logging.getLogger('chat.messages')
+
+listener = None
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets one record in `rate` through.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        return next(self.counter) % self.rate == 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands the records to the listener thread, and drops them when it can't keep up
+    instead of blocking the thread that logs, or growing the queue without bound.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(path=LOG_FILE, level='INFO', sample_rate=SAMPLE_RATE, console=True):
+    """
+    Logs to rotating files from a background thread, so logging never blocks the relay of messages.
+    Events of INFO level and above are also written to the console.
+    :param sample_rate: log one per-message event in sample_rate
+    """
+    global listener
+
+    handlers = [RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding='utf-8')]
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(max(logging.INFO, logging.getLevelName(level)))
+        handlers.append(console_handler)
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(FORMAT))
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    message_logger.addFilter(SampleFilter(sample_rate))
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+
+def stop_logging():
+    """
+    Writes the records still queued. Called before the process exits with os._exit.
+    """
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,95 @@
+import os
+import time
+
+MEDIA_MAX_SIZE = 1024 ** 3  # Bytes of stored files, beyond which the least recently sent ones are evicted
+MEDIA_TTL = 30 * 24 * 3600  # Seconds a sent file is kept
+BLOB_DIR = 'blobs'
+
+
+class MediaStore:
+    """
+    Content-addressed store of the files sent through the server, in server_media/blobs.
+    A file is stored once, named after the SHA-256 of its content, however many times and under whichever
+    names it is sent. Every sending is a row of media_files referencing the blob, which media_blobs counts.
+    Sendings are forgotten after `ttl` seconds and blobs once nothing references them anymore.
+    Beyond `max_size` bytes of blobs, the least recently sent ones are evicted.
+    Blobs are moved into the store and deleted by the storage writer, within the transaction updating
+    their metadata, so a blob can't be evicted between being stored and referenced, even by another shard.
+    """
+
+    def __init__(self, storage, root, max_size=MEDIA_MAX_SIZE, ttl=MEDIA_TTL):
+        self.storage = storage
+        self.root = root
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def path(self, digest):
+        return os.path.join(self.root, BLOB_DIR, digest[:2], digest)
+
+    def add(self, digest, size, filename, sender, recipient, source):
+        """
+        Records the sending of a file.
+        :param digest: the SHA-256 of the received file, computed by the server
+        :param source: the received file, which is moved into the store, or deleted if its content is already stored
+        :return: a Future of the path of the blob, done once the file is stored
+        """
+        path = self.path(digest)
+        now = time.time()
+
+        def store(cur):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(source)
+            else:
+                os.replace(source, path)
+
+            cur.execute(''' INSERT INTO media_blobs(hash, size, refcount, last_used)
+                            VALUES(?,?,1,?)
+                            ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1, last_used = excluded.last_used''',
+                        (digest, size, now))
+            cur.execute(''' INSERT INTO media_files(hash, filename, sender, recipient, created)
+                            VALUES(?,?,?,?,?) ''', (digest, filename, sender, recipient, now))
+            return path
+
+        return self.storage.submit(store)
+
+    def evict(self, now=None):
+        """
+        Forgets the sendings older than the ttl, and deletes the blobs which are not referenced anymore,
+        and the least recently sent ones while the store is larger than max_size.
+        :return: the number of deleted blobs
+        """
+        deadline = (now or time.time()) - self.ttl
+
+        def collect(cur):
+            expired = cur.execute(''' SELECT hash, COUNT(*)
+                                      FROM media_files
+                                      WHERE created < ?
+                                      GROUP BY hash''', (deadline,)).fetchall()
+            cur.execute("DELETE FROM media_files WHERE created < ?", (deadline,))
+            cur.executemany("UPDATE media_blobs SET refcount = refcount - ? WHERE hash = ?",
+                            [(count, digest) for digest, count in expired])
+
+            doomed = [digest for digest, in cur.execute("SELECT hash FROM media_blobs WHERE refcount <= 0")]
+            total = cur.execute("SELECT COALESCE(SUM(size), 0) FROM media_blobs WHERE refcount > 0").fetchone()[0]
+            if total > self.max_size:
+                for digest, size in cur.execute(''' SELECT hash, size
+                                                    FROM media_blobs
+                                                    WHERE refcount > 0
+                                                    ORDER BY last_used''').fetchall():
+                    if total <= self.max_size:
+                        break
+                    doomed.append(digest)
+                    total -= size
+
+            cur.executemany("DELETE FROM media_files WHERE hash = ?", [(digest,) for digest in doomed])
+            cur.executemany("DELETE FROM media_blobs WHERE hash = ?", [(digest,) for digest in doomed])
+            for digest in doomed:
+                # Recipients still being sent the file keep reading it until they are done
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+            return len(doomed)
+
+        return self.storage.transaction(collect)
@@ -0,0 +1,186 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts the observations above every bound
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges of the server, exposed in the Prometheus text format.
+    Recording can be turned off and on while the server runs, recording functions then return immediately.
+    Gauges are functions evaluated when the metrics are scraped, so they cost nothing in between.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.help = {}  # name -> (type, help)
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> function returning a value, or a dict of labels -> value
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def time(self, name, **labels):
+        """
+        :return: a context manager observing the time spent in its block
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self.timer(name, labels)
+
+    @contextmanager
+    def timer(self, name, labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    def gauge(self, name, text, function):
+        self.describe(name, 'gauge', text)
+        self.gauges[name] = function
+
+    def exposition(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(((key, list(histogram.counts), histogram.sum, histogram.count)
+                                 for key, histogram in self.histograms.items()), key=lambda item: item[0])
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, self.help.get(name, (kind, name))[1]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+        for (name, labels), counts, total, count in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+
+        for name, function in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            value = function()
+            if isinstance(value, dict):
+                for labels, labelled_value in sorted(value.items()):
+                    lines.append('{}{} {}'.format(name, format_labels(labels), labelled_value))
+            else:
+                lines.append('{} {}'.format(name, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+
+# The registry of the process, shared by the server, its connections and its storage
+metrics = Metrics()
+metrics.describe('chat_frames_total', 'counter', 'Frames received from clients, by type')
+metrics.describe('chat_bytes_received_total', 'counter', 'Bytes received from clients')
+metrics.describe('chat_bytes_sent_total', 'counter', 'Bytes sent to clients')
+metrics.describe('chat_messages_total', 'counter', 'Chat messages relayed, by kind')
+metrics.describe('chat_command_seconds', 'histogram', 'Time spent executing the commands of clients')
+metrics.describe('chat_relay_seconds', 'histogram', 'Time spent relaying a message to its recipients')
+metrics.describe('chat_sql_seconds', 'histogram', 'Time spent in database queries and write batches')
+metrics.describe('chat_sql_writes_total', 'counter', 'Writes committed by the storage writer')
+metrics.describe('chat_rate_limited_total', 'counter', 'Frames refused because a client exceeded its rate, by class')
+metrics.describe('chat_throttled_seconds_total', 'counter', 'Time spent not reading clients over their byte rate')
+metrics.describe('chat_shed_messages_total', 'counter', 'Messages refused while the database writer was overloaded')
+metrics.describe('chat_rejected_connections_total', 'counter', 'Connections turned away on accept, by reason')
+metrics.describe('chat_reaped_connections_total', 'counter', 'Connections dropped after their client went silent')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics returns the metrics, POST /metrics/enable and /metrics/disable turn recording on and off.
+    """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        self.reply(200, metrics.exposition(), 'text/plain; version=0.0.4')
+
+    def do_POST(self):
+        if self.path == '/metrics/enable':
+            metrics.enabled = True
+        elif self.path == '/metrics/disable':
+            metrics.enabled = False
+        else:
+            self.send_error(404)
+            return
+        self.reply(200, 'enabled\n' if metrics.enabled else 'disabled\n', 'text/plain')
+
+    def reply(self, status, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a line of output each
+
+
+def serve_metrics(host, port):
+    """
+    Serves the metrics over HTTP from a thread of its own.
+    :return: the HTTP server
+    """
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name='metrics', daemon=True).start()
+    return http_server
@@ -0,0 +1,70 @@
+import time
+
+OFFLINE_QUEUE_SIZE = 1000  # Messages kept for an offline user, the oldest ones are dropped first
+OFFLINE_TTL = 7 * 24 * 3600  # Seconds an offline user keeps its identity and queued messages
+FLUSH_BATCH = 64  # Queued messages sent together to a reconnected user
+
+
+class OfflineQueue:
+    """
+    Durable store-and-forward queue of the messages sent to offline users, kept in the offline_messages table.
+    Messages are queued for the id of the user, which only resuming its session gets back.
+    Messages are stored as the frames that would have been sent, and written through the storage writer,
+    so a group message to many offline members costs one batched insert and doesn't wait for a commit.
+    """
+
+    def __init__(self, storage, max_size=OFFLINE_QUEUE_SIZE, ttl=OFFLINE_TTL):
+        self.storage = storage
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def enqueue(self, user_ids, message):
+        """
+        Queues the message frame for each of the given users.
+        :return: a Future of the write
+        """
+        expires = time.time() + self.ttl
+
+        def insert(cur):
+            cur.executemany(''' INSERT INTO offline_messages(user_id, message, expires)
+                                VALUES(?,?,?) ''', [(user_id, message, expires) for user_id in user_ids])
+            for user_id in user_ids:
+                # Keep only the newest max_size messages of the user
+                cur.execute(''' DELETE FROM offline_messages
+                                WHERE user_id = ? AND id <= (SELECT id
+                                                             FROM offline_messages
+                                                             WHERE user_id = ?
+                                                             ORDER BY id DESC
+                                                             LIMIT 1 OFFSET ?)''',
+                            (user_id, user_id, self.max_size))
+
+        return self.storage.submit(insert)
+
+    def take(self, user_id):
+        """
+        Removes the queued messages of the user. Runs after every message queued before the call has been written.
+        :return: a Future of the message frames which have not expired, oldest first
+        """
+        def pop(cur):
+            messages = [message for message, in cur.execute(''' SELECT message
+                                                                FROM offline_messages
+                                                                WHERE user_id = ? AND expires > ?
+                                                                ORDER BY id''', (user_id, time.time()))]
+            cur.execute("DELETE FROM offline_messages WHERE user_id = ?", (user_id,))
+            return messages
+
+        return self.storage.submit(pop)
+
+    def batches(self, messages):
+        """
+        Yields the messages joined in batches of FLUSH_BATCH frames, each sent with a single write.
+        """
+        for i in range(0, len(messages), FLUSH_BATCH):
+            yield b''.join(messages[i:i + FLUSH_BATCH])
+
+    def expire(self, now=None):
+        """
+        Deletes the messages which have been queued for longer than the ttl.
+        """
+        return self.storage.execute("DELETE FROM offline_messages WHERE expires <= ?",
+                                    (time.time() if now is None else now,))
@@ -0,0 +1,60 @@
+import threading
+
+from .utils import pack_message
+
+PRESENCE_WINDOW = 0.25  # Seconds over which changes of presence are coalesced into one delta
+
+
+class PresenceFeed:
+    """
+    Pushes the changes of presence to the subscribed connections as delta frames:
+    '/presence_delta' followed by a line per user, '+username' when it went online and '-username' when it left.
+    A rename is the old name leaving and the new one joining.
+    Changes are coalesced over `window` seconds. A user going offline and back online within the window
+    is not reported, and all the changes of the window go out as a single frame, shared by every subscriber.
+    """
+
+    def __init__(self, schedule, window=PRESENCE_WINDOW):
+        """
+        :param schedule: function calling a function after a delay, from the thread that may send to connections
+        """
+        self.schedule = schedule
+        self.window = window
+        # Replaced instead of being modified, so it can be iterated while connections subscribe
+        self.subscribers = frozenset()
+        self.pending = {}  # username -> True if it went online during the window, False if it went offline
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+    def subscribe(self, connection):
+        with self.lock:
+            self.subscribers = self.subscribers | {connection}
+
+    def unsubscribe(self, connection):
+        with self.lock:
+            self.subscribers = self.subscribers - {connection}
+
+    def changed(self, username, online):
+        if not self.subscribers:
+            return
+        with self.lock:
+            if self.pending.get(username, online) != online:
+                # Back to where it was before the window
+                del self.pending[username]
+            else:
+                self.pending[username] = online
+            if not self.scheduled:
+                self.scheduled = True
+                self.schedule(self.window, self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        if not pending:
+            return
+        content = '/presence_delta\n' + ''.join('{}{}\n'.format('+' if online else '-', username)
+                                                for username, online in pending.items())
+        message = pack_message('Server', 'presence', content)
+        for connection in self.subscribers:
+            connection.send(message)
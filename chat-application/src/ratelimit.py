@@ -0,0 +1,92 @@
+import time
+
+# Rate, per second, and burst of each class of frames a connection may send
+RATE_LIMITS = {
+    'message': (20, 40),  # Messages to a user or a group
+    'broadcast': (2, 10),  # Messages to everyone, which cost a frame per connected client
+    'command': (10, 30),
+    'upload': (1, 5),  # `/send-file` and `/upload`, which start a file transfer
+    'bytes': (16 * 1024 * 1024, 32 * 1024 * 1024),  # Everything received, files included
+}
+MAX_CONNECTIONS = 10000  # Connections of a server, or of each shard, beyond which new ones are turned away
+ACCEPT_RATE = 500  # New connections accepted per second, the others wait in the listen backlog
+SHED_WRITE_BACKLOG = 10000  # Queued database writes beyond which chat messages are refused
+
+
+def frame_class(recipient, content):
+    """
+    :return: the class of the RATE_LIMITS a message or command counts against, None if it is not limited
+    """
+    if content.startswith('/'):
+        if content == '/ping' or content == '/pong':
+            return None
+        if content.startswith('/send-file') or content.startswith('/upload'):
+            return 'upload'
+        return 'command'
+    return 'broadcast' if recipient == 'broadcast' else 'message'
+
+
+def parse_rate_limit(text):
+    """
+    Parses a `-rate-limit` argument, CLASS=RATE/BURST or CLASS=RATE, where BURST defaults to twice RATE.
+    :return: (class, (rate, burst)), or (class, None) for a RATE of 0, which lifts the limit of the class
+    """
+    name, _, limit = text.partition('=')
+    rate, _, burst = limit.partition('/')
+    if name not in RATE_LIMITS:
+        raise ValueError('Unknown class {}, expected one of {}'.format(name, ', '.join(RATE_LIMITS)))
+    if float(rate) <= 0:
+        return name, None
+    return name, (float(rate), float(burst) if burst else 2 * float(rate))
+
+
+class TokenBucket:
+    """
+    Allows `rate` units per second on average, and bursts of up to `burst` units.
+    Not thread safe, each bucket is used by the thread or the event loop reading its connection.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count=1):
+        """
+        :return: True if there were enough tokens, which are taken, False if the units are over the limit
+        """
+        self.refill()
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def delay(self, count=1):
+        """
+        Takes the tokens even if there are not enough of them, for units which can't be refused but can be slowed down.
+        :return: the seconds to wait for the bucket to be back in credit
+        """
+        self.refill()
+        self.tokens -= count
+        return max(0.0, -self.tokens / self.rate)
+
+    def retry_after(self, count=1):
+        """
+        :return: the seconds until `count` tokens are available
+        """
+        self.refill()
+        return max(0.0, (count - self.tokens) / self.rate)
+
+
+def buckets(limits):
+    """
+    :return: a TokenBucket per limited class, for a new connection
+    """
+    return {name: TokenBucket(*limit) for name, limit in limits.items() if limit is not None}
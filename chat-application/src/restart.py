@@ -0,0 +1,69 @@
+import os
+import socket
+import subprocess
+import sys
+
+from .log import logger
+
+DRAIN_TIMEOUT = 30  # Seconds the file transfers in progress have to finish when the server stops
+DRAIN_SPREAD = 10  # Seconds over which the idle clients are disconnected, so they don't all reconnect at once
+READY_TIMEOUT = 60  # Seconds a new server has to start on a hot restart, before the restart is given up
+# Environment of a server started by a hot restart: the listening socket it takes over,
+# and its end of the socket pair of the handoff
+LISTEN_FD = 'CHAT_LISTEN_FD'
+HANDOFF_FD = 'CHAT_HANDOFF_FD'
+
+
+def inherited_listener():
+    """
+    :return: the listening socket handed over by the previous server on a hot restart, or None
+    """
+    fd = os.environ.pop(LISTEN_FD, None)
+    return socket.socket(fileno=int(fd)) if fd is not None else None
+
+
+def spawn_successor(listener, timeout=READY_TIMEOUT):
+    """
+    Starts a new server process with the arguments of this one, which takes over the listening socket.
+    Connections keep queueing in the listen backlog meanwhile, none is refused.
+    The new server says it is ready through a socket pair once it has loaded its state, and waits for
+    this end of the pair to be closed before accepting connections, so only one process accepts at a time.
+    :return: this end of the socket pair, to close once this server has stopped accepting,
+     or None if the new server failed to start within `timeout` seconds
+    """
+    ours, theirs = socket.socketpair()
+    env = dict(os.environ, **{LISTEN_FD: str(listener.fileno()), HANDOFF_FD: str(theirs.fileno())})
+    # The server is run as a module of the package, wherever it was started from
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    process = subprocess.Popen([sys.executable, '-m', __package__ + '.server'] + sys.argv[1:], env=env,
+                               pass_fds=(listener.fileno(), theirs.fileno()))
+    theirs.close()
+    logger.info('Started the new server, process %s', process.pid)
+
+    ours.settimeout(timeout)
+    try:
+        ready = ours.recv(1) == b'1'
+    except socket.timeout:
+        ready = False
+    if not ready:
+        logger.error('The new server did not start within %s seconds, the restart is given up', timeout)
+        process.kill()
+        ours.close()
+        return None
+    return ours
+
+
+def wait_for_handoff():
+    """
+    Tells the previous server that this one, started by a hot restart, is ready,
+    and waits for it to stop accepting connections, or to exit.
+    :return: False if this server was not started by a hot restart
+    """
+    fd = os.environ.pop(HANDOFF_FD, None)
+    if fd is None:
+        return False
+    with socket.socket(fileno=int(fd)) as handoff:
+        handoff.sendall(b'1')
+        handoff.recv(1)
+    return True
@@ -0,0 +1,229 @@
+import threading
+from collections import defaultdict, namedtuple
+
+from .directory import Directory
+
+# The members of a group a message is routed to: the connections of those online on this shard,
+# and the ids of those offline, whose messages are queued
+GroupSnapshot = namedtuple('GroupSnapshot', 'connections offline')
+EMPTY_SNAPSHOT = GroupSnapshot((), ())
+
+
+class RoutingIndex:
+    """
+    In-memory view of the routing_table, groups and users_groups tables.
+    The Server writes every change through to the database and to this index,
+    so routing a message only needs dictionary lookups and never queries the database.
+    Neither do /online-users and /show-groups, which are served from the directories of the index.
+    """
+
+    def __init__(self, on_presence=None):
+        """
+        :param on_presence: called with (username, online) when a username goes online or offline
+        """
+        # Held by the Server around check-then-write operations, e.g. claiming a free name
+        self.lock = threading.RLock()
+
+        # Users are keyed by the integer id of their row of the routing_table, which they keep across connections
+        self.connections = {}  # user id -> connection
+        self.user_ids = {}  # username -> user id
+        self.usernames = {}  # user id -> username
+        self.shards = {}  # user id -> shard serving the user, for users of the other worker processes
+        self.groups = {}  # group name -> group id
+        self.group_info = {}  # group name -> (creator address, creation date)
+        # Group id -> frozenset of member ids. The sets are replaced instead of being modified,
+        # so they can be iterated by any thread while the membership is changing.
+        self.members = {}
+        self.memberships = {}  # user id -> frozenset of the ids of its groups
+        # Group id -> GroupSnapshot, built on the first message to the group and dropped when its membership,
+        # or the presence of one of its members, changes. Written under the lock, read without it.
+        self.snapshots = {}
+        # Offline users keep their id, username and groups, and receive their queued messages when they resume
+        self.offline = {}  # username -> user id
+        self.offline_usernames = {}  # user id -> username
+
+        self.online = Directory()
+        self.on_presence = on_presence
+        self.group_directory = Directory(self.describe_group)
+
+    def add_connection(self, connection):
+        with self.lock:
+            self.connections[connection.user_id] = connection
+            self.invalidate_snapshots(connection.user_id)
+
+    def remove_connection(self, connection):
+        with self.lock:
+            if self.connections.get(connection.user_id) is connection:
+                del self.connections[connection.user_id]
+                self.invalidate_snapshots(connection.user_id)
+
+    def add_user(self, user_id, username, shard=None):
+        with self.lock:
+            self.user_ids[username] = user_id
+            self.usernames[user_id] = username
+            if shard is not None:
+                self.shards[user_id] = shard
+            if self.online.add(username):
+                self.presence_changed(username, True)
+
+    def remove_user(self, user_id):
+        with self.lock:
+            self.shards.pop(user_id, None)
+            username = self.usernames.pop(user_id, None)
+            if self.user_ids.get(username) == user_id:
+                del self.user_ids[username]
+                if self.online.remove(username):
+                    self.presence_changed(username, False)
+
+    def rename_user(self, user_id, new_username):
+        with self.lock:
+            old_username = self.usernames.get(user_id)
+            if self.user_ids.get(old_username) == user_id:
+                del self.user_ids[old_username]
+                if self.online.remove(old_username):
+                    self.presence_changed(old_username, False)
+            self.add_user(user_id, new_username)
+
+    def presence_changed(self, username, online):
+        if self.on_presence is not None:
+            self.on_presence(username, online)
+
+    def add_offline_user(self, user_id, username):
+        with self.lock:
+            self.offline[username] = user_id
+            self.offline_usernames[user_id] = username
+            self.invalidate_snapshots(user_id)
+
+    def remove_offline_user(self, username):
+        """
+        Called when the offline user is back online.
+        :return: the id of the offline user, or None if there is no such offline user
+        """
+        with self.lock:
+            user_id = self.offline.pop(username, None)
+            if user_id is not None:
+                del self.offline_usernames[user_id]
+                self.invalidate_snapshots(user_id)
+            return user_id
+
+    def forget_user(self, username):
+        """
+        Removes an offline user and its memberships, when it has expired or its username is taken by someone else.
+        :return: the id of the offline user, or None if there is no such offline user
+        """
+        with self.lock:
+            user_id = self.remove_offline_user(username)
+            if user_id is not None:
+                self.remove_user_memberships(user_id)
+            return user_id
+
+    def remove_user_memberships(self, user_id):
+        with self.lock:
+            self.remove_memberships([(group_id, user_id) for group_id in self.memberships.get(user_id, ())])
+            self.memberships.pop(user_id, None)
+
+    def add_group(self, group_id, group_name, creator_address=None, creation_date=None):
+        with self.lock:
+            self.groups[group_name] = group_id
+            self.group_info[group_name] = (creator_address, creation_date)
+            self.members.setdefault(group_id, frozenset())
+            self.group_directory.add(group_name)
+
+    def add_member(self, group_id, user_id):
+        self.add_memberships([(group_id, user_id)])
+
+    def remove_member(self, group_id, user_id):
+        self.remove_memberships([(group_id, user_id)])
+
+    def add_memberships(self, memberships):
+        """
+        Adds (group id, member id) pairs, e.g. a user joining several groups or many users added to a group.
+        The member set of each group is replaced once, however many members it gains.
+        """
+        self.change_memberships(memberships, frozenset.union)
+
+    def remove_memberships(self, memberships):
+        self.change_memberships(memberships, frozenset.difference)
+
+    def change_memberships(self, memberships, operation):
+        by_group = defaultdict(set)
+        by_user = defaultdict(set)
+        for group_id, user_id in memberships:
+            by_group[group_id].add(user_id)
+            by_user[user_id].add(group_id)
+        with self.lock:
+            for group_id, user_ids in by_group.items():
+                self.members[group_id] = operation(self.members.get(group_id, frozenset()), user_ids)
+                self.snapshots.pop(group_id, None)
+            for user_id, group_ids in by_user.items():
+                self.memberships[user_id] = operation(self.memberships.get(user_id, frozenset()), group_ids)
+            # The number of members is part of the listing of the group
+            self.group_directory.invalidate()
+
+    def invalidate_snapshots(self, user_id):
+        """
+        Drops the snapshots of the groups of a user whose presence has changed.
+        """
+        for group_id in self.memberships.get(user_id, ()):
+            self.snapshots.pop(group_id, None)
+
+    def describe_group(self, group_name):
+        """
+        :return: the line of the group in /show-groups: its id, name, creator, creation date and number of members
+        """
+        group_id = self.groups[group_name]
+        creator_address, creation_date = self.group_info[group_name]
+        return '{}\t{}\t{}\t{}\t{}'.format(group_id, group_name, creator_address, creation_date,
+                                          len(self.members.get(group_id, ())))
+
+    def group_members(self, group_name):
+        """
+        :return: ids of the members of the group, or an empty set if there is no such group
+        """
+        group_id = self.groups.get(group_name)
+        return self.members.get(group_id, frozenset())
+
+    def user_shard(self, username):
+        """
+        :return: the shard serving the user if it is online on another worker process, None otherwise
+        """
+        return self.shards.get(self.user_ids.get(username))
+
+    def user_connection(self, username):
+        """
+        :return: the connection of the user if they are online, None otherwise
+        """
+        user_id = self.user_ids.get(username)
+        return self.connections.get(user_id)
+
+    def group_snapshot(self, group_name):
+        """
+        :return: the GroupSnapshot of the group, EMPTY_SNAPSHOT if there is no such group.
+         Messages to a group reuse its snapshot until it changes, instead of looking up each member.
+        """
+        group_id = self.groups.get(group_name)
+        if group_id is None:
+            return EMPTY_SNAPSHOT
+        snapshot = self.snapshots.get(group_id)
+        if snapshot is None:
+            with self.lock:
+                members = self.members.get(group_id, frozenset())
+                found = (self.connections.get(user_id) for user_id in members)
+                snapshot = GroupSnapshot(tuple(connection for connection in found if connection is not None),
+                                         tuple(user_id for user_id in members if user_id in self.offline_usernames))
+                self.snapshots[group_id] = snapshot
+        return snapshot
+
+    def group_connections(self, group_name):
+        """
+        :return: connections of the online members of the group
+        """
+        return self.group_snapshot(group_name).connections
+
+    def offline_recipients(self, destination):
+        """
+        :return: ids of the offline users a message to the given username or group name should be queued for
+        """
+        if destination in self.offline:
+            return [self.offline[destination]]
+        return self.group_snapshot(destination).offline
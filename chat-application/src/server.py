@@ -1,77 +1,547 @@
 import argparse
+import hashlib
+import itertools
 import os
+import queue
+import secrets
+import select
+import signal
 import socket
+import ssl
+import sqlite3
 import threading
+import time
+from concurrent import futures
 from datetime import datetime
-
-from .utils import db_connection, pack_message, unpack_message, generate_name, send_file, recv_file
+from time import perf_counter
+
+from .fanout import FileFanout
+from .directory import PAGE_SIZE as DIRECTORY_PAGE_SIZE, MAX_PAGE_SIZE as DIRECTORY_MAX_PAGE_SIZE
+from .heartbeat import Reaper, set_keepalive, HEARTBEAT_INTERVAL, IDLE_TIMEOUT
+from .history import MessageHistory, chat_key, PAGE_SIZE
+from .media import MediaStore, MEDIA_MAX_SIZE, MEDIA_TTL
+from .log import logger, message_logger, setup_logging, stop_logging, LOG_FILE, SAMPLE_RATE
+from .metrics import metrics, serve_metrics
+from .offline import OfflineQueue, OFFLINE_QUEUE_SIZE, OFFLINE_TTL
+from .presence import PresenceFeed
+from .ratelimit import (TokenBucket, buckets, frame_class, parse_rate_limit, RATE_LIMITS, MAX_CONNECTIONS,
+                        ACCEPT_RATE, SHED_WRITE_BACKLOG)
+from .restart import inherited_listener, spawn_successor, wait_for_handoff, DRAIN_TIMEOUT, DRAIN_SPREAD
+from .tls import server_context
+from .transfer import Upload, unpack_chunk, expire_partials, ACK_INTERVAL, PARTIAL_DIR, PARTIAL_TTL
+from .routing import RoutingIndex
+from .storage import Storage
+from .utils import (pack_message, unpack_message, UsernamePool,
+                    FrameDecoder, IncomingFile, FILE_DATA, FILE_CHUNK, frame_type, frame_body, frame_ref,
+                    compress_frame, compress_message)
+
+BUFFER_SIZE = 1024 * 64  # 64KB
+OUTBOX_SIZE = 1024  # Messages queued for a client before it is treated as a slow consumer
+EXPIRE_INTERVAL = 60  # Seconds between two purges of the expired offline users, messages and files
+ACCEPT_POLL = 0.5  # Seconds the accept loop waits for a connection before checking whether the server is stopping
+DRAIN_STEP = 0.1  # Seconds between two batches of connections closed while the server is draining
+FINISH = object()  # Queued after the last message to a client, for its writer to close the connection
+# Names of the files received with `/send-file` in server_media/.partial
+INCOMING_FILE_IDS = itertools.count()
+# Commands timed by the metrics, any other command is labelled 'invalid'
+COMMANDS = ('/send-file', '/change-chat', '/change-username', '/online-users', '/create-group',
+            '/join-group', '/show-groups', '/leave-group', '/history', '/subscribe-presence',
+            '/unsubscribe-presence', '/compression', '/upload', '/ping', '/pong', '/add-members', '/resume')
 
 
 class Server(threading.Thread):
-    def __init__(self, host, port, db):
+    def __init__(self, host, port, db, backlog=socket.SOMAXCONN, cut_through=True,
+                 outbox_size=OUTBOX_SIZE, slow_consumer='drop',
+                 offline_queue_size=OFFLINE_QUEUE_SIZE, offline_ttl=OFFLINE_TTL, shard=0, shards=1,
+                 metrics_port=None, metrics_enabled=True, certfile=None, keyfile=None, compression=True,
+                 media_max_size=MEDIA_MAX_SIZE, media_ttl=MEDIA_TTL, partial_ttl=PARTIAL_TTL,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 rate_limits=RATE_LIMITS, max_connections=MAX_CONNECTIONS, accept_rate=ACCEPT_RATE,
+                 drain_timeout=DRAIN_TIMEOUT, drain_spread=DRAIN_SPREAD):
         super().__init__()
         self.connections = []
         self.host = host
         self.port = port
+        self.backlog = backlog
+        # When the server runs as several worker processes sharing the listening port, this one is shard
+        # `shard` of `shards`, and the MessageBus carries the messages and routing changes between them
+        self.shard = shard
+        self.shards = shards
+        self.bus = None
         self.can_broadcast = True
+        # Relay uploaded files to recipients while they are being received, instead of after they are stored
+        self.cut_through = cut_through
+        # Connections are encrypted when the server has a certificate
+        self.ssl_context = server_context(certfile, keyfile) if certfile is not None else None
+        # Whether clients may ask for the frames sent to them to be compressed
+        self.compression = compression
+
+        # Each connection queues at most outbox_size messages. When the outbox of a client is full,
+        # new messages to it are either dropped or the client is disconnected, according to slow_consumer.
+        self.outbox_size = outbox_size
+        self.slow_consumer = slow_consumer
+        self.stats_lock = threading.Lock()
+        self.dropped_messages = 0
+        self.slow_disconnects = 0
+        # Every connection has a token bucket per class of rate_limits. New connections wait for the accept rate,
+        # and are turned away beyond max_connections
+        self.rate_limits = rate_limits
+        self.max_connections = max_connections
+        self.accept_bucket = TokenBucket(accept_rate, accept_rate)
+        # Clients that stay silent are pinged, and reaped if they don't answer
+        self.idle_timeout = idle_timeout
+        self.reaper = Reaper(self, heartbeat_interval, idle_timeout)
+        # When the server stops, it stops accepting connections and gives the clients drain_spread seconds
+        # to be disconnected over, and the file transfers in progress drain_timeout seconds to finish
+        self.drain_timeout = drain_timeout
+        self.drain_spread = drain_spread
+        self.listener = None
+        self.stopping = threading.Lock()
+        self.draining = threading.Event()
+        self.stopped_accepting = threading.Event()
 
         # Create a directory to store client's received files
         pwd = os.getcwd()
         self.save_dir = os.path.join(pwd, 'server_media/')
-        if not os.path.exists(self.save_dir):
-            os.makedirs(self.save_dir)
+        # Files are received in PARTIAL_DIR, and stored in the MediaStore once they are complete.
+        # Shards of the same server may create it concurrently
+        self.partial_dir = os.path.join(self.save_dir, PARTIAL_DIR)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        # Partial files of uploads given up on are deleted, they don't count towards the size of the MediaStore
+        self.partial_ttl = partial_ttl
 
         try:
-            self.conn = db_connection(db)
-            print('Connected to database successfully')
+            self.storage = Storage(db)
+            logger.info('Connected to database successfully (schema version %s)', self.storage.version)
 
         except:
-            print("Oh no! An error occured! Connection to database failed")
+            logger.exception("Oh no! An error occured! Connection to database failed")
+
+        self.history = MessageHistory(self.storage)
+        # Messages to offline users are queued until they resume their session, or it expires
+        self.offline = OfflineQueue(self.storage, offline_queue_size, offline_ttl)
+        self.media = MediaStore(self.storage, self.save_dir, media_max_size, media_ttl)
+        # Subscribed clients are pushed the changes of presence of the routing index, instead of a notice each
+        self.presence = PresenceFeed(self.schedule)
+        self.index = RoutingIndex(on_presence=self.presence.changed)
+        self.load_index()
+        self.usernames = UsernamePool(shard=shard, shards=shards)
+        self.user_ids = None
+        self.reset_user_ids()
+        self.reset_presence()
+        threading.Thread(target=self.expire_loop, name='expiry', daemon=True).start()
+
+        metrics.enabled = metrics_enabled
+        self.register_gauges()
+        if metrics_port is not None:
+            # Each shard serves the metrics of its own process
+            serve_metrics('127.0.0.1', metrics_port + shard)
+            logger.info('Serving metrics at http://127.0.0.1:%s/metrics', metrics_port + shard)
+
+    def register_gauges(self):
+        metrics.gauge('chat_connections', 'Clients connected to this server', lambda: len(self.connections))
+        metrics.gauge('chat_offline_users', 'Offline users keeping their username', lambda: len(self.index.offline))
+        metrics.gauge('chat_groups', 'Groups', lambda: len(self.index.groups))
+        metrics.gauge('chat_outbox_messages', 'Messages queued for the clients, in total and in the fullest queue',
+                      lambda: {(('queue', stat),): value for stat, value in
+                               [('total', self.outbox_stats()['queued_messages']),
+                                ('max', self.outbox_stats()['max_queue_depth'])]})
+        metrics.gauge('chat_slow_consumer_dropped_messages', 'Messages dropped because an outbox was full',
+                      lambda: self.dropped_messages)
+        metrics.gauge('chat_sql_backlog', 'Writes queued for the database writer', self.storage.backlog)
+        metrics.gauge('chat_slow_consumer_disconnects', 'Clients disconnected because their outbox was full',
+                      lambda: self.slow_disconnects)
+
+    def load_index(self):
+        """
+        Loads the groups and memberships stored in the database into the routing index.
+        Users are indexed while they are online, and while they are offline until they expire, see reset_presence.
+        """
+        for group_id, group_name, creator_address, creation_date in self.storage.query(
+                "SELECT id, name, creator_address, creation_date FROM groups"):
+            self.index.add_group(group_id, group_name, creator_address, creation_date)
+        self.index.add_memberships([(group_id, user_id) for user_id, group_id in
+                                    self.storage.query("SELECT user_id, group_id FROM users_groups")])
 
-    def run(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((self.host, self.port))
+    def reset_user_ids(self):
+        """
+        Continues the user ids after the highest one ever inserted in the routing_table, even if its row is gone,
+        so the id of a deleted user is never given to another one. The ids are allocated by the servers
+        rather than by the database, so the rows of new users are written in the background:
+        shard `shard` of `shards` allocates the ids equal to `shard` modulo `shards`.
+        """
+        row = self.storage.query_one("SELECT seq FROM sqlite_sequence WHERE name = 'routing_table'")
+        last = row[0] if row is not None else 0
+        first = last + 1 + (self.shard - last - 1) % self.shards
+        self.user_ids = itertools.count(first, self.shards)
 
-        sock.listen(1)
-        print('Listening at ', sock.getsockname())
+    def reset_presence(self):
+        """
+        Loads the offline users into the routing index and forgets the expired ones.
+        With several shards, the supervisor has already marked the users of a previous run as offline.
+        """
+        if self.shards == 1:
+            reset_online_users(self.storage)
+        for user_id, username in self.storage.query("SELECT id, username FROM routing_table WHERE status=?", (0,)):
+            self.index.add_offline_user(user_id, username)
+        self.expire_offline_users()
 
+    def expire_loop(self):
         while True:
+            time.sleep(EXPIRE_INTERVAL)
+            self.expire_offline_users()
+            self.media.evict()
+            deleted = expire_partials(self.partial_dir, self.partial_ttl)
+            if deleted:
+                logger.info('Deleted %s partial files of abandoned uploads', deleted)
+
+    def expire_offline_users(self):
+        """
+        Deletes the messages queued for longer than the offline ttl, and the users offline for longer than it,
+        with their memberships and queued messages. Their usernames are returned to the pool.
+        """
+        now = time.time()
+        self.offline.expire(now)
+        deadline = now - self.offline.ttl
+        expired = self.storage.query("""SELECT id, username
+                                        FROM routing_table
+                                        WHERE status = ? AND (last_seen IS NULL OR last_seen < ?)""",
+                                     (0, deadline)).fetchall()
+
+        def delete(cur):
+            for table in ('users_groups', 'offline_messages'):
+                cur.execute(''' DELETE FROM {}
+                                WHERE user_id IN (SELECT id
+                                                  FROM routing_table
+                                                  WHERE status = ? AND (last_seen IS NULL OR last_seen < ?))'''
+                            .format(table), (0, deadline))
+            cur.execute(''' DELETE FROM routing_table
+                            WHERE status = ? AND (last_seen IS NULL OR last_seen < ?)''', (0, deadline))
+
+        with self.index.lock:
+            for user_id, username in expired:
+                # Unless the user has resumed its session in the meantime
+                if self.index.offline.get(username) == user_id:
+                    self.index.forget_user(username)
+                    self.usernames.release(username)
+            self.storage.submit(delete)
+
+    def listen(self):
+        """
+        :return: the listening socket, the one of the previous server on a hot restart
+        """
+        sock = inherited_listener()
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.shards > 1:
+                # Every shard listens on the port, the kernel spreads the incoming connections among them
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(self.backlog)
+        self.listener = sock
+        logger.info('Listening at %s', sock.getsockname())
+        return sock
+
+    def take_over(self):
+        """
+        On a hot restart, waits for the previous server to stop accepting connections. Its clients reconnect
+        to this one as it disconnects them, so the users it has registered or marked as offline meanwhile,
+        which it has committed before letting this one accept, are loaded again.
+        """
+        if wait_for_handoff():
+            logger.info('Took over the listening socket from the previous server')
+            self.reset_user_ids()
+            self.reset_presence()
+
+    def run(self):
+        sock = self.listen()
+        self.take_over()
+        # The previous server of a hot restart may have made the shared socket non-blocking
+        sock.setblocking(True)
+        if self.bus is not None:
+            self.bus.listen(self.apply_bus_event)
+        self.reaper.start()
+
+        while not self.draining.is_set():
+            # Connections beyond the accept rate wait in the listen backlog
+            time.sleep(self.accept_bucket.retry_after())
+            if not select.select([sock], [], [], ACCEPT_POLL)[0]:
+                continue
             # Accept a new connection
             sc, sockname = sock.accept()
-            print('Accepted a new connection from {} to {}'.format(sc.getpeername(), sc.getsockname()))
-
-            username = generate_name()
-            print('Assigned Name to connection {} is {}'.format(sc.getpeername(), username))
-            self.add_user(sc.getpeername(), username)
+            if self.admission() is not None:
+                self.turn_away(sc)
+                continue
+            logger.info('Accepted a new connection from %s to %s', sc.getpeername(), sc.getsockname())
+            set_keepalive(sc, timeout=self.idle_timeout)
+            if self.ssl_context is not None:
+                # The handshake is made by the thread of the connection, not to hold up the accept loop
+                sc = self.ssl_context.wrap_socket(sc, server_side=True, do_handshake_on_connect=False)
 
             # Create a new thread
             server_socket = ServerSocket(sc, sockname, self)
-
-            message = pack_message('Server', username, "INIT_USERNAME={}".format(username))
-            server_socket.send(message)
+            self.register(server_socket)
 
             # Start the new thread
             server_socket.start()
 
-            # Add the thread to active connections
-            self.connections.append(server_socket)
+            logger.debug('Ready to receive messages from %s', sockname)
+
+        # The connections already accepted are served until they are drained
+        sock.close()
+        self.stopped_accepting.set()
+
+    def stop_accepting(self):
+        """
+        Closes the listening socket of this process, the connections left in the listen backlog are accepted
+        by the next server of a hot restart, or refused.
+        """
+        self.draining.set()
+        self.stopped_accepting.wait()
+
+    def call(self, function, *args):
+        """
+        Calls the function from the thread the connections are written from, and returns its result.
+        """
+        return function(*args)
+
+    def drain(self, handoff=None):
+        """
+        Stops the server without losing what is in flight. It stops accepting connections, then tells the clients
+        it is closing, and closes the connections once the messages queued for them are written: the idle ones
+        in batches over drain_spread seconds, so their clients don't all reconnect at once, and the ones transferring
+        a file when the transfer is over, or after drain_timeout seconds. The queued database writes are committed last.
+        :param handoff: on a hot restart, the socket pair end which lets the new server accept once it is closed
+        """
+        deadline = time.monotonic() + self.drain_timeout
+        self.stop_accepting()
+        if handoff is not None:
+            # The new server continues the user ids after those allocated by this one
+            self.storage.flush()
+            handoff.close()
+        connections = list(self.connections)
+        logger.info('Draining %s connections', len(connections))
+        notice = '/server_closing:restart={}'.format(int(handoff is not None))
+        self.call(self.broadcast_local, pack_message('Server', 'broadcast', notice))
+
+        held = self.call(self.transferring, connections)
+        idle = [connection for connection in connections if connection not in held]
+        busy = [connection for connection in connections if connection in held]
+        batches = max(1, int(min(self.drain_spread, self.drain_timeout) / DRAIN_STEP))
+        size = max(1, -(-len(idle) // batches))
+        for start in range(0, len(idle), size):
+            self.call(self.finish_all, idle[start:start + size])
+            time.sleep(DRAIN_STEP)
+        while busy and time.monotonic() < deadline:
+            held = self.call(self.transferring, busy)
+            self.call(self.finish_all, [connection for connection in busy if connection not in held])
+            busy = [connection for connection in busy if connection in held]
+            time.sleep(DRAIN_STEP)
+
+        while self.connections and time.monotonic() < deadline:
+            time.sleep(DRAIN_STEP)
+        if self.connections:
+            left = list(self.connections)
+            logger.warning('Closing %s connections still open after %s seconds', len(left), self.drain_timeout)
+            self.call(self.unregister_all, left)
+            for connection in left:
+                self.call(connection.abort)
+        self.storage.close()
+        logger.info('Drained, the database is up to date')
+
+    def transferring(self, connections):
+        """
+        :return: the connections transferring a file, and those the files being uploaded are for
+        """
+        held = {connection for connection in connections if connection.busy}
+        for connection in list(held):
+            for destination in connection.upload_recipients():
+                held.update(self.recipients_of(destination))
+        return held
+
+    @staticmethod
+    def finish_all(connections):
+        for connection in connections:
+            connection.finish()
+
+    def admission(self):
+        """
+        Decides whether a newly accepted connection is served.
+        :return: None if it is, or the reason it is turned away: 'capacity' or 'rate'
+        """
+        if len(self.connections) >= self.max_connections:
+            reason = 'capacity'
+        elif not self.accept_bucket.take():
+            reason = 'rate'
+        else:
+            return None
+        metrics.inc('chat_rejected_connections_total', reason=reason)
+        return reason
+
+    def turn_away(self, sc):
+        """
+        Tells the client of a connection that is not admitted that the server is busy, and closes it.
+        Encrypted connections are just closed, rather than holding up the accept loop with a handshake.
+        """
+        logger.warning('Turning away %s, %s connections are open', sc.getpeername(), len(self.connections))
+        if self.ssl_context is None:
+            sc.setblocking(False)
+            try:
+                sc.send(busy_message())
+            except OSError:
+                pass
+        sc.close()
+
+    def overloaded(self):
+        """
+        :return: True when the database writer is too far behind to take more chat messages
+        """
+        return self.storage.backlog() > SHED_WRITE_BACKLOG
 
-            print('Ready to receive messages from ', sc.getpeername())
+    def register(self, connection):
+        """
+        Assigns a user id and a username to a newly accepted connection, sends the username and the token
+        to resume the session with to the client, and adds the connection to the active connections.
+        Shared by the threaded and the asyncio server modes.
+        :param connection: a ServerSocket (or AsyncServerSocket) of the accepted client
+        :return: the assigned username
+        """
+        token = new_token()
+        with self.index.lock:
+            connection.user_id = next(self.user_ids)
+            username = self.usernames.allocate(taken=self.name_exists)
+            self.add_user(connection.user_id, connection.address, username, token_digest(token))
+        logger.info('Assigned Name to connection %s is %s', connection.address, username)
+
+        message = pack_message('Server', username, "INIT_USERNAME={}".format(username))
+        connection.send(message)
+        connection.send(pack_message('Server', username, '/session_token:token={}'.format(token)))
+
+        # Add the connection to active connections
+        connection.buckets = buckets(self.rate_limits)
+        connection.refusing = set()
+        connection.last_seen = time.monotonic()
+        connection.registered = True
+        self.connections.append(connection)
+        self.index.add_connection(connection)
+        return username
+
+    def unregister(self, connection):
+        """
+        Notifies other clients that the given connection has left the chatroom,
+        removes it from active connections and marks its user as offline.
+        The user keeps its username until it expires, and messages sent to it are queued meanwhile.
+        :param connection: a ServerSocket (or AsyncServerSocket) whose client has disconnected
+        """
+        self.unregister_all([connection])
 
-    def add_user(self, address, username):
+    def unregister_all(self, connections):
+        """
+        Unregisters several connections at once, with a single write marking their users as offline.
+        A connection which has already been unregistered, e.g. by the Reaper before its thread noticed
+        that its socket was aborted, is skipped.
+        """
+        with self.index.lock:
+            connections = [connection for connection in connections if connection.registered]
+            for connection in connections:
+                connection.registered = False
+        if not connections:
+            return
+
+        left = [(connection, self.get_user_username(connection.user_id)) for connection in connections]
+        for connection in connections:
+            self.presence.unsubscribe(connection)
+            self.remove_connection(connection)
+        self.make_offline([connection.user_id for connection in connections])
+        for connection, left_username in left:
+            content = '{} left the chatroom!'.format(left_username)
+            self.broadcast_notice(pack_message('Server', 'broadcast', content))
+            logger.info('%s (%s) left the chatroom', left_username, connection.address)
+        with self.index.lock:
+            for connection, left_username in left:
+                self.index.remove_user(connection.user_id)
+                self.index.add_offline_user(connection.user_id, left_username)
+        for connection, left_username in left:
+            self.publish('offline', connection.user_id, left_username)
+
+    def add_user(self, user_id, address, username, token):
         """
         Add a new user to the routing_table of server.
         As the initial username of each user is unique, this function doesn't check for a duplicate username.
-        :param address:
+        The row is written in the background, the user is routable as soon as it is in the index.
+        :param user_id: the id allocated to the user, see reset_user_ids
+        :param address: ip and port address the user is connected from
         :param username:
-        :return: If successful, row id of the newly added user. A negative value otherwise.
+        :param token: digest of the token the user resumes its session with
+        :return: a Future of the completion of the write
+        """
+        def insert(cur):
+            self.forget_offline_user(cur, username)
+            cur.execute(''' INSERT INTO routing_table(id,address,username,status,token)
+                              VALUES(?,?,?,?,?) ''', (user_id, address, username, 1, token))
+
+        self.index.add_user(user_id, username)
+        self.publish('user', user_id, username, self.shard)
+        return self.storage.submit(insert)
+
+    def publish(self, event, *args, to=None):
+        """
+        Sends an event to the other shards (or to shard `to`), which apply it with apply_bus_event.
+        Does nothing when the server runs as a single process.
         """
-        cur = self.conn.cursor()
-        cur.execute(''' INSERT INTO routing_table(address,username,status)
-                              VALUES(?,?,?) ''', (str(address), username, 1))
-        self.conn.commit()
-        return cur.lastrowid
+        if self.bus is not None:
+            self.bus.publish(event, args, to)
+
+    def apply_bus_event(self, event, args):
+        """
+        Applies an event published by another shard: a change of the routing index,
+        or a message to deliver to the connections of this shard.
+        """
+        if event == 'user':
+            user_id, username, shard = args
+            self.index.add_user(user_id, username, shard)
+        elif event == 'offline':
+            user_id, username = args
+            with self.index.lock:
+                self.index.remove_user(user_id)
+                self.index.add_offline_user(user_id, username)
+        elif event == 'resume':
+            user_id, username, shard, replaced_id, replaced_username = args
+            with self.index.lock:
+                self.index.remove_user(replaced_id)
+                self.index.remove_user_memberships(replaced_id)
+                self.index.remove_offline_user(username)
+                self.index.add_user(user_id, username, shard)
+            self.usernames.release(replaced_username)
+        elif event == 'rename':
+            user_id, old_username, new_username = args
+            with self.index.lock:
+                self.index.forget_user(new_username)
+                self.index.rename_user(user_id, new_username)
+            # Only the shard the name was allocated by returns it to its pool
+            self.usernames.release(old_username)
+        elif event == 'group':
+            self.index.add_group(*args)
+        elif event == 'member':
+            memberships, = args
+            self.index.add_memberships(memberships)
+        elif event == 'unmember':
+            memberships, = args
+            self.index.remove_memberships(memberships)
+        elif event == 'broadcast':
+            message, = args
+            self.broadcast_local(message)
+        elif event == 'notice':
+            message, = args
+            self.broadcast_local(message, exclude=self.presence.subscribers)
+        elif event == 'message':
+            message, destination = args
+            for connection in self.recipients_of(destination):
+                connection.send(message)
+        elif event == 'file':
+            message, path, filesize, destination = args
+            self.send_file_to(message, path, filesize, destination, remote=False)
 
     def broadcast(self, message, source=None):
         """
@@ -80,116 +550,238 @@ class Server(threading.Thread):
             message (str): The message to broadcast.
             source (tuple): The socket address of the source client.
         """
+        self.broadcast_local(message, source)
+        self.publish('broadcast', message)
+
+    def broadcast_local(self, message, source=None, exclude=frozenset()):
+        """
+        Sends a message to the clients connected to this shard, except the source of the message
+        and the excluded connections.
+        """
         for connection in self.connections:
             # Send to all connected clients except the source client
-            if connection.sockname != source:
+            if connection.sockname != source and connection not in exclude:
                 connection.send(message)
 
+    def broadcast_notice(self, message):
+        """
+        Broadcasts the notice of a change of presence to the clients who are not subscribed to presence,
+        the subscribers are sent a coalesced delta instead.
+        """
+        self.broadcast_local(message, exclude=self.presence.subscribers)
+        self.publish('notice', message)
+
+    def schedule(self, delay, function):
+        """
+        Calls the function after delay seconds.
+        """
+        timer = threading.Timer(delay, function)
+        timer.daemon = True
+        timer.start()
+
     def broadcast_file(self, message, source):
         pass
 
-    def send_message_to(self, message, destination):
+    def recipients_of(self, destination):
+        """
+        :return: the online connections a message to the given username or group name should be delivered to
+        """
         if self.username_exists(destination):
-            # Find the connection from list and db
-            user_address = self.get_user_address(destination)
-            for connection in self.connections:
-                if str(connection.sc.getpeername()) == user_address:
-                    connection.send(message)
-                    break
+            connection = self.index.user_connection(destination)
+            return [connection] if connection is not None else []
+        return self.index.group_connections(destination)
 
-        elif self.group_name_exists(destination):
-            members_address = self.get_members_address(destination)
-            for connection in self.connections:
-                if str(connection.sc.getpeername()) in members_address:
-                    connection.send(message)
+    def send_message_to(self, message, destination):
+        """
+        Sends a message to the given user, or to the members of the given group.
+        Messages to offline users are queued for them.
+        """
+        for connection in self.recipients_of(destination):
+            connection.send(message)
+        if self.bus is not None:
+            if self.username_exists(destination):
+                shard = self.index.user_shard(destination)
+                if shard is not None:
+                    self.publish('message', message, destination, to=shard)
+            elif self.group_name_exists(destination):
+                self.publish('message', message, destination)
+        # Under the lock, so the message is queued before a resume of the session takes the queue
+        with self.index.lock:
+            offline_users = self.index.offline_recipients(destination)
+            if offline_users:
+                self.offline.enqueue(offline_users, message)
+
+    def deliver_offline_messages(self, connection):
+        """
+        Sends the messages queued for the user of the connection while it was offline, in batches,
+        once they have been taken from the queue.
+        """
+        def deliver(future):
+            for batch in self.offline.batches(future.result()):
+                connection.send(batch)
 
-    def send_file_to(self, message, filename, filesize, destination):
-        if self.username_exists(destination):
-            # Find the connection from list and db
-            address = self.get_user_address(destination)
-            for connection in self.connections:
-                if str(connection.sc.getpeername()) == address:
-                    connection.send_file(message, filename, filesize)
-                    break
+        connection.then(self.offline.take(connection.user_id), deliver)
 
-        elif self.group_name_exists(destination):
-            members_address = self.get_members_address(destination)
-            for connection in self.connections:
-                if str(connection.sc.getpeername()) in members_address:
-                    connection.send_file(message, filename, filesize)
+    def send_file_to(self, message, path, filesize, destination, local=True, remote=True):
+        """
+        Sends a file of the MediaStore to the given user, or to the members of the given group.
+        :param local: whether to send it to the recipients connected to this shard,
+         False when they have already been sent the file while it was uploaded
+        :param remote: whether the other shards should send it to their recipients
+        """
+        if local:
+            FileFanout(path, filesize, message, self.recipients_of(destination)).start()
+        if remote:
+            self.publish('file', message, path, filesize, destination)
 
     def username_exists(self, username):
         """
-            Checks whether the given username exists in database.
+            Checks whether the given username belongs to an online user.
             :returns True if exists, False if it does not exist.
         """
-        cur = self.conn.cursor()
-        cur.execute("""SELECT username
-                       FROM routing_table
-                       WHERE username=? """,
-                    (username,))
-        existing_username = cur.fetchone()
-        return not (existing_username is None)
-
-    def get_user_address(self, username):
-        cur = self.conn.cursor()
-        cur.execute("""SELECT address
-                       FROM routing_table
-                       WHERE username=?""",
-                    (username,))
-        found_users = cur.fetchone()
-        return found_users[0]
-
-    def get_user_username(self, address):
-        cur = self.conn.cursor()
-        cur.execute("""SELECT username
-                       FROM routing_table
-                       WHERE address=?""",
-                    (address,))
-        found_users = cur.fetchone()
-        return found_users[0]
-
-    def update_username(self, user_address, new_username):
-        """
-        Updates the username of the given address to the given new username, if the new one is available.
-        :param user_address: ip and port address of the user
-        :param new_username: the requested new username
-        :return: if successful, row id of the newly added user. A negative value otherwise.
+        return username in self.index.user_ids
+
+    def get_user_id(self, username):
+        return self.index.user_ids[username]
+
+    def find_user_id(self, username):
+        """
+        :return: the id of the online or offline user holding the username, None if there is no such user
         """
-        cur = self.conn.cursor()
+        user_id = self.index.user_ids.get(username)
+        return user_id if user_id is not None else self.index.offline.get(username)
 
-        if self.name_exists(new_username):
-            # Username already taken
-            return -1
-        else:
-            old_username = self.get_user_username(str(user_address))
+    def get_user_username(self, user_id):
+        return self.index.usernames[user_id]
 
+    def update_username(self, user_id, new_username):
+        """
+        Updates the username of the given user to the given new username, if the new one is available.
+        The username of an offline user is still taken, until the user resumes its session or expires.
+        :param user_id: id of the user
+        :param new_username: the requested new username
+        :return: 0 if successful. A negative value otherwise.
+        """
+        def update(cur):
             cur.execute(''' UPDATE routing_table
                             SET username = ?
-                            WHERE address = ?''', (new_username, str(user_address)))
-            self.conn.commit()
-
-            # Notify all users that this user has changed their username
-            message = pack_message("Server", 'broadcast',
-                                   "User {} has changed their username to {}!"
-                                   " If you want to chat with them,"
-                                   " you need to enter command `/change-chat {}`"
-                                   .format(old_username, new_username, new_username))
-            self.broadcast(message)
-            return cur.lastrowid
+                            WHERE id = ?''', (new_username, user_id))
 
-    def online_users(self):
+        if not valid_username(new_username):
+            return -1
+        with self.index.lock:
+            if self.name_exists(new_username):
+                # Username already taken
+                return -1
+            old_username = self.get_user_username(user_id)
+
+            self.storage.submit(update)
+            self.index.rename_user(user_id, new_username)
+        self.usernames.release(old_username)
+        self.publish('rename', user_id, old_username, new_username)
+
+        # Notify all users that this user has changed their username
+        message = pack_message("Server", 'broadcast',
+                               "User {} has changed their username to {}!"
+                               " If you want to chat with them,"
+                               " you need to enter command `/change-chat {}`"
+                               .format(old_username, new_username, new_username))
+        self.broadcast_notice(message)
+        return 0
+
+    def resume(self, connection, token):
+        """
+        Gives a connection the identity of a previous session of its client: its user id, username and groups,
+        in place of the one assigned to the connection when it was accepted.
+        A connection of this shard the user is still online on, which its client has given up, is dropped.
+        :param token: the token of the previous session, sent to the client with `/session_token`,
+                      or in the reply to the resume of that session
+        :return: the username of the user and the token of the new session, a token is only good for one
+                 resume. None if there is no such session, or the user is online on another shard.
+        """
+        row = self.storage.query_one("SELECT id, username FROM routing_table WHERE token = ?", (token_digest(token),))
+        if row is None or row[0] == connection.user_id:
+            return None
+        user_id, username = row
+        stale = self.index.connections.get(user_id)
+        if stale is not None:
+            self.unregister(stale)
+            stale.abort()
+
+        token = new_token()
+        replaced_id = connection.user_id
+
+        def update(cur):
+            cur.execute("DELETE FROM users_groups WHERE user_id = ?", (replaced_id,))
+            cur.execute("DELETE FROM routing_table WHERE id = ?", (replaced_id,))
+            cur.execute(''' UPDATE routing_table
+                            SET status = ?, address = ?, token = ?
+                            WHERE id = ?''', (1, connection.address, token_digest(token), user_id))
+
+        with self.index.lock:
+            if self.index.offline.get(username) != user_id:
+                return None
+            replaced_username = self.get_user_username(replaced_id)
+            self.index.remove_connection(connection)
+            self.index.remove_user(replaced_id)
+            self.index.remove_user_memberships(replaced_id)
+            self.index.remove_offline_user(username)
+            connection.user_id = user_id
+            self.index.add_user(user_id, username)
+            self.index.add_connection(connection)
+            self.storage.submit(update)
+        self.usernames.release(replaced_username)
+        self.publish('resume', user_id, username, self.shard, replaced_id, replaced_username)
+        logger.info('%s resumed its session on connection %s', username, connection.address)
+
+        message = pack_message('Server', 'broadcast', '{} is back in the chatroom!'.format(username))
+        self.broadcast_notice(message)
+        return username, token
+
+    def forget_offline_user(self, cur, username):
         """
-        :return: a list of all usernames that are currently online
+        Deletes the offline user still holding the given username in the routing_table, with its memberships
+        and queued messages, before the username is taken by someone else.
         """
-        cur = self.conn.cursor()
-        cur.execute("""SELECT username
-                       FROM routing_table
-                       WHERE status=?
-                    """, (1,))
-        users = cur.fetchall()
+        for table in ('users_groups', 'offline_messages'):
+            cur.execute(''' DELETE FROM {}
+                            WHERE user_id IN (SELECT id FROM routing_table WHERE username = ? AND status = ?)'''
+                        .format(table), (username, 0))
+        cur.execute(''' DELETE FROM routing_table
+                        WHERE username = ? AND status = ?''', (username, 0))
+
+    def online_users(self, after=None, limit=DIRECTORY_PAGE_SIZE):
+        """
+        Served from the directory of the routing index, the users of every shard are in it.
+        :return: a page of the usernames that are currently online, one per line, the username the next page
+                 starts after (None if this is the last page) and the number of users online
+        """
+        return self.index.online.page(after, min(max(limit, 1), DIRECTORY_MAX_PAGE_SIZE))
 
-        return users
+    def slow_consumer_detected(self, connection):
+        """
+        Called when a message doesn't fit in the outbox of the connection.
+        :return: True if the connection should be closed, False if the message is just dropped
+        """
+        with self.stats_lock:
+            if self.slow_consumer == 'disconnect':
+                self.slow_disconnects += 1
+                return True
+            self.dropped_messages += 1
+            return False
+
+    def outbox_stats(self):
+        """
+        :return: a summary of the outbound queues of the connected clients
+        """
+        depths = [connection.outbox_depth() for connection in list(self.connections)]
+        return {
+            'connections': len(depths),
+            'queued_messages': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'dropped_messages': self.dropped_messages,
+            'slow_consumers_disconnected': self.slow_disconnects,
+        }
 
     def remove_connection(self, connection):
         """
@@ -197,192 +789,548 @@ class Server(threading.Thread):
         Args:
             connection (ServerSocket): The ServerSocket thread to remove.
         """
-        # TODO make it offline in db
         self.connections.remove(connection)
+        self.index.remove_connection(connection)
 
-    def make_offline(self, connection):
-        user_address = connection.sc.getpeername()
+    def make_offline(self, user_ids):
+        now = time.time()
+        self.storage.submit(lambda cur: cur.executemany(''' UPDATE routing_table
+                                                            SET status = ?, last_seen = ?
+                                                            WHERE id = ?''',
+                                                        [(0, now, user_id) for user_id in user_ids]))
 
-        cur = self.conn.cursor()
-        cur.execute(''' UPDATE routing_table
-                        SET status = ?
-                        WHERE address = ?''', (0, str(user_address)))
-        self.conn.commit()
-
-    def create_group(self, user_address, group_name):
+    def create_group(self, connection, group_name, reply):
         """
             Creates a new group, adds it to groups table in database,
             adds its creator to user_groups table
             As the desired group name could be duplicate, this function first checks whether the group name is already used or not.
-            :param address:
-            :param username:
-            :return: If successful, row id of the newly added user. A negative value otherwise.
+            :param connection: the connection of the creator, which waits for the write with `then`
+            :param reply: function called with the row id of the newly added group if successful,
+             a negative value otherwise
         """
-        if self.name_exists(group_name):
-            return -1
-        else:
-            cur = self.conn.cursor()
+        user_id, creator_address = connection.user_id, connection.address
+        creation_date = str(datetime.now())
+
+        def insert(cur):
             cur.execute(''' INSERT INTO groups(name, creator_address, creation_date)
-                            VALUES(?,?,?) ''', (group_name, user_address, str(datetime.now())))
+                            VALUES(?,?,?) ''', (group_name, creator_address, creation_date))
             created_group_id = cur.lastrowid
 
-            cur.execute(''' INSERT INTO users_groups(user_address, group_id)
-                            VALUES(?,?) ''', (user_address, created_group_id))
+            cur.execute(''' INSERT INTO users_groups(user_id, group_id)
+                            VALUES(?,?) ''', (user_id, created_group_id))
+            return created_group_id
+
+        def created(future):
+            try:
+                created_group_id = future.result()
+            except sqlite3.IntegrityError:
+                # Another connection or shard has just created a group with this name
+                reply(-1)
+                return
+            with self.index.lock:
+                self.index.add_group(created_group_id, group_name, creator_address, creation_date)
+                self.index.add_member(created_group_id, user_id)
+            self.publish('group', created_group_id, group_name, creator_address, creation_date)
+            self.publish('member', [(created_group_id, user_id)])
+            reply(created_group_id)
 
-            self.conn.commit()
-            return cur.lastrowid
+        if self.name_exists(group_name):
+            reply(-1)
+            return
+        # The id of the group is needed for the index, so the group is indexed once it is committed
+        connection.then(self.storage.submit(insert), created)
 
     def get_group_id(self, group_name):
-        """
-            Checks whether the given group_name exists in database.
-            :returns True if exists, False if it does not exist.
-        """
-        cur = self.conn.cursor()
-        cur.execute("""SELECT id
-                       FROM groups
-                       WHERE name=? """,
-                    (group_name,))
-        found_group = cur.fetchone()
-        return found_group[0]
+        return self.index.groups[group_name]
 
     def group_name_exists(self, group_name):
         """
             Checks whether the given group_name exists in database.
             :returns True if exists, False if it does not exist.
         """
-        cur = self.conn.cursor()
-        cur.execute("""SELECT name
-                       FROM groups
-                       WHERE name=? """,
-                    (group_name,))
-        found_group = cur.fetchone()
-        return not (found_group is None)
+        return group_name in self.index.groups
 
-    def is_member_of(self, user_address, group_name):
-        cur = self.conn.cursor()
+    def is_member_of(self, user_id, group_name):
+        return user_id in self.index.group_members(group_name)
 
-        group_id = self.get_group_id(group_name)
-
-        cur.execute("""SELECT id
-                       FROM users_groups
-                       WHERE user_address=? AND 
-                       group_id=?""",
-                    (user_address, group_id))
+    def join_groups(self, user_id, group_names):
+        """
+        Adds the user to several groups with a single write, and tells the members of each group.
+        :return: group name -> 1 if the user joined it, 0 if it was already a member, -1 if there is no such group
+        """
+        results = {}
+        with self.index.lock:
+            for group_name in group_names:
+                if group_name in results:
+                    continue
+                if not self.group_name_exists(group_name):
+                    results[group_name] = -1
+                elif self.is_member_of(user_id, group_name):
+                    results[group_name] = 0
+                else:
+                    results[group_name] = 1
+            memberships = [(self.get_group_id(group_name), user_id)
+                           for group_name, result in results.items() if result == 1]
+            if memberships:
+                self.add_memberships(memberships)
+        if memberships:
+            self.publish('member', memberships)
+            username = self.get_user_username(user_id)
+            for group_name, result in results.items():
+                if result == 1:
+                    message = pack_message("Sender", group_name,
+                                           "{} just joined the group {}!".format(username, group_name))
+                    self.send_message_to(message, group_name)
+        return results
+
+    def add_members(self, user_id, group_name, usernames):
+        """
+        Adds users, online or offline, to a group the user is a member of, with a single write.
+        :return: -1 if there is no such group or the user is not a member of it, otherwise username ->
+                 1 if the user was added, 0 if it was already a member, -1 if there is no such user
+        """
+        results = {}
+        with self.index.lock:
+            if not self.group_name_exists(group_name) or not self.is_member_of(user_id, group_name):
+                return -1
+            group_id = self.get_group_id(group_name)
+            members = self.index.group_members(group_name)
+            added = []
+            memberships = []
+            for username in usernames:
+                if username in results:
+                    continue
+                member_id = self.find_user_id(username)
+                if member_id is None:
+                    results[username] = -1
+                elif member_id in members:
+                    results[username] = 0
+                else:
+                    results[username] = 1
+                    added.append(username)
+                    memberships.append((group_id, member_id))
+            if memberships:
+                self.add_memberships(memberships)
+        if memberships:
+            self.publish('member', memberships)
+            content = "{} added {} to the group {}!".format(self.get_user_username(user_id), ', '.join(added),
+                                                            group_name)
+            self.send_message_to(pack_message("Sender", group_name, content), group_name)
+        return results
+
+    def add_memberships(self, memberships):
+        """
+        Writes (group id, member user id) pairs to users_groups with a single statement, and to the index.
+        Called with the index lock held, the caller publishes them to the other shards.
+        """
+        self.storage.submit(lambda cur: cur.executemany(''' INSERT INTO users_groups(user_id, group_id)
+                                                            VALUES(?,?) ''',
+                                                        [(user_id, group_id) for group_id, user_id in memberships]))
+        self.index.add_memberships(memberships)
 
-        found_group = cur.fetchone()
-        return not (found_group is None)
+    def show_groups(self, after=None, limit=DIRECTORY_PAGE_SIZE):
+        """
+        :return: a page of the groups, one per line with their number of members, the group name the next page
+                 starts after (None if this is the last page) and the number of groups
+        """
+        return self.index.group_directory.page(after, min(max(limit, 1), DIRECTORY_MAX_PAGE_SIZE))
 
-    def join_group(self, user_address, group_name):
-        cur = self.conn.cursor()
-        if not self.group_name_exists(group_name):
-            return -1
-        elif self.is_member_of(user_address, group_name):
-            return 0
+    def leave_groups(self, user_id, group_names):
+        """
+        Removes the user from several groups with a single write, and tells the members left in each group.
+        :return: group name -> 1 if the user left it, 0 if it was not a member, -1 if there is no such group
+        """
+        results = {}
+        with self.index.lock:
+            for group_name in group_names:
+                if group_name in results:
+                    continue
+                if not self.group_name_exists(group_name):
+                    results[group_name] = -1
+                elif not self.is_member_of(user_id, group_name):
+                    results[group_name] = 0
+                else:
+                    results[group_name] = 1
+            memberships = [(self.get_group_id(group_name), user_id)
+                           for group_name, result in results.items() if result == 1]
+            if memberships:
+                self.storage.submit(lambda cur: cur.executemany(''' DELETE FROM users_groups
+                                                                    WHERE user_id = ? AND group_id = ?''',
+                                                                [(user_id, group_id)
+                                                                 for group_id, user_id in memberships]))
+                self.index.remove_memberships(memberships)
+        if memberships:
+            self.publish('unmember', memberships)
+            username = self.get_user_username(user_id)
+            for group_name, result in results.items():
+                if result == 1:
+                    message = pack_message("Sender", group_name, "{} left the group {}!".format(username, group_name))
+                    self.send_message_to(message, group_name)
+        return results
+
+    def record_message(self, user_id, recipient, content):
+        """
+        Appends a relayed message to the history of its chat.
+        Messages to a destination that doesn't exist were not delivered, and are not recorded.
+        """
+        sender = self.get_user_username(user_id)
+        if recipient == 'broadcast':
+            chat = chat_key('broadcast')
+        elif self.find_user_id(recipient) is not None:
+            chat = chat_key('user', user_id, self.find_user_id(recipient))
+        elif self.group_name_exists(recipient):
+            chat = chat_key('group', recipient)
         else:
-            group_id = self.get_group_id(group_name)
-            cur.execute(''' INSERT INTO users_groups(user_address, group_id)
-                            VALUES(?,?) ''',
-                        (user_address, group_id))
-            self.conn.commit()
-            username = self.get_user_username(user_address)
-            message = pack_message("Sender", group_name, "{} just joined the group {}!".format(username, group_name))
-            self.send_message_to(message, group_name)
-            return cur.lastrowid
-
-    def show_groups(self):
-        cur = self.conn.cursor()
-        cur.execute("""SELECT *
-                       FROM groups
-                    """)
-
-        groups = cur.fetchall()
-        return groups
-
-    def leave_group(self, user_address, group_name):
-        cur = self.conn.cursor()
-        if not self.group_name_exists(group_name):
+            return
+        self.history.append(chat, sender, recipient, content)
+
+    def message_history(self, user_id, chat, before=None, limit=PAGE_SIZE):
+        """
+        :param chat: 'broadcast', a group name, or the username of the other side of a direct chat
+        :return: a page of the messages of the chat, oldest first, and whether there are older messages.
+                 -1 if the user is not a member of the group, or there is no such user.
+        """
+        if chat == 'broadcast':
+            return self.history.page(chat_key('broadcast'), before, limit)
+        elif self.group_name_exists(chat):
+            if not self.is_member_of(user_id, chat):
+                return -1
+            return self.history.page(chat_key('group', chat), before, limit)
+        # The other side may be offline, its past messages are still part of the chat
+        other_id = self.find_user_id(chat)
+        if other_id is None:
             return -1
-        elif not self.is_member_of(user_address, group_name):
-            return 0
-        else:
-            group_id = self.get_group_id(group_name)
-            cur.execute(''' DELETE FROM users_groups
-                            WHERE user_address = ? AND 
-                            group_id = ?''',
-                        (user_address, group_id))
-            self.conn.commit()
-
-            username = self.get_user_username(user_address)
-            message = pack_message("Sender", group_name, "{} left the group {}!".format(username, group_name))
-            self.send_message_to(message, group_name)
-            return cur.lastrowid
-
-    def get_members_address(self, group_name):
-        group_id = self.get_group_id(group_name)
-        cur = self.conn.cursor()
-        cur.execute("""SELECT user_address
-                       FROM users_groups
-                       WHERE group_id=?""",
-                    (group_id,))
-        found_members = cur.fetchall()
-        found_members_clean = []
-        for member in found_members:
-            found_members_clean.append(member[0])
-        return found_members_clean
+        return self.history.page(chat_key('user', user_id, other_id), before, limit)
 
-    def name_exists(self, name):
-        return self.username_exists(name) or self.group_name_exists(name)
+    def get_members(self, group_name):
+        return list(self.index.group_members(group_name))
 
+    def name_exists(self, name):
+        """
+        Usernames of offline users are still taken, messages to them are queued.
+        """
+        return self.username_exists(name) or name in self.index.offline or self.group_name_exists(name)
+
+
+def batch_results(results):
+    """
+    :return: the outcome of a command on several groups or users, as NAME=RESULT fields of its reply
+    """
+    return ';'.join('{}={}'.format(name, result) for name, result in results.items())
+
+
+def valid_username(username):
+    """
+    Usernames are arguments of space separated commands and may end up in paths,
+    so they can't contain whitespace or path separators.
+    """
+    return bool(username) and not any(c.isspace() or c in '/\\' for c in username)
+
+
+def new_token():
+    """
+    :return: a token for a client to resume its session with, of which only the digest is stored
+    """
+    return secrets.token_urlsafe(24)
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def busy_message():
+    return pack_message('Server', 'broadcast', '/server_busy')
+
+
+def reset_online_users(storage):
+    """
+    Users still marked as online were connected when a previous run of the server stopped.
+    Marks them as offline.
+    """
+    storage.write("UPDATE routing_table SET status = ?, last_seen = ? WHERE status = ?", (0, time.time(), 1))
+
+
+class CommandHandler:
+    """
+    Parses and executes the messages and commands received from a single client.
+    Subclasses provide the transport: `server`, `sockname`, `address`, `sending`, the fan-outs being
+    sent to the client, `send(message)`, `deliver_file(fanout)`, `finish()` and `abort()`.
+    """
+    # The file this client is uploading, the `/send-file` message and recipient it is forwarded with,
+    # and in cut-through mode, the fan-out relaying it to the recipients while it is being received
+    incoming_file = None
+    incoming_file_header = None
+    fanout = None
+    # SHA-256 of the file being uploaded with `/send-file`, which it is stored under
+    incoming_file_hash = None
+    # Transfer id -> Upload, the files this client is uploading with `/upload`, several at once
+    uploads = None
+    # Id of the user of the connection, which stays the same when the user resumes its session on another one
+    user_id = None
+    # Whether the connection is among the server's connections, and the time.monotonic() it last received data at
+    registered = False
+    last_seen = 0.0
+    # Class -> TokenBucket of the rate limits, and the classes whose frames are being refused,
+    # which the client has been told about once
+    buckets = None
+    refusing = None
+
+    @property
+    def busy(self):
+        """
+        Whether a file is being transferred from or to the client, which a draining server waits for.
+        """
+        return self.incoming_file is not None or bool(self.uploads) or bool(self.sending)
 
-class ServerSocket(threading.Thread):
-    def __init__(self, sc, sockname, server):
-        super().__init__()
-        self.sc = sc
-        self.sockname = sockname
-        self.server = server
+    def upload_recipients(self):
+        """
+        :return: the users or groups the files this client is uploading are for
+        """
+        recipients = [upload.recipient for upload in list(self.uploads.values())] if self.uploads else []
+        if self.incoming_file_header is not None:
+            recipients.append(self.incoming_file_header[2])
+        return recipients
 
-    def run(self):
-        while True:
-            message = self.sc.recv(1024)
-            if message:
-                print('{}: {!r}'.format(self.sockname, message))
-                try:
-                    self.parse(message)
-                except ValueError:
-                    print(ValueError.with_traceback())
+    def then(self, future, callback):
+        """
+        Calls the callback with a Future of a storage write once it is done.
+        The thread of the connection waits for it, the frames it receives meanwhile are handled afterwards.
+        """
+        futures.wait([future])
+        callback(future)
+
+    def handle_frame(self, frame):
+        if not self.registered:
+            return  # Turned away, or reaped
+        if frame_type(frame) == FILE_DATA:
+            metrics.inc('chat_frames_total', type='file_data')
+            if self.incoming_file is not None:
+                self.write_file_data(frame_body(frame))
+            return
+        if frame_type(frame) == FILE_CHUNK:
+            metrics.inc('chat_frames_total', type='file_chunk')
+            self.write_chunk(frame)
+            return
+
+        metrics.inc('chat_frames_total', type='message')
+        message_logger.debug('%s: %r', self.sockname, frame)
+        try:
+            self.parse(frame)
+        except ValueError as e:
+            logger.warning('Invalid message from %s: %s', self.sockname, e)
 
-            else:
-                # Client has closed the socket, exit the thread
-                # TODO add name! and broadcast to all that they left! and change their status to offline!
-                left_username = self.server.get_user_username(str(self.sc.getpeername()))
-                content = '{} left the chatroom!'.format(left_username)
-                message = pack_message('Server', 'broadcast', content)
-                self.server.broadcast(message, self.sockname)
-                print(message)
-                self.sc.close()
-                self.server.remove_connection(self)
-                self.server.make_offline(self)
-                return
+    def admit(self, sender, recipient, content, ref=0):
+        """
+        Checks a message or command against the rate limit of its class, and chat messages against the load.
+        The first frame refused is answered with '/rate_limited:class=CLASS;retry=SECONDS'
+        or '/overloaded:retry=SECONDS', the next ones are dropped silently until a frame of the class is admitted,
+        unless they have a ref, whose sender waits for a reply.
+        :return: False if the frame is refused
+        """
+        name = frame_class(recipient, content)
+        if name is None:
+            return True
+        if name in ('message', 'broadcast') and self.server.overloaded():
+            metrics.inc('chat_shed_messages_total', kind=name)
+            return self.refuse('overloaded', sender, '/overloaded:retry=1', ref)
+        bucket = self.buckets.get(name)
+        if bucket is None or bucket.take():
+            self.refusing.discard(name)
+            self.refusing.discard('overloaded')
+            return True
+        metrics.inc('chat_rate_limited_total', kind=name)
+        return self.refuse(name, sender, '/rate_limited:class={};retry={:.3f}'.format(name, bucket.retry_after()),
+                           ref)
+
+    def refuse(self, name, sender, content, ref):
+        if ref or name not in self.refusing:
+            self.refusing.add(name)
+            self.send(pack_message('Server', sender, content, ref=ref))
+        return False
+
+    def throttle(self, size):
+        """
+        Counts received bytes against the byte rate of the connection.
+        :return: the seconds to stop reading from the client for
+        """
+        bucket = self.buckets.get('bytes')
+        if bucket is None:
+            return 0
+        delay = bucket.delay(size)
+        if delay:
+            metrics.inc('chat_throttled_seconds_total', delay)
+        return delay
 
-    def send(self, message):
-        self.sc.sendall(message)
+    def receive_file(self, message, filename, filesize, recipient):
+        # Received under a name of its own, so files of the same name sent at the same time don't collide
+        try:
+            self.incoming_file = IncomingFile('send-file.{}.{}'.format(os.getpid(), next(INCOMING_FILE_IDS)),
+                                              filesize, self.server.partial_dir,
+                                              preallocate=self.server.cut_through, progress=False)
+        except OSError as e:
+            # Its FILE_DATA frames are dropped
+            logger.error('Could not receive %s from %s: %s', filename, self.sockname, e)
+            return
+        logger.info('Receiving %s (%s bytes) from %s for %s', filename, filesize, self.sockname, recipient)
+        self.incoming_file_header = (message, filename, recipient)
+        self.incoming_file_hash = hashlib.sha256()
+        if self.server.cut_through:
+            self.fanout = FileFanout(self.incoming_file.save_path, filesize, message,
+                                     self.server.recipients_of(recipient), available=0)
+            self.fanout.start()
+
+        if self.incoming_file.done:
+            self.write_file_data(b'')
+
+    def write_file_data(self, data):
+        done = self.incoming_file.write(data)
+        self.incoming_file_hash.update(data)
+        if self.fanout is not None:
+            self.fanout.advance(len(data))
+
+        if done:
+            incoming_file = self.incoming_file
+            message, filename, recipient = self.incoming_file_header
+            digest = self.incoming_file_hash.hexdigest()
+            relayed = self.fanout is not None
+            self.incoming_file = self.incoming_file_header = self.incoming_file_hash = self.fanout = None
+            # The fan-out keeps reading the received file after it has been moved to the store, or deleted
+            # because the store already has it
+            stored = self.server.media.add(digest, incoming_file.filesize, filename,
+                                           self.server.get_user_username(self.user_id), recipient,
+                                           source=incoming_file.save_path)
+            def forward(stored):
+                # Recipients on this shard have been sent the file while it was uploaded in cut-through mode
+                self.server.send_file_to(message, stored.result(), incoming_file.filesize, recipient,
+                                         local=not relayed)
+
+            self.then(stored, forward)
+
+    def abort_file(self):
+        if self.incoming_file is not None:
+            self.incoming_file.close()
+            if self.fanout is not None:
+                self.fanout.abort()
+            os.remove(self.incoming_file.save_path)
+            self.incoming_file = self.incoming_file_header = self.incoming_file_hash = self.fanout = None
+        if self.uploads:
+            # Their partial files are kept, for the uploads to be resumed
+            for upload in self.uploads.values():
+                upload.close()
+            self.uploads = None
+
+    def file_size(self, text):
+        """
+        :return: the size of a file announced by the client, which the media store must be able to hold
+        """
+        filesize = int(text)
+        if not 0 <= filesize <= self.server.media.max_size:
+            raise ValueError('Invalid file size {}'.format(filesize))
+        return filesize
 
-    def send_file(self, message, filename, filesize):
-        print('LINE 201, MESSAGE: ' + str(message))
-        self.sc.sendall(message)
-        send_file(self.sc, 'server_media/' + str(filename), filesize)
+    def start_upload(self, transfer_id, filename, filesize, recipient):
+        """
+        :return: the Upload, resumed from the partial file of a previous upload of the file by this user
+        """
+        if self.uploads is None:
+            self.uploads = {}
+        previous = self.uploads.pop(transfer_id, None)
+        if previous is not None:
+            previous.close()
+        sender = self.server.get_user_username(self.user_id)
+        upload = Upload(transfer_id, self.server.save_dir, os.path.basename(filename), filesize, self.user_id, sender,
+                        recipient)
+        logger.info('Receiving %s (%s bytes, from offset %s) from %s for %s', upload.filename, filesize,
+                    upload.offset, self.sockname, recipient)
+        self.uploads[transfer_id] = upload
+        return upload
+
+    def write_chunk(self, frame):
+        transfer_id, offset, crc, data = unpack_chunk(frame)
+        upload = self.uploads.get(transfer_id) if self.uploads else None
+        if upload is None:
+            return  # A chunk still in flight when the upload was restarted or replaced
+        if upload.write(offset, crc, data):
+            upload.rejected = False
+            if upload.done:
+                self.finish_upload(upload)
+            elif upload.offset - upload.acked >= ACK_INTERVAL:
+                upload.acked = upload.offset
+                self.send(pack_message('Server', upload.sender,
+                                       "/upload_ack:id={};offset={}".format(transfer_id, upload.offset)))
+        elif not upload.rejected:
+            # The chunks already sent after this one are dropped silently, until the sender restarts
+            upload.rejected = True
+            self.send(pack_message('Server', upload.sender,
+                                   "/upload_error:id={};offset={}".format(transfer_id, upload.offset)))
+
+    def finish_upload(self, upload):
+        del self.uploads[upload.transfer_id]
+        upload.close()
+        stored = self.server.media.add(upload.hash.hexdigest(), upload.filesize, upload.filename, upload.sender,
+                                       upload.recipient, source=upload.partial_path)
+
+        def forward(stored):
+            path = stored.result()
+            self.send(pack_message('Server', upload.sender, "/upload_done:id={}".format(upload.transfer_id)))
+            self.forward_file(path, upload.filename, upload.filesize, upload.sender, upload.recipient)
+
+        self.then(stored, forward)
+
+    def forward_file(self, path, filename, filesize, sender, recipient):
+        message = pack_message(sender, recipient, '/send-file {} {}'.format(filename, filesize))
+        self.server.send_file_to(message, path, filesize, recipient)
+
+    @staticmethod
+    def directory_args(command):
+        """
+        :return: the name a page of /online-users or /show-groups starts after, and its number of entries
+        """
+        args = command.split()
+        after = args[1] if len(args) > 1 else None
+        try:
+            limit = int(args[2]) if len(args) > 2 else DIRECTORY_PAGE_SIZE
+        except ValueError:
+            limit = DIRECTORY_PAGE_SIZE
+        return after, limit
 
     def parse(self, message):
         sender, recipient, content = unpack_message(message)
+        # Replies to commands carry the ref of the command, which clients match them with
+        ref = frame_ref(message)
+        if not self.admit(sender, recipient, content, ref):
+            return
+        started = perf_counter()
+        command = content.split(' ', 1)[0] if content.startswith("/") else None
 
         if content.startswith("/"):  # Its a command
-            if content.startswith("/send-file"):
+            if content.startswith("/ping"):
+                # Heartbeat of a client checking that the server is still there
+                self.send(pack_message('Server', sender, '/pong', ref=ref))
+
+            elif content.startswith("/pong"):
+                pass  # Answer to a heartbeat of the Reaper, receiving it was all that mattered
+
+            elif content.startswith("/send-file"):
                 _, filename, filesize = content.split()
-                filesize = int(filesize)
-                # TODO each client should have its own directory in server_media!
-                # TODO broadcast file?
-                recv_file(self.sc, filename, filesize, 'server_media')
-                self.server.send_file_to(message, filename, filesize, recipient)
+                filesize = self.file_size(filesize)
+                self.receive_file(message, filename, filesize, recipient)
+
+            elif content.startswith("/upload"):
+                # /upload <transfer-id> <filename> <size>, followed by FILE_CHUNK frames from the offset replied.
+                # The content is only deduplicated once received: a digest the client claims proves nothing.
+                args = content.split()
+                upload = None
+                try:
+                    transfer_id, filename, filesize = int(args[1]), os.path.basename(args[2]), self.file_size(args[3])
+                    upload = self.start_upload(transfer_id, filename, filesize, recipient)
+                    content = "/upload_result:id={};offset={}".format(transfer_id, upload.offset)
+                except (IndexError, ValueError, OSError):
+                    content = "/upload_result:id=-1"
+                message = pack_message('Server', sender, content, ref=ref)
+                self.send(message)
+                if upload is not None and upload.done:
+                    self.finish_upload(upload)
 
             elif content.startswith("/change-chat"):
                 _, new_recipient = content.split()
@@ -392,109 +1340,437 @@ class ServerSocket(threading.Thread):
                 else:
                     content = "/change-chat_result:new_recipient=-1"
 
-                message = pack_message('Server', sender, content)
-                print(message)
+                message = pack_message('Server', sender, content, ref=ref)
                 self.send(message)
 
             elif content.startswith("/change-username"):
                 _, new_username = content.split()
-                result = self.server.update_username(self.sc.getpeername(), new_username)
+                result = self.server.update_username(self.user_id, new_username)
                 if result == -1:
                     content = "/change-username_result:new_username=-1"
                 else:
                     content = "/change-username_result:new_username=" + new_username
-                message = pack_message('Server', sender, content)
-                print(message)
+                message = pack_message('Server', sender, content, ref=ref)
                 self.send(message)
 
+            elif content.startswith("/resume"):
+                # /resume <token>, sent by a client reconnecting with the token of its previous session
+                # The reply carries the token of the resumed session, which replaces the one sent on connection
+                args = content.split()
+                result = self.server.resume(self, args[1]) if len(args) == 2 else None
+                if result is None:
+                    content = "/resume_result:username=-1"
+                else:
+                    content = "/resume_result:username={};token={}".format(*result)
+                message = pack_message('Server', sender, content, ref=ref)
+                self.send(message)
+                if result is not None:
+                    self.server.deliver_offline_messages(self)
+
             elif content.startswith("/online-users"):
-                online_users = self.server.online_users()
-                content = "/online-users\n"
-                for user in online_users:
-                    content += user[0] + '\n'
-                message = pack_message('Server', sender, content)
-                print(message)
+                # /online-users [after-username] [limit]
+                after, limit = self.directory_args(content)
+                online_users, next_after, count = self.server.online_users(after, limit)
+                content = "/online-users:next={};count={}\n".format(next_after or -1, count) + online_users
+                message = pack_message('Server', sender, content, ref=ref)
                 self.send(message)
 
             elif content.startswith("/create-group"):
                 _, group_name = content.split()
-                result = self.server.create_group(str(self.sc.getpeername()), group_name)
-                if result == -1:  # Group Exists
-                    content = "/create-group_result:create_group=-1"
-                elif result >= 0:  # Group Created Successfully
-                    content = "/create-group_result:create_group=" + group_name
-                message = pack_message('Server', sender, content)
-                print(message)
-                self.send(message)
+
+                def reply(result):
+                    if result == -1:  # Group Exists
+                        content = "/create-group_result:create_group=-1"
+                    else:  # Group Created Successfully
+                        content = "/create-group_result:create_group=" + group_name
+                    self.send(pack_message('Server', sender, content, ref=ref))
+
+                self.server.create_group(self, group_name, reply)
 
             elif content.startswith("/join-group"):
-                _, group_name = content.split()
-                result = self.server.join_group(str(self.sc.getpeername()), group_name)
+                # /join-group <group> [group...]
+                group_names = content.split()[1:]
+                result = self.server.join_groups(self.user_id, group_names)
+                if len(group_names) > 1:
+                    content = "/join-group_result:" + batch_results(result)
+                    result = None
+                else:
+                    group_name, = group_names
+                    result = result[group_name]
                 if result == -1:
                     content = "/join-group_result:join_group=-1"
                 elif result == 0:
                     # Already Joined!
                     content = "/join-group_result:join_group=0"
-                elif result > 0:
+                elif result == 1:
                     # Joined Succesfully!
                     content = "/join-group_result:join_group=" + group_name
 
-                message = pack_message('Server', sender, content)
-                print(message)
+                message = pack_message('Server', sender, content, ref=ref)
                 self.send(message)
 
             elif content.startswith("/show-groups"):
-                groups = self.server.show_groups()
-                print(groups)
-                # TODO add number of group members
-                content = "/show-groups_result=\n"
-                for group in groups:
-                    content += str(group) + '\n'
-
-                message = pack_message('Server', sender, content)
-                print(message)
+                # /show-groups [after-group] [limit]
+                after, limit = self.directory_args(content)
+                groups, next_after, count = self.server.show_groups(after, limit)
+                content = "/show-groups_result:next={};count={}\n".format(next_after or -1, count) + groups
+
+                message = pack_message('Server', sender, content, ref=ref)
                 self.send(message)
 
             elif content.startswith("/leave-group"):
-                _, group_name = content.split()
-                result = self.server.leave_group(str(self.sc.getpeername()), group_name)
+                # /leave-group <group> [group...]
+                group_names = content.split()[1:]
+                result = self.server.leave_groups(self.user_id, group_names)
+                if len(group_names) > 1:
+                    content = "/leave-group_result:" + batch_results(result)
+                    result = None
+                else:
+                    group_name, = group_names
+                    result = result[group_name]
                 if result == -1:
                     # There is no such group
                     content = "/leave-group_result:leave_group=-1"
                 elif result == 0:
                     # Group Exists, But this client is not a member of it. (i.e. already left!)
                     content = "/leave-group_result:leave_group=0"
-                elif result > 0:
+                elif result == 1:
                     # Left Successfully!
                     content = "/leave-group_result:leave_group=" + group_name
 
-                message = pack_message('Server', sender, content)
-                print(message)
+                message = pack_message('Server', sender, content, ref=ref)
+                self.send(message)
+
+            elif content.startswith("/add-members"):
+                # /add-members <group> <username> [username...]
+                args = content.split()
+                results = self.server.add_members(self.user_id, args[1], args[2:]) if len(args) > 2 else -1
+                if results == -1:
+                    content = "/add-members_result:group=-1"
+                else:
+                    content = "/add-members_result:group={};".format(args[1]) + batch_results(results)
+                message = pack_message('Server', sender, content, ref=ref)
+                self.send(message)
+
+            elif content.startswith("/history"):
+                # /history <chat> [before-id] [limit]
+                args = content.split()
+                try:
+                    chat = args[1]
+                    before = int(args[2]) if len(args) > 2 else None
+                    limit = int(args[3]) if len(args) > 3 else PAGE_SIZE
+                    result = self.server.message_history(self.user_id, chat, before, limit)
+                except (IndexError, ValueError):
+                    chat, result = None, -1
+                if result == -1:
+                    content = "/history_result:chat=-1"
+                else:
+                    result, older = result
+                    # The id to pass as before-id to get the previous page, -1 when this is the first page
+                    before = result[0][0] if older else -1
+                    content = "/history_result:chat={};before={}\n".format(chat, before)
+                    for message_id, message_sender, message_recipient, message_content, creation_date in result:
+                        content += "{} [{}] {} -> {}: {}\n".format(message_id, creation_date[:19], message_sender,
+                                                                 message_recipient, message_content)
+                message = pack_message('Server', sender, content, ref=ref)
+                self.send(message)
+
+            elif content.startswith("/compression"):
+                # /compression zlib|none: whether the frames sent to this client are compressed
+                args = content.split()
+                self.compress = len(args) > 1 and args[1] == 'zlib' and self.server.compression
+                content = "/compression_result:" + ('zlib' if self.compress else 'none')
+                message = pack_message('Server', sender, content, ref=ref)
+                self.send(message)
+
+            elif content.startswith("/subscribe-presence"):
+                # Changes of presence are pushed as /presence_delta frames from now on,
+                # the users already online are listed by /online-users
+                self.server.presence.subscribe(self)
+                content = "/subscribe-presence_result:online={}".format(len(self.server.index.online))
+                message = pack_message('Server', sender, content, ref=ref)
+                self.send(message)
+
+            elif content.startswith("/unsubscribe-presence"):
+                self.server.presence.unsubscribe(self)
+                message = pack_message('Server', sender, "/unsubscribe-presence_result", ref=ref)
                 self.send(message)
 
             else:
                 content = "/command_invalid"
-                message = pack_message('Server', sender, content)
-                print(message)
+                message = pack_message('Server', sender, content, ref=ref)
                 self.send(message)
 
         else:  # Its a message
             # Actually send a message to recipient!
+            self.server.record_message(self.user_id, recipient, content)
             if recipient == 'broadcast':
                 self.server.broadcast(message, self.sockname)
             else:
                 self.server.send_message_to(message, recipient)
 
+        if command is not None:
+            metrics.observe('chat_command_seconds', perf_counter() - started,
+                            command=command if command in COMMANDS else 'invalid')
+        elif metrics.enabled:
+            if recipient == 'broadcast':
+                kind = 'broadcast'
+            elif self.server.group_name_exists(recipient):
+                kind = 'group'
+            else:
+                kind = 'direct'
+            metrics.observe('chat_relay_seconds', perf_counter() - started, kind=kind)
+            metrics.inc('chat_messages_total', kind=kind)
+
+
+class ServerSocket(CommandHandler, threading.Thread):
+    def __init__(self, sc, sockname, server):
+        super().__init__()
+        self.sc = sc
+        self.sockname = sockname
+        self.address = str(sc.getpeername())
+        self.server = server
+        self.decoder = FrameDecoder()
+        # Serializes the frames written to this client by the writer and the fan-out threads
+        self.lock = threading.Lock()
+
+        # Messages to this client are queued and written by a writer thread of its own,
+        # so sending to a slow client never blocks the sender
+        self.outbox = queue.Queue(maxsize=server.outbox_size)
+        self.writer = threading.Thread(target=self.drain, daemon=True)
+        self.closed = False
+        self.compress = False
+        self.sending = set()
+
+    def run(self):
+        if not self.handshake():
+            self.disconnect()
+            return
+        self.writer.start()
+        while True:
+            try:
+                data = self.sc.recv(BUFFER_SIZE)
+            except OSError:
+                data = None
+
+            if data:
+                self.last_seen = time.monotonic()
+                metrics.inc('chat_bytes_received_total', len(data))
+                try:
+                    self.decoder.feed(data)
+                    for frame in self.decoder:
+                        self.handle_frame(frame)
+                except (ValueError, OSError) as e:
+                    # The stream can not be decoded anymore, or a file it carries can not be written
+                    logger.warning('Closing connection %s: %s', self.sockname, e)
+                    data = None
+                else:
+                    # Clients sending faster than their byte rate are read from more slowly
+                    time.sleep(self.throttle(len(data)))
+
+            if not data:
+                # Client has closed the socket, exit the thread
+                self.disconnect()
+                return
+
+    def handshake(self):
+        """
+        Makes the TLS handshake of an encrypted connection, before the writer thread starts using the socket.
+        :return: False if it failed
+        """
+        if not isinstance(self.sc, ssl.SSLSocket):
+            return True
+        try:
+            self.sc.do_handshake()
+            return True
+        except (ssl.SSLError, OSError) as e:
+            logger.warning('TLS handshake with %s failed: %s', self.sockname, e)
+            return False
+
+    def disconnect(self):
+        self.abort_file()
+        self.stop_writer()
+        self.sc.close()
+        self.server.unregister(self)
+
+    def send(self, message):
+        if self.closed:
+            return
+        if self.compress:
+            message = compress_message(message)
+        try:
+            self.outbox.put_nowait(message)
+        except queue.Full:
+            if self.server.slow_consumer_detected(self):
+                logger.warning('Disconnecting slow consumer %s', self.sockname)
+                self.shutdown()
+
+    def drain(self):
+        """
+        Writes the queued messages to the client until the connection is closed.
+        """
+        while True:
+            message = self.outbox.get()
+            if message is None or self.closed:
+                return
+            if message is FINISH:
+                self.closed = True
+                self.shutdown()
+                return
+            try:
+                with self.lock:
+                    self.sc.sendall(message)
+                metrics.inc('chat_bytes_sent_total', len(message))
+            except OSError:
+                self.shutdown()
+                return
+
+    def stop_writer(self):
+        self.closed = True
+        try:
+            self.outbox.put_nowait(None)
+        except queue.Full:
+            pass  # The writer is busy, and checks `closed` before writing the next message
+
+    def shutdown(self):
+        """
+        Shuts the socket down from any thread, which makes the reading thread clean the connection up.
+        """
+        try:
+            self.sc.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def finish(self):
+        """
+        Closes the connection once the messages queued for the client have been written.
+        """
+        try:
+            self.outbox.put(FINISH, timeout=DRAIN_STEP)
+        except queue.Full:
+            self.abort()
+
+    def outbox_depth(self):
+        return self.outbox.qsize()
+
+    def deliver_file(self, fanout):
+        self.sending.add(fanout)
+        threading.Thread(target=self.send_fanout, args=(fanout,), daemon=True).start()
+
+    def send_fanout(self, fanout):
+        """
+        Sends the file of the fan-out to this client from a thread of its own,
+        so a slow client doesn't hold up the uploader or the other recipients.
+        """
+        try:
+            # The header is written right away instead of being queued, so it precedes the file content
+            with self.lock:
+                self.sc.sendall(fanout.message)
+            offset = 0
+            while offset < fanout.filesize:
+                available = fanout.wait(offset)
+                if available <= offset:
+                    # The upload was aborted
+                    with self.lock:
+                        self.sc.sendall(fanout.abort_message())
+                    break
+                for start, count in fanout.chunks(offset, available):
+                    if self.compress:
+                        frame = compress_frame(fanout.frame_header(count) + fanout.map[start:start + count])
+                        with self.lock:
+                            self.sc.sendall(frame)
+                        metrics.inc('chat_bytes_sent_total', len(frame))
+                    elif isinstance(self.sc, ssl.SSLSocket):
+                        with memoryview(fanout.map) as view, view[start:start + count] as chunk:
+                            with self.lock:
+                                self.sc.sendall(fanout.frame_header(count))
+                                self.sc.sendall(chunk)
+                            metrics.inc('chat_bytes_sent_total', count)
+                    else:
+                        # Copied from the file to the socket by the kernel with sendfile(), without passing
+                        # through user space. The offset is explicit, the recipients share the file
+                        with self.lock:
+                            self.sc.sendall(fanout.frame_header(count))
+                            sent = self.sc.sendfile(fanout.f, start, count)
+                        if sent < count:
+                            # The frame can not be completed, the stream is broken
+                            raise ConnectionError('{} was truncated while sending'.format(fanout.path))
+                        metrics.inc('chat_bytes_sent_total', count)
+                    offset = start + count
+        except OSError:
+            pass  # The client has disconnected
+        finally:
+            self.sending.discard(fanout)
+            fanout.release()
+
+    def abort(self):
+        """
+        Drops the connection of a client which doesn't answer anymore.
+        """
+        self.closed = True
+        self.shutdown()
+
+    def close(self):
+        self.sc.close()
+
+
+def stop(server, restart=False):
+    """
+    Drains the server and exits. On a hot restart, a new server process started with the same arguments
+    takes over the listening socket first, and the clients reconnect to it as they are disconnected,
+    resuming their sessions.
+    """
+    if not server.stopping.acquire(blocking=False):
+        return  # Already stopping
+    handoff = None
+    if restart:
+        logger.info('Restarting')
+        handoff = spawn_successor(server.listener)
+        if handoff is None:
+            server.stopping.release()
+            return
+    else:
+        logger.info('Shutting down')
+    server.drain(handoff)
+    stop_logging()
+    os._exit(0)
+
+
+def handle_signals(server):
+    """
+    SIGTERM drains the server and exits, SIGHUP restarts it without closing the listening socket.
+    The signals are handled by threads of their own, as draining takes a while.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=stop, args=(server,)).start())
+    if server.shards == 1:
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: threading.Thread(target=stop, args=(server, True)).start())
+
 
 def exit(server):
     while True:
         ipt = input('')
         if ipt == 'q':
-            print('Closing all connections')
-            for connection in server.connections:
-                connection.sc.close()
-            print('shutting down the server_media')
-            os._exit(0)
+            stop(server)
+        elif ipt == 'r':
+            stop(server, restart=True)
+        elif ipt == 's':
+            print(server.outbox_stats())
+        elif ipt == 'm':
+            metrics.enabled = not metrics.enabled
+            print('Metrics are {}'.format('enabled' if metrics.enabled else 'disabled'))
+
+
+def server_class(mode):
+    """
+    :param mode: 'thread' or 'async'
+    :return: the Server class of the mode
+    """
+    if mode == 'async':
+        from .async_server import AsyncServer
+
+        return AsyncServer
+    return Server
 
 
 if __name__ == '__main__':
@@ -505,11 +1781,101 @@ if __name__ == '__main__':
     parser.add_argument('-db', metavar='DATABSE', type=str, default='db.sqlite',
                         help='Database Path (The Defualt is set to file "db.sqlite"'
                              ' which should be located in the same directory that server.py is in)')
+    parser.add_argument('-mode', choices=['thread', 'async'], default='thread',
+                        help='thread: one thread per client (default),'
+                             ' async: a single asyncio event loop serving all clients')
+    parser.add_argument('-backlog', metavar='BACKLOG', type=int, default=socket.SOMAXCONN,
+                        help='Maximum number of pending connections (default SOMAXCONN)')
+    parser.add_argument('-relay', choices=['cut-through', 'store'], default='cut-through',
+                        help='cut-through: forward files to recipients while they are uploaded (default),'
+                             ' store: forward files once they are completely stored in server_media')
+    parser.add_argument('-outbox', metavar='SIZE', type=int, default=OUTBOX_SIZE,
+                        help='Maximum number of messages queued for a client (default {})'.format(OUTBOX_SIZE))
+    parser.add_argument('-slow-consumer', choices=['drop', 'disconnect'], default='drop',
+                        help='What to do when the outbox of a client is full: drop the message (default)'
+                             ' or disconnect the client')
+    parser.add_argument('-offline-queue', metavar='SIZE', type=int, default=OFFLINE_QUEUE_SIZE,
+                        help='Maximum number of messages queued for an offline user'
+                             ' (default {})'.format(OFFLINE_QUEUE_SIZE))
+    parser.add_argument('-offline-ttl', metavar='SECONDS', type=float, default=OFFLINE_TTL,
+                        help='How long offline users keep their username and queued messages'
+                             ' (default {}, a week)'.format(OFFLINE_TTL))
+    parser.add_argument('-workers', metavar='N', type=int, default=1,
+                        help='Number of worker processes sharing the port, each serving a shard of the clients'
+                             ' (default 1)')
+    parser.add_argument('-metrics-port', metavar='PORT', type=int, default=None,
+                        help='Serve the metrics at http://127.0.0.1:PORT/metrics (shard i of -workers at PORT+i)')
+    parser.add_argument('-metrics', choices=['on', 'off'], default='on',
+                        help='Whether metrics are recorded at startup (default on). They can be toggled'
+                             " with POST /metrics/enable and /metrics/disable, or by typing 'm'")
+    parser.add_argument('-log-file', metavar='PATH', type=str, default=LOG_FILE,
+                        help='Log file, rotated every 10MB (default {}). Shard i of -workers logs to PATH.i'
+                             .format(LOG_FILE))
+    parser.add_argument('-log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help='DEBUG also logs a sample of the messages (default INFO)')
+    parser.add_argument('-log-sample', metavar='N', type=int, default=SAMPLE_RATE,
+                        help='Log one message in N at DEBUG level (default {})'.format(SAMPLE_RATE))
+    parser.add_argument('-media-size', metavar='BYTES', type=int, default=MEDIA_MAX_SIZE,
+                        help='Size of the stored files beyond which the least recently sent ones are deleted'
+                             ' (default {}, 1GB)'.format(MEDIA_MAX_SIZE))
+    parser.add_argument('-media-ttl', metavar='SECONDS', type=float, default=MEDIA_TTL,
+                        help='How long sent files are kept (default {}, 30 days)'.format(MEDIA_TTL))
+    parser.add_argument('-partial-ttl', metavar='SECONDS', type=float, default=PARTIAL_TTL,
+                        help='How long the partial file of an interrupted upload is kept to be resumed'
+                             ' (default {}, a day)'.format(PARTIAL_TTL))
+    parser.add_argument('-heartbeat', metavar='SECONDS', type=float, default=HEARTBEAT_INTERVAL,
+                        help='Ping the clients silent for SECONDS (default {})'.format(HEARTBEAT_INTERVAL))
+    parser.add_argument('-idle-timeout', metavar='SECONDS', type=float, default=IDLE_TIMEOUT,
+                        help='Disconnect the clients silent for SECONDS, pings included'
+                             ' (default {})'.format(IDLE_TIMEOUT))
+    parser.add_argument('-rate-limit', metavar='CLASS=RATE[/BURST]', type=parse_rate_limit, action='append',
+                        default=[],
+                        help='Frames per second a client may send, for a class among {} (bytes for bytes),'
+                             ' and the burst allowed (twice the rate by default). A rate of 0 lifts the limit.'
+                             ' Defaults: {}'.format(', '.join(RATE_LIMITS),
+                                                    ', '.join('{}={:g}/{:g}'.format(name, *limit)
+                                                              for name, limit in RATE_LIMITS.items())))
+    parser.add_argument('-max-connections', metavar='N', type=int, default=MAX_CONNECTIONS,
+                        help='Connections beyond which new clients are told the server is busy, per worker'
+                             ' (default {})'.format(MAX_CONNECTIONS))
+    parser.add_argument('-accept-rate', metavar='N', type=float, default=ACCEPT_RATE,
+                        help='New connections accepted per second, per worker (default {})'.format(ACCEPT_RATE))
+    parser.add_argument('-drain-timeout', metavar='SECONDS', type=float, default=DRAIN_TIMEOUT,
+                        help="How long file transfers may go on when the server stops, on SIGTERM or 'q',"
+                             " or restarts, on SIGHUP or 'r' (default {})".format(DRAIN_TIMEOUT))
+    parser.add_argument('-drain-spread', metavar='SECONDS', type=float, default=DRAIN_SPREAD,
+                        help='Time over which the clients are disconnected when the server stops or restarts'
+                             ' (default {})'.format(DRAIN_SPREAD))
+    parser.add_argument('-cert', metavar='CERTFILE', type=str, default=None,
+                        help='Certificate of the server (PEM), which encrypts the connections with TLS')
+    parser.add_argument('-key', metavar='KEYFILE', type=str, default=None,
+                        help='Private key of the certificate, if it is not in CERTFILE')
+    parser.add_argument('-compression', choices=['on', 'off'], default='on',
+                        help='Whether clients may ask for compressed frames with `/compression zlib` (default on)')
     args = parser.parse_args()
 
-    # Create and start server thread
-    server = Server(args.host, args.p, args.db)
-    server.start()
-
-    exit = threading.Thread(target=exit, args=(server,))
-    exit.start()
+    log_options = dict(path=args.log_file, level=args.log_level, sample_rate=args.log_sample)
+    options = dict(backlog=args.backlog, cut_through=args.relay == 'cut-through',
+                   outbox_size=args.outbox, slow_consumer=args.slow_consumer,
+                   offline_queue_size=args.offline_queue, offline_ttl=args.offline_ttl,
+                   metrics_port=args.metrics_port, metrics_enabled=args.metrics == 'on',
+                   certfile=args.cert, keyfile=args.key, compression=args.compression == 'on',
+                   media_max_size=args.media_size, media_ttl=args.media_ttl, partial_ttl=args.partial_ttl,
+                   heartbeat_interval=args.heartbeat, idle_timeout=args.idle_timeout,
+                   rate_limits=dict(RATE_LIMITS, **dict(args.rate_limit)),
+                   max_connections=args.max_connections, accept_rate=args.accept_rate,
+                   drain_timeout=args.drain_timeout, drain_spread=args.drain_spread)
+    if args.workers > 1:
+        from .cluster import serve_cluster
+
+        serve_cluster(args.host, args.p, args.db, args.mode, args.workers, options, log_options)
+    else:
+        setup_logging(**log_options)
+        # Create and start server thread
+        server = server_class(args.mode)(args.host, args.p, args.db, **options)
+        server.start()
+        handle_signals(server)
+
+        exit = threading.Thread(target=exit, args=(server,), daemon=True)
+        exit.start()
+        server.join()
@@ -0,0 +1,365 @@
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+
+from .log import logger
+from .metrics import metrics
+
+# ================ Schema Migrations =============
+# Each migration upgrades the database by one version, which is kept in PRAGMA user_version.
+# Databases created by the original db.py script are at version 0 and already have the tables
+# of the first migration, hence the IF NOT EXISTS clauses.
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS routing_table
+    (
+        address TEXT PRIMARY KEY,
+        username          TEXT,
+        status INTEGER DEFAULT 1
+    );
+    CREATE TABLE IF NOT EXISTS groups
+    (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        creator_address TEXT,
+        creation_date          TEXT
+    );
+    CREATE TABLE IF NOT EXISTS users_groups
+    (
+        id INTEGER PRIMARY KEY,
+        user_address TEXT,
+        group_id          TEXT
+    );
+    ''',
+    '''
+    DELETE FROM routing_table
+    WHERE rowid NOT IN (SELECT MAX(rowid) FROM routing_table GROUP BY username);
+    DELETE FROM groups
+    WHERE id NOT IN (SELECT MIN(id) FROM groups GROUP BY name);
+    DELETE FROM users_groups
+    WHERE id NOT IN (SELECT MIN(id) FROM users_groups GROUP BY user_address, group_id);
+
+    CREATE UNIQUE INDEX routing_table_username ON routing_table(username);
+    CREATE INDEX routing_table_status ON routing_table(status);
+    CREATE UNIQUE INDEX groups_name ON groups(name);
+    CREATE UNIQUE INDEX users_groups_membership ON users_groups(user_address, group_id);
+    CREATE INDEX users_groups_group_id ON users_groups(group_id);
+    ''',
+    '''
+    CREATE TABLE messages
+    (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat TEXT NOT NULL,
+        sender TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        content TEXT NOT NULL,
+        creation_date TEXT NOT NULL
+    );
+    CREATE INDEX messages_chat ON messages(chat, id);
+    ''',
+    '''
+    ALTER TABLE routing_table ADD COLUMN last_seen REAL;
+    CREATE TABLE offline_messages
+    (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        message BLOB NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX offline_messages_username ON offline_messages(username, id);
+    CREATE INDEX offline_messages_expires ON offline_messages(expires);
+    ''',
+    '''
+    CREATE TABLE media_blobs
+    (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX media_blobs_last_used ON media_blobs(last_used);
+    CREATE TABLE media_files
+    (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hash TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        sender TEXT,
+        recipient TEXT,
+        created REAL NOT NULL
+    );
+    CREATE INDEX media_files_hash ON media_files(hash);
+    CREATE INDEX media_files_created ON media_files(created);
+    ''',
+    # Users are identified by an integer id instead of the address they first connected from,
+    # and keep it, with their groups, when they reconnect with their resume token (of which the SHA-256 is kept)
+    '''
+    ALTER TABLE routing_table RENAME TO routing_table_old;
+    CREATE TABLE routing_table
+    (
+        id INTEGER PRIMARY KEY,
+        address TEXT,
+        username TEXT NOT NULL,
+        status INTEGER DEFAULT 1,
+        last_seen REAL,
+        token TEXT
+    );
+    INSERT INTO routing_table(address, username, status, last_seen)
+    SELECT address, username, status, last_seen FROM routing_table_old;
+
+    ALTER TABLE users_groups RENAME TO users_groups_old;
+    CREATE TABLE users_groups
+    (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        group_id INTEGER NOT NULL
+    );
+    INSERT INTO users_groups(user_id, group_id)
+    SELECT routing_table.id, users_groups_old.group_id
+    FROM users_groups_old JOIN routing_table ON routing_table.address = users_groups_old.user_address;
+
+    DROP TABLE routing_table_old;
+    DROP TABLE users_groups_old;
+    CREATE UNIQUE INDEX routing_table_username ON routing_table(username);
+    CREATE INDEX routing_table_status ON routing_table(status);
+    CREATE UNIQUE INDEX routing_table_token ON routing_table(token);
+    CREATE UNIQUE INDEX users_groups_membership ON users_groups(user_id, group_id);
+    CREATE INDEX users_groups_group_id ON users_groups(group_id);
+    ''',
+    # Queued messages belong to the user id rather than to whoever holds the username, and are only
+    # delivered to the session resuming it. Messages of usernames no offline user holds are dropped.
+    '''
+    ALTER TABLE offline_messages RENAME TO offline_messages_old;
+    CREATE TABLE offline_messages
+    (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        message BLOB NOT NULL,
+        expires REAL NOT NULL
+    );
+    INSERT INTO offline_messages(user_id, message, expires)
+    SELECT routing_table.id, offline_messages_old.message, offline_messages_old.expires
+    FROM offline_messages_old JOIN routing_table ON routing_table.username = offline_messages_old.username
+    WHERE routing_table.status = 0
+    ORDER BY offline_messages_old.id;
+
+    DROP TABLE offline_messages_old;
+    CREATE INDEX offline_messages_user_id ON offline_messages(user_id, id);
+    CREATE INDEX offline_messages_expires ON offline_messages(expires);
+    ''',
+    # User ids are never handed out again once their row is deleted, the direct chat history is keyed by them.
+    # sqlite_sequence keeps the highest id ever inserted. It starts above the ids of the direct chats,
+    # as the rows of some of their users may already be gone.
+    '''
+    ALTER TABLE routing_table RENAME TO routing_table_old;
+    CREATE TABLE routing_table
+    (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        address TEXT,
+        username TEXT NOT NULL,
+        status INTEGER DEFAULT 1,
+        last_seen REAL,
+        token TEXT
+    );
+    INSERT INTO routing_table(id, address, username, status, last_seen, token)
+    SELECT id, address, username, status, last_seen, token FROM routing_table_old;
+    DROP TABLE routing_table_old;
+    CREATE UNIQUE INDEX routing_table_username ON routing_table(username);
+    CREATE INDEX routing_table_status ON routing_table(status);
+    CREATE UNIQUE INDEX routing_table_token ON routing_table(token);
+
+    INSERT INTO sqlite_sequence(name, seq)
+    SELECT 'routing_table', 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'routing_table');
+    UPDATE sqlite_sequence
+    SET seq = MAX(seq, COALESCE((SELECT MAX(MAX(CAST(substr(chat, 4, instr(chat, '|') - 4) AS INTEGER),
+                                                CAST(substr(chat, instr(chat, '|') + 1) AS INTEGER)))
+                                 FROM messages WHERE chat LIKE 'dm:%'), 0))
+    WHERE name = 'routing_table';
+    ''',
+]
+
+BATCH_SIZE = 256  # Maximum number of writes committed together
+
+
+def report_failure(future):
+    if future.exception() is not None:
+        logger.error('A database write failed: %s', future.exception())
+
+
+def migrate(conn):
+    """
+    Applies the migrations the database has not seen yet.
+    :return: the schema version of the database
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # executescript commits any pending transaction, and runs the script in its own
+        conn.executescript('BEGIN;' + migration + 'PRAGMA user_version = {};COMMIT;'.format(i))
+        version = i
+    return version
+
+
+class Storage:
+    """
+    SQLite persistence of the chat state.
+    All writes go through a single writer thread, which commits them in batches: a storm of
+    joins, leaves or renames costs one fsync per batch instead of one per statement.
+    Reads use a connection of the reading thread, and thanks to WAL mode they never wait for the writer.
+    """
+
+    def __init__(self, db_file, batch_size=BATCH_SIZE):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.local = threading.local()
+
+        self.writer_conn = self.connect(check_same_thread=False)
+        self.writer_conn.execute('PRAGMA journal_mode=WAL')
+        self.version = migrate(self.writer_conn)
+
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, name='storage-writer', daemon=True)
+        self.writer.start()
+
+    def connect(self, check_same_thread=True):
+        # Transactions are managed explicitly
+        conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=check_same_thread)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    # ================ Reads =============
+
+    def reader(self):
+        """
+        :return: the read connection of the calling thread
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def query(self, sql, params=()):
+        """
+        :return: a cursor over the rows of the query, so large results can be consumed lazily
+        """
+        with metrics.time('chat_sql_seconds', op='query'):
+            return self.reader().execute(sql, params)
+
+    def query_one(self, sql, params=()):
+        return self.query(sql, params).fetchone()
+
+    # ================ Writes =============
+
+    def submit(self, work):
+        """
+        Queues a function of a cursor to be run by the writer thread, inside a batch transaction.
+        :return: a Future of the result of the function
+        """
+        future = Future()
+        future.add_done_callback(report_failure)
+        self.writes.put((work, future))
+        return future
+
+    def execute(self, sql, params=()):
+        """
+        Queues a statement without waiting for it to be committed.
+        :return: a Future of the row id of the last inserted row
+        """
+        return self.submit(lambda cur: cur.execute(sql, params).lastrowid)
+
+    def write(self, sql, params=()):
+        """
+        Runs a statement and waits until it has been committed.
+        :return: the row id of the last inserted row
+        """
+        return self.execute(sql, params).result()
+
+    def flush(self):
+        """
+        Waits until the writes queued so far have been committed.
+        """
+        self.submit(lambda cur: None).result()
+
+    def transaction(self, work):
+        """
+        Runs a function of a cursor atomically, and waits until it has been committed.
+        :return: the result of the function
+        """
+        return self.submit(work).result()
+
+    def write_loop(self):
+        cur = self.writer_conn.cursor()
+        while True:
+            batch = [self.writes.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(work is None for work, _ in batch)
+            batch = [(work, future) for work, future in batch if work is not None]
+
+            started = perf_counter()
+            try:
+                results = self.commit_batch(cur, batch)
+            except sqlite3.Error as e:
+                # e.g. the write lock could not be taken within busy_timeout: the batch fails, the writer goes on
+                logger.error('A batch of %s database writes failed: %s', len(batch), e)
+                if self.writer_conn.in_transaction:
+                    try:
+                        cur.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        pass
+                results = [(future, None, e) for _, future in batch]
+
+            metrics.observe('chat_sql_seconds', perf_counter() - started, op='batch')
+            metrics.inc('chat_sql_writes_total', len(batch))
+
+            # Results are only published once they are durable
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+            if stop:
+                return
+
+    @staticmethod
+    def commit_batch(cur, batch):
+        """
+        Runs the writes of a batch in a single transaction.
+        :return: (future, result, error) of each write
+        :raises sqlite3.Error: if the transaction itself fails, none of the writes are committed then
+        """
+        # Takes the write lock upfront, other processes sharing the database wait for it (busy_timeout)
+        cur.execute('BEGIN IMMEDIATE')
+        results = []
+        for work, future in batch:
+            # A savepoint per write, so a failing write doesn't roll the rest of the batch back
+            cur.execute('SAVEPOINT write')
+            try:
+                results.append((future, work(cur), None))
+                cur.execute('RELEASE write')
+            except Exception as e:
+                cur.execute('ROLLBACK TO write')
+                cur.execute('RELEASE write')
+                results.append((future, None, e))
+        cur.execute('COMMIT')
+        return results
+
+    def backlog(self):
+        """
+        :return: the number of writes waiting for the writer thread
+        """
+        return self.writes.qsize()
+
+    def close(self):
+        """
+        Commits the queued writes and stops the writer thread.
+        """
+        self.writes.put((None, None))
+        self.writer.join()
+        self.writer_conn.close()
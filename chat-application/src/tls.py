@@ -0,0 +1,42 @@
+"""
+TLS for the chat connections.
+A self-signed certificate is enough for local testing, e.g.
+openssl req -x509 -newkey rsa:2048 -nodes -keyout key.pem -out cert.pem -days 365 -subj /CN=localhost
+ -addext subjectAltName=DNS:localhost,IP:127.0.0.1
+and clients then verify the server with -cafile cert.pem.
+"""
+import ssl
+
+
+def server_context(certfile, keyfile=None):
+    """
+    The server issues session tickets, so clients reconnecting to the same process resume their session
+    instead of running a full handshake. Worker processes of a cluster each have ticket keys of their own.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+class ClientContext(ssl.SSLContext):
+    """
+    A client context which resumes `session`, for asyncio connections, whose SSL objects can't be given one.
+    A session can only be resumed with the context of the connection it was established by.
+    """
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session or self.session)
+
+
+def client_context(cafile=None):
+    """
+    :param cafile: certificates to verify the server with, e.g. the self-signed certificate of a test server.
+     The default CA certificates of the system otherwise.
+    """
+    context = ClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile is not None:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
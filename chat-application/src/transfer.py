@@ -0,0 +1,103 @@
+import hashlib
+import os
+import struct
+import time
+import zlib
+
+from .utils import pack_frame, HEADER, FILE_CHUNK, FILE_CHUNK_SIZE
+
+# A FILE_CHUNK body starts with the offset of the chunk in the file and the CRC32 of its data.
+# The transfer it belongs to is the ref of the frame header.
+CHUNK_FIELDS = struct.Struct('!QI')
+ACK_INTERVAL = 4 * 1024 * 1024  # The receiver acknowledges the offset it has reached every 4MB
+PARTIAL_DIR = '.partial'  # Directory of server_media holding the uploads that are not complete yet
+PARTIAL_TTL = 24 * 3600  # Seconds an interrupted upload can be resumed for, its partial file is deleted after
+
+
+def pack_chunk(transfer_id, offset, data):
+    return pack_frame(FILE_CHUNK, CHUNK_FIELDS.pack(offset, zlib.crc32(data)) + data, ref=transfer_id)
+
+
+def expire_partials(partial_dir, ttl=PARTIAL_TTL, now=None):
+    """
+    Deletes the partial files nothing has been written to for `ttl` seconds, of uploads given up on.
+    :return: the number of deleted files
+    """
+    deadline = (now or time.time()) - ttl
+    deleted = 0
+    for entry in os.scandir(partial_dir):
+        try:
+            if entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+                deleted += 1
+        except FileNotFoundError:
+            pass  # Completed meanwhile, or deleted by another shard
+    return deleted
+
+
+def unpack_chunk(frame):
+    """
+    :return: the transfer id, offset, CRC32 and data of a FILE_CHUNK frame
+    :raises ValueError: if the frame is too short to be a chunk
+    """
+    if len(frame) < HEADER.size + CHUNK_FIELDS.size:
+        raise ValueError('Truncated chunk frame')
+    transfer_id = HEADER.unpack_from(frame)[3]
+    offset, crc = CHUNK_FIELDS.unpack_from(frame, HEADER.size)
+    return transfer_id, offset, crc, memoryview(frame)[HEADER.size + CHUNK_FIELDS.size:]
+
+
+class Upload:
+    """
+    A file a client is uploading with `/upload`, received as FILE_CHUNK frames interleaved with its other frames.
+    The chunks are appended to a partial file named after the id of the uploader, the size and the SHA-256
+    of the name of the file, so the partial file never leaves the partial directory whatever the name.
+    When the same user uploads the same file again, e.g. after losing the connection, it resumes where
+    the partial file ends. Chunks which are not at that offset, or whose CRC32 doesn't match, are rejected.
+    The SHA-256 of the file is computed as it is received, and the complete file is added to the MediaStore.
+    """
+
+    def __init__(self, transfer_id, save_dir, filename, filesize, user_id, sender, recipient):
+        self.transfer_id = transfer_id
+        self.filename = filename
+        self.filesize = filesize
+        self.sender = sender
+        self.recipient = recipient
+        name_digest = hashlib.sha256(filename.encode()).hexdigest()
+        self.partial_path = os.path.join(save_dir, PARTIAL_DIR, '{}.{}.{}'.format(user_id, filesize, name_digest))
+
+        self.f = open(self.partial_path, 'ab', buffering=0)
+        self.offset = self.f.tell()
+        if self.offset > filesize:
+            # Not a previous attempt at this file after all
+            self.f.truncate(0)
+            self.offset = 0
+        self.hash = hashlib.sha256()
+        if self.offset:
+            with open(self.partial_path, 'rb') as f:
+                for block in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+                    self.hash.update(block)
+        self.acked = self.offset
+        # Set when a chunk has been rejected, until the sender restarts at the expected offset
+        self.rejected = False
+
+    @property
+    def done(self):
+        return self.offset >= self.filesize
+
+    def write(self, offset, crc, data):
+        """
+        :return: False if the chunk was rejected
+        """
+        if offset != self.offset or offset + len(data) > self.filesize or zlib.crc32(data) != crc:
+            return False
+        self.f.write(data)
+        self.hash.update(data)
+        self.offset += len(data)
+        return True
+
+    def close(self):
+        """
+        Stops receiving the file. Unless it is complete, its partial file is kept to be resumed.
+        """
+        self.f.close()
@@ -1,106 +1,355 @@
 import os
 import random
-import sqlite3
+import struct
 import sys
-from time import sleep
+import threading
+import zlib
+from functools import lru_cache
+from time import monotonic
 
 import tqdm
 
 
-def generate_name(file_path='usernames.txt'):
-    """"
-    Chooses a random line from the given file, deletes that line, and the returns it.
-    Notice this function uses an algorithm with O(n**2) complexity which could be slow.
+class UsernamePool:
     """
-    with open(file_path, 'r') as f:
-        usernames = f.read().splitlines()
-        # print(usernames)
-        chosen_index = random.choice(range(len(usernames)))
-        chosen_username = usernames[chosen_index]
+    Hands out random usernames from the given file in O(1).
+    The file is read once. Allocations and releases are appended to a log next to it
+    (`+name` / `-name` lines), which is replayed on startup, so names stay unique across restarts
+    without rewriting the whole file on every allocation.
+    When the server runs as several worker processes, each shard owns the names hashing to it,
+    and has a log of its own.
+    """
+
+    def __init__(self, file_path='usernames.txt', log_path=None, shard=0, shards=1):
+        self.log_path = log_path or (file_path + '.log' if shards == 1 else '{}.{}.log'.format(file_path, shard))
+        self.lock = threading.Lock()
+        self.shard = shard
+        self.shards = shards
+
+        with open(file_path, 'r') as f:
+            self.names = set(name for name in f.read().splitlines()
+                             if name and zlib.crc32(name.encode('utf-8')) % shards == shard)
+
+        self.allocated = set()
+        log_lines = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    log_lines += 1
+                    op, name = line[:1], line[1:].rstrip('\n')
+                    if op == '+':
+                        self.allocated.add(name)
+                    elif op == '-':
+                        self.allocated.discard(name)
+
+        self.available = list(self.names - self.allocated)
+        random.shuffle(self.available)
+
+        if log_lines > 2 * len(self.allocated):
+            self.compact()
+        self.log = open(self.log_path, 'a')
+        # Names handed out when the pool is exhausted, which are not persisted
+        self.fallback_counter = shard
+
+    def compact(self):
+        """
+        Rewrites the log with only the current allocations.
+        """
+        tmp_path = self.log_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines('+' + name + '\n' for name in self.allocated)
+        os.replace(tmp_path, self.log_path)
+
+    def allocate(self, taken=lambda name: False):
+        """
+        Chooses a random free username and marks it as allocated.
+        :param taken: a predicate telling whether a name is already used by someone else,
+         e.g. a user who picked it with `/change-username`
+        :return: the username
+        """
+        with self.lock:
+            while self.available:
+                name = self.available.pop()
+                if name in self.allocated or taken(name):
+                    continue
+                self.allocated.add(name)
+                self.log.write('+' + name + '\n')
+                self.log.flush()
+                return name
+
+            # The pool is exhausted
+            while True:
+                self.fallback_counter += self.shards
+                name = 'user{}'.format(self.fallback_counter)
+                if not taken(name):
+                    return name
+
+    def release(self, name):
+        """
+        Returns an allocated username to the pool.
+        Names which didn't come from the pool are ignored.
+        """
+        with self.lock:
+            if name not in self.allocated:
+                return
+            self.allocated.remove(name)
+            self.log.write('-' + name + '\n')
+            self.log.flush()
+
+            # Put it back at a random position of the available names
+            self.available.append(name)
+            i = random.randrange(len(self.available))
+            self.available[i], self.available[-1] = self.available[-1], self.available[i]
+
+
+# ================ Wire Format =============
+# Every frame starts with a fixed header: body length, frame type, flags and a reference id.
+# A MESSAGE body holds the lengths of sender and recipient followed by the UTF-8 encoded
+# sender, recipient and content. A FILE_DATA body holds raw bytes of the file being transferred.
+# A FILE_CHUNK body holds a chunk of a resumable upload, see transfer.py.
+# Any body may be compressed with zlib, which is flagged with FLAG_COMPRESSED.
+HEADER = struct.Struct('!IBBI')
+MESSAGE_FIELDS = struct.Struct('!HH')
+
+MESSAGE = 1
+FILE_DATA = 2
+FILE_CHUNK = 3
 
-    usernames.remove(chosen_username)
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 16MB
+FILE_CHUNK_SIZE = 256 * 1024  # 256KB of file content per FILE_DATA frame
 
-    with open(file_path, 'w') as f:
-        f.writelines(username + "\n"
-                     for username in usernames)
+FLAG_COMPRESSED = 0x01
+COMPRESS_MIN_SIZE = 512  # Smaller bodies are not worth compressing
+COMPRESS_LEVEL = 6
+# Larger frames are not kept compressed for the next recipients, e.g. joined batches of queued messages,
+# so the cache of shared frames holds at most 256 of this size
+SHARED_FRAME_MAX_SIZE = 64 * 1024
 
-    return chosen_username
 
+def pack_frame(frame_type, body, flags=0, ref=0):
+    return HEADER.pack(len(body), frame_type, flags, ref) + body
 
-def db_connection(db_file):
-    """ create a database connection to the SQLite database
-        specified by db_file
-    :param db_file: database file
-    :return: Connection object or None
+
+def frame_type(frame):
+    return frame[4]
+
+
+def frame_body(frame):
+    return frame[HEADER.size:]
+
+
+def frame_ref(frame):
+    return HEADER.unpack_from(frame)[3]
+
+
+def pack_message(sender, recipient, content, ref=0):
+    sender = sender.encode('utf-8')
+    recipient = recipient.encode('utf-8')
+    body = MESSAGE_FIELDS.pack(len(sender), len(recipient)) + sender + recipient + content.encode('utf-8')
+    return pack_frame(MESSAGE, body, ref=ref)
+
+
+def compress_frame(frame, level=COMPRESS_LEVEL):
+    """
+    :return: the frame with its body compressed, or the frame itself if it is small, doesn't compress,
+             or is not a single uncompressed frame (e.g. a batch of queued messages)
     """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_file, check_same_thread=False)
-    except Exception as e:
-        print(e)
+    if len(frame) < HEADER.size + COMPRESS_MIN_SIZE:
+        return frame
+    body_length, kind, flags, ref = HEADER.unpack_from(frame)
+    if flags & FLAG_COMPRESSED or len(frame) != HEADER.size + body_length:
+        return frame
+    body = zlib.compress(memoryview(frame)[HEADER.size:], level)
+    if len(body) >= body_length:
+        return frame
+    return HEADER.pack(len(body), kind, flags | FLAG_COMPRESSED, ref) + body
 
-    return conn
+
+@lru_cache(maxsize=256)
+def compress_shared_frame(frame):
+    """
+    compress_frame for the frames sent to many clients, e.g. broadcasts, which are compressed once.
+    """
+    return compress_frame(frame)
 
 
-def pack_message(sender, recipient, content):
-    return ("From: {}|To: {}|Content: {}".format(sender, recipient, content)).encode('ascii')
+def compress_message(frame):
+    if len(frame) < HEADER.size + COMPRESS_MIN_SIZE:
+        return frame
+    if len(frame) > SHARED_FRAME_MAX_SIZE:
+        return compress_frame(frame)
+    return compress_shared_frame(frame)
 
 
 def unpack_message(message):
-    try:
-        message = message.decode('ascii')
-        sender, recipient, content = message.split('|')
-        sender = sender.lstrip('From: ')
-        recipient = recipient.lstrip('To: ')
-        content = content.lstrip('Content: ')
-        return sender, recipient, content
-    except ValueError:
-        print('An Exception in unpack')
-        print(message)
-
-
-def send_file(sock, filepath, filesize, BUFFER_SIZE=1024):
-    # start sending the file
-    progress = tqdm.tqdm(range(filesize), f"Sending {filepath}", unit="B",
-                         unit_scale=True, unit_divisor=1024, file=sys.stdout)
-
-    sock.settimeout(5.0)
-    try:
-        with open(filepath, "rb") as f:
-            # Start receiving data until the whole file is received
-            bytes_sent = 0
-            while bytes_sent < filesize:
-                sleep(0.1)
-                data = f.read(BUFFER_SIZE)
-                sock.sendall(data)
-                bytes_sent += len(data)
-                progress.update(len(data))
+    """
+    Decodes a MESSAGE frame.
+    :param message: a complete frame, as returned by FrameDecoder
+    :return: a tuple of sender, recipient and content
+    :raises ValueError: if the frame is not a valid MESSAGE frame
+    """
+    if len(message) < HEADER.size + MESSAGE_FIELDS.size or frame_type(message) != MESSAGE:
+        raise ValueError('Not a message frame')
+    sender_length, recipient_length = MESSAGE_FIELDS.unpack_from(message, HEADER.size)
+    sender_start = HEADER.size + MESSAGE_FIELDS.size
+    recipient_start = sender_start + sender_length
+    content_start = recipient_start + recipient_length
+    if content_start > len(message):
+        raise ValueError('Truncated message frame')
 
-            sys.stdout.flush()
-            f.close()
-    except:
-        print("Possible Connection Timeout!")
+    sender = bytes(message[sender_start:recipient_start]).decode('utf-8')
+    recipient = bytes(message[recipient_start:content_start]).decode('utf-8')
+    content = bytes(message[content_start:]).decode('utf-8')
+    return sender, recipient, content
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of a stream of frames.
+    Bytes received from a socket are fed to the decoder as they arrive, and complete frames
+    are pulled out of its buffer one by one, no matter how they were split or coalesced by recv.
+    Compressed frames are decompressed, so the frames pulled out are never compressed.
+    """
 
-    sock.settimeout(None)
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.start = 0
+        self.max_frame_size = max_frame_size
 
+    def feed(self, data):
+        if self.start and self.start >= len(self.buffer) // 2:
+            # Drop the already decoded frames before the buffer grows
+            del self.buffer[:self.start]
+            self.start = 0
+        self.buffer += data
 
-def recv_file(sock, filename, filesize, save_dir, BUFFER_SIZE=1024):
-    save_path = os.path.join(save_dir, filename)
-    print(save_path)
+    def next_frame(self):
+        """
+        :return: the next complete frame as bytes, or None if more data is needed
+        :raises ValueError: if the stream announces a frame larger than max_frame_size,
+         or has a compressed frame which can't be decompressed
+        """
+        if len(self.buffer) - self.start < HEADER.size:
+            return None
+        body_length = HEADER.unpack_from(self.buffer, self.start)[0]
+        if body_length > self.max_frame_size:
+            raise ValueError('Frame of {} bytes exceeds the maximum frame size'.format(body_length))
+
+        end = self.start + HEADER.size + body_length
+        if len(self.buffer) < end:
+            return None
+        frame = bytes(self.buffer[self.start:end])
+        self.start = end
+        if frame[5] & FLAG_COMPRESSED:
+            frame = self.decompress(frame)
+        return frame
+
+    def decompress(self, frame):
+        _, kind, flags, ref = HEADER.unpack_from(frame)
+        decompressor = zlib.decompressobj()
+        try:
+            # Bounded, so a small frame can't expand into an unbounded amount of memory
+            body = decompressor.decompress(memoryview(frame)[HEADER.size:], self.max_frame_size)
+        except zlib.error as e:
+            raise ValueError('Invalid compressed frame: {}'.format(e))
+        if not decompressor.eof:
+            raise ValueError('Compressed frame is truncated or exceeds the maximum frame size')
+        return HEADER.pack(len(body), kind, flags & ~FLAG_COMPRESSED, ref) + body
+
+    def __iter__(self):
+        return iter(self.next_frame, None)
+
+
+class Progress:
+    """
+    A tqdm progress bar for a file transfer, which is only redrawn every `interval` seconds
+    instead of on every chunk.
+    """
 
-    # start receiving the file from the socket and writing to the file stream
-    progress = tqdm.tqdm(range(filesize), f"Receiving {filename}", unit="B",
-                         unit_scale=True, unit_divisor=1024, file=sys.stdout)
+    def __init__(self, total, desc, interval=0.5):
+        self.bar = tqdm.tqdm(total=total, desc=desc, unit="B", unit_scale=True, unit_divisor=1024,
+                             file=sys.stdout, mininterval=interval)
+        self.interval = interval
+        self.pending = 0
+        self.last_update = monotonic()
+
+    def update(self, n):
+        self.pending += n
+        now = monotonic()
+        if now - self.last_update >= self.interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        if self.pending:
+            self.bar.update(self.pending)
+            self.pending = 0
+        self.last_update = now or monotonic()
+
+    def close(self):
+        self.flush()
+        self.bar.close()
+
+
+class IncomingFile:
+    """
+    A file being received as FILE_DATA frames.
+    The receiver keeps handling other frames while the file is incoming, and writes the
+    payload of each FILE_DATA frame until the whole file has been received.
+    """
+
+    def __init__(self, filename, filesize, save_dir, preallocate=False, progress=True):
+        """
+        :param preallocate: extend the file to its full size upfront, so it can be memory mapped
+         and read while it is being received
+        :param progress: show the save path and a progress bar on the console
+        """
+        self.filename = filename
+        self.filesize = filesize
+        self.save_path = os.path.join(save_dir, filename)
+        if progress:
+            print(self.save_path)
+
+        self.bytes_received = 0
+        # Unbuffered, so every received chunk is visible to readers of the file as soon as it is written
+        self.f = open(self.save_path, "wb", buffering=0)
+        if preallocate:
+            try:
+                self.f.truncate(filesize)
+            except OSError:
+                # e.g. the disk is full, the empty file is not left behind
+                self.f.close()
+                os.remove(self.save_path)
+                raise
+        # start receiving the file from the socket and writing to the file stream
+        self.progress = Progress(filesize, f"Receiving {filename}") if progress else None
+
+    @property
+    def done(self):
+        return self.bytes_received >= self.filesize
+
+    def write(self, data):
+        """
+        Writes the payload of a FILE_DATA frame.
+        :return: True once the whole file has been received
+        """
+        self.f.write(data)
+        self.bytes_received += len(data)
+        if self.progress is not None:
+            self.progress.update(len(data))
+
+        if self.done:
+            self.close()
+            sys.stdout.flush()
+        return self.done
 
-    # try:
-    with open(save_path, "wb") as f:
-        # Start receiving data until the whole file is received
-        bytes_received = 0
-        while bytes_received < filesize:
-            data = sock.recv(BUFFER_SIZE)
-            f.write(data)
-            bytes_received += len(data)
-            progress.update(len(data))
+    def close(self):
+        self.f.close()
+        if self.progress is not None:
+            self.progress.close()
 
-        sys.stdout.flush()
-        f.close()
+    def discard(self):
+        """
+        Drops a file which won't be received completely.
+        """
+        self.close()
+        os.remove(self.save_path)